@@ -0,0 +1,503 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from types import BuiltinMethodType, MethodType
+from typing import Any, Iterable, Optional
+
+LOG = logging.getLogger("localstack_persist")
+
+STATE_FILE_NAMES = ("backend", "store")
+
+
+# Offline tool for inspecting, converting and migrating persisted data without starting LocalStack, e.g.
+#   python -m localstack_persist --base-dir ./persisted-data stats
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m localstack_persist",
+        description="Inspect, convert and migrate data persisted by localstack-persist",
+    )
+    parser.add_argument(
+        "--base-dir",
+        help="directory containing persisted data (default: $PERSIST_BASE_DIR or /persisted-data)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stats = subparsers.add_parser(
+        "stats", help="show object counts and sizes per service, account and region"
+    )
+    stats.add_argument("services", nargs="*", help="services to show (default: all)")
+
+    convert = subparsers.add_parser(
+        "convert", help="rewrite persisted state in different serialization format(s)"
+    )
+    convert.add_argument(
+        "--to",
+        required=True,
+        help="comma-separated serialization formats to write, e.g. `json` or `json,binary`",
+    )
+    convert.add_argument("--jobs", type=int, default=os.cpu_count())
+    convert.add_argument(
+        "services", nargs="*", help="services to convert (default: all)"
+    )
+
+    verify = subparsers.add_parser(
+        "verify",
+        help="check that persisted state can be loaded, and saved and reloaded without changes",
+    )
+    verify.add_argument("--jobs", type=int, default=os.cpu_count())
+    verify.add_argument("services", nargs="*", help="services to verify (default: all)")
+
+    migrate = subparsers.add_parser(
+        "migrate",
+        help="load and re-save persisted state using the installed LocalStack, applying any migrations "
+        "so that they don't need to run when the container starts",
+    )
+    migrate.add_argument(
+        "services", nargs="*", help="services to migrate (default: all)"
+    )
+
+    export = subparsers.add_parser(
+        "export", help="write persisted data to a single bundle file"
+    )
+    export.add_argument("bundle", help="path of the bundle file to write")
+    export.add_argument("services", nargs="*", help="services to export (default: all)")
+
+    import_ = subparsers.add_parser(
+        "import",
+        help="replace persisted data with the data in a bundle file",
+    )
+    import_.add_argument("bundle", help="path of the bundle file to read")
+    import_.add_argument(
+        "services", nargs="*", help="services to import (default: all in the bundle)"
+    )
+
+    args = parser.parse_args(argv)
+
+    # config is read from environment variables when first imported, so this must be set before importing it
+    if args.base_dir:
+        os.environ["PERSIST_BASE_DIR"] = args.base_dir
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    match args.command:
+        case "stats":
+            return stats_command(args.services)
+        case "convert":
+            return convert_command(args.services, args.to, args.jobs)
+        case "verify":
+            return verify_command(args.services, args.jobs)
+        case "migrate":
+            return migrate_command(args.services)
+        case "export":
+            return export_command(args.bundle, args.services)
+        case "import":
+            return import_command(args.bundle, args.services)
+    return 2
+
+
+def find_services(services: Iterable[str]) -> list[str]:
+    from .config import BASE_DIR
+
+    if not os.path.isdir(BASE_DIR):
+        LOG.error("Persisted data directory %s does not exist", BASE_DIR)
+        return []
+
+    found = sorted(
+        entry.name
+        for entry in os.scandir(BASE_DIR)
+        # directories starting with "_" or "." hold internal data rather than a service's state
+        if entry.is_dir() and not entry.name.startswith(("_", "."))
+    )
+    if services := list(services):
+        for service_name in set(services) - set(found):
+            LOG.warning("No persisted state found for service %s", service_name)
+        return [s for s in found if s in services]
+    return found
+
+
+# Returns the file path bases (i.e. without extension) of all state files of the given services
+def find_state_files(services: Iterable[str]) -> list[tuple[str, str]]:
+    from .config import BASE_DIR, SerializationFormat
+
+    state_files = []
+    for service_name in find_services(services):
+        for name in STATE_FILE_NAMES:
+            file_path_base = os.path.join(BASE_DIR, service_name, name)
+            if any(
+                os.path.isfile(file_path_base + format.file_ext())
+                for format in SerializationFormat
+            ):
+                state_files.append((service_name, file_path_base))
+    return state_files
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for name in file_names:
+            try:
+                total += os.lstat(os.path.join(dir_path, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class _CountingWriter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        return len(data)
+
+
+def pickled_size(data: Any) -> Optional[int]:
+    from .serialization.pickle.handlers import CustomDillPickler
+
+    writer = _CountingWriter()
+    try:
+        CustomDillPickler(writer).dump(data)
+    except:
+        return None
+    return writer.size
+
+
+def count_objects(store: Any) -> int:
+    return sum(
+        len(value)
+        for value in vars(store).values()
+        if isinstance(value, dict | list | set)
+    )
+
+
+def stats_command(services: list[str]) -> int:
+    from localstack.services.stores import AccountRegionBundle
+    from moto.core.base_backend import BackendDict
+
+    from .config import BASE_DIR
+    from .manifest import get_service_manifest
+    from .serialization import get_deserializer
+
+    state_files = dict[str, list[str]]()
+    for service_name, file_path_base in find_state_files(services):
+        state_files.setdefault(service_name, []).append(file_path_base)
+
+    for service_name in find_services(services):
+        service_dir = os.path.join(BASE_DIR, service_name)
+        print(f"{service_name} ({format_size(dir_size(service_dir))} on disk)")
+
+        for file_path_base in state_files.get(service_name, []):
+            deserializer = get_deserializer(service_name, file_path_base)
+            assert deserializer
+            file_path = deserializer.file_path  # type: ignore[attr-defined]
+            details = ""
+            if entry := get_service_manifest(service_name).get_state_file(
+                os.path.basename(file_path_base)
+            ):
+                details = f" (last saved in {entry['save_duration_ms']:.0f} ms)"
+            print(
+                f"  {os.path.basename(file_path)}: {format_size(os.path.getsize(file_path))}{details}"
+            )
+
+            try:
+                state = deserializer.deserialize()
+            except:
+                LOG.exception("Failed to load %s", file_path)
+                continue
+
+            if not isinstance(state, AccountRegionBundle | BackendDict):
+                continue
+            for account_id, account_state in state.items():
+                for region, store in account_state.items():
+                    size = pickled_size(store)
+                    print(
+                        f"    {account_id} {region}: {count_objects(store)} objects, "
+                        f"{format_size(size) if size is not None else '? B'}"
+                    )
+    return 0
+
+
+def convert_command(services: list[str], to: str, jobs: int) -> int:
+    from .config import SerializationFormat
+
+    try:
+        formats = [SerializationFormat[f.strip().upper()] for f in to.split(",")]
+    except KeyError as e:
+        LOG.error("Unknown serialization format %s", e)
+        return 2
+
+    state_files = find_state_files(services)
+    if not state_files:
+        LOG.warning("No persisted state files found")
+        return 0
+
+    from .manifest import get_service_manifest
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = executor.map(
+            _convert_state_file,
+            *zip(*state_files),
+            [formats] * len(state_files),
+        )
+        # workers return manifest entries rather than updating manifests themselves, so that concurrent
+        # conversions of the same service's state files don't overwrite each other's entries
+        for (service_name, file_path_base), entry in zip(state_files, results):
+            if entry is None:
+                failures += 1
+                continue
+            manifest = get_service_manifest(service_name)
+            manifest.set_state_file(os.path.basename(file_path_base), entry)
+            manifest.save()
+
+    LOG.info("Converted %d state files", len(state_files) - failures)
+    return 1 if failures else 0
+
+
+# Returns the manifest entry for the converted state file, or None if it couldn't be converted
+def _convert_state_file(
+    service_name: str, file_path_base: str, formats: list
+) -> Optional[dict]:
+    from .config import SerializationFormat
+    from .serialization import describe_saved_state, get_deserializer, serializer_types
+
+    try:
+        deserializer = get_deserializer(service_name, file_path_base)
+        assert deserializer
+        data = deserializer.deserialize()
+
+        start = time.perf_counter()
+        serializers = [
+            serializer_types[format](service_name, file_path_base + format.file_ext())
+            for format in formats
+        ]
+        for serializer in serializers:
+            serializer.serialize(data)
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        for format in set(SerializationFormat) - set(formats):
+            if os.path.exists(file_path_base + format.file_ext()):
+                os.remove(file_path_base + format.file_ext())
+
+        entry = describe_saved_state(data, serializers, duration_ms)
+    except:
+        LOG.exception("Failed to convert %s", file_path_base)
+        return None
+
+    LOG.info("Converted %s", file_path_base)
+    return entry
+
+
+def verify_command(services: list[str], jobs: int) -> int:
+    state_files = find_state_files(services)
+    if not state_files:
+        LOG.warning("No persisted state files found")
+        return 0
+
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        failures = sum(
+            not ok for ok in executor.map(_verify_state_file, *zip(*state_files))
+        )
+
+    if failures:
+        LOG.error(
+            "%d of %d state files failed verification", failures, len(state_files)
+        )
+        return 1
+    LOG.info("Verified %d state files", len(state_files))
+    return 0
+
+
+# Compares deserialised state structurally, as most persisted objects don't implement `__eq__`. Pairs of objects
+# already being compared are assumed equal, so that reference cycles terminate.
+def states_equal(a: Any, b: Any, seen: Optional[set[tuple[int, int]]] = None) -> bool:
+    if type(a) is not type(b):
+        return False
+    if a is b or _equals(a, b):
+        return True
+
+    if seen is None:
+        seen = set()
+    if (id(a), id(b)) in seen:
+        return True
+    seen.add((id(a), id(b)))
+
+    if isinstance(a, dict):
+        if len(a) != len(b):
+            return False
+        if all(key in b for key in a):
+            if not all(states_equal(value, b[key], seen) for key, value in a.items()):
+                return False
+        elif not _match_all(list(a.items()), list(b.items()), seen):
+            return False
+    elif isinstance(a, list | tuple | deque):
+        if len(a) != len(b) or not all(states_equal(x, y, seen) for x, y in zip(a, b)):
+            return False
+    elif isinstance(a, set | frozenset):
+        # items that are equal by `__eq__` are matched already, so only the rest need to be compared structurally
+        if not _match_all(
+            [x for x in a if x not in b], [y for y in b if y not in a], seen
+        ):
+            return False
+    elif isinstance(a, MethodType | BuiltinMethodType):
+        # bound methods are equal by `__eq__` only if they're bound to the same object
+        return a.__name__ == b.__name__ and states_equal(a.__self__, b.__self__, seen)
+    elif type(a).__eq__ is not object.__eq__ and not _object_state(a):
+        # a value type, e.g. a string or datetime, that `_equals` found to differ
+        return False
+
+    return states_equal(_object_state(a), _object_state(b), seen)
+
+
+def _equals(a: Any, b: Any) -> bool:
+    try:
+        # NaN is the only value that isn't equal to itself
+        return bool(a == b) or (a != a and b != b)
+    except:
+        return False
+
+
+# Whether each item in `a` is equal to a different item in `b`, e.g. for sets of objects that don't implement
+# `__eq__`/`__hash__`
+def _match_all(a: list, b: list, seen: set[tuple[int, int]]) -> bool:
+    if len(a) != len(b):
+        return False
+    remaining = list(b)
+    for x in a:
+        for i, y in enumerate(remaining):
+            # a failed comparison mustn't leave pairs behind that were assumed equal while it was in progress
+            trial_seen = set(seen)
+            if states_equal(x, y, trial_seen):
+                seen.update(trial_seen)
+                del remaining[i]
+                break
+        else:
+            return False
+    return True
+
+
+def _object_state(obj: Any) -> dict:
+    state = dict(getattr(obj, "__dict__", None) or {})
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if name not in ("__dict__", "__weakref__") and hasattr(obj, name):
+                state[name] = getattr(obj, name)
+    # objects without any inspectable state, e.g. locks, are considered equal if their types are
+    return state
+
+
+def _verify_state_file(service_name: str, file_path_base: str) -> bool:
+    from .config import SerializationFormat
+    from .serialization import deserializer_types, get_deserializer, serializer_types
+
+    try:
+        deserializer = get_deserializer(service_name, file_path_base)
+        assert deserializer
+        data = deserializer.deserialize()
+
+        # Saving the loaded state and loading it again should produce equal state. The saved files themselves aren't
+        # compared, as e.g. the iteration order of sets may differ between loads.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for format in SerializationFormat:
+                file_path = os.path.join(tmp_dir, "state" + format.file_ext())
+                serializer_types[format](service_name, file_path).serialize(data)
+                reloaded = deserializer_types[format](
+                    service_name, file_path
+                ).deserialize()
+
+                if not states_equal(data, reloaded):
+                    LOG.error(
+                        "%s changed after round-trip through %s format",
+                        file_path_base,
+                        format.name.lower(),
+                    )
+                    return False
+    except:
+        LOG.exception("Failed to verify %s", file_path_base)
+        return False
+
+    LOG.info("Verified %s", file_path_base)
+    return True
+
+
+# Services are loaded and saved directly with the state visitors, rather than through the state tracker, so that
+# no lifecycle hooks are invoked, assets aren't restored into LocalStack's data directory and no background threads
+# are started
+def migrate_command(services: list[str]) -> int:
+    from localstack.services.plugins import SERVICE_PLUGINS
+
+    from .hooks import apply_compat_patches
+    from .prepare_service import prepare_service_data
+    from .visitors import LoadStateVisitor, SaveStateVisitor, StateFilesVisitor
+
+    apply_compat_patches()
+
+    failures = 0
+    for service_name in find_services(services):
+        try:
+            prepare_service_data(service_name)
+            service = SERVICE_PLUGINS.get_service(service_name)
+            if not service:
+                LOG.warning("No service %s found in service manager", service_name)
+                continue
+
+            visitor = LoadStateVisitor(service_name)
+            service.accept_state_visitor(StateFilesVisitor(visitor))
+            if visitor.failed:
+                LOG.error("Failed to load persisted state of service %s", service_name)
+                failures += 1
+                continue
+            service.accept_state_visitor(
+                StateFilesVisitor(SaveStateVisitor(service_name))
+            )
+        except:
+            LOG.exception("Failed to migrate state of service %s", service_name)
+            failures += 1
+            continue
+        LOG.info("Migrated state of service %s", service_name)
+
+    return 1 if failures else 0
+
+
+def export_command(path: str, services: list[str]) -> int:
+    from .bundle import write_bundle
+
+    if not (found := find_services(services)):
+        return 1
+    info = write_bundle(path, found)
+    print(f"Exported {', '.join(found)} to {path} ({format_size(info['size'])})")
+    return 0
+
+
+def import_command(path: str, services: list[str]) -> int:
+    from .bundle import Bundle, BundleError, import_service_dir
+
+    try:
+        bundle = Bundle(path)
+    except BundleError as e:
+        LOG.error("%s", e)
+        return 1
+
+    with bundle:
+        for service_name in set(services) - set(bundle.services):
+            LOG.warning("No persisted data for service %s in bundle", service_name)
+        for service_name in bundle.services:
+            if not services or service_name in services:
+                import_service_dir(bundle, service_name)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import gzip
+import logging
+import os
+import queue
+import tarfile
+import tempfile
+import time
+import zlib
+from threading import Thread
+from typing import BinaryIO, Optional, cast
+
+from .metrics import METRICS
+from .sqlite_backup import backup_sqlite, is_sqlite_file, sqlite_sidecar_base
+
+LOG = logging.getLogger(__name__)
+
+ARCHIVE_EXT = ".tar.gz"
+# Asset files are often already compressed (e.g. Lucene segments), so favour speed over compression ratio
+COMPRESS_LEVEL = 1
+READ_CHUNK_SIZE = 1024 * 1024
+# Maximum number of decompressed chunks to buffer ahead of extraction
+MAX_BUFFERED_CHUNKS = 16
+
+
+def get_archive_path(dir_path: str) -> str:
+    return dir_path + ARCHIVE_EXT
+
+
+# Writes the contents of `src` to a compressed tar archive at `archive_path`, replacing it atomically.
+# SQLite databases are added via an online backup, so that the archive contains a consistent copy.
+def write_asset_archive(src: str | os.PathLike, archive_path: str):
+    start = time.perf_counter()
+    src = os.fspath(src)
+    tmp_path = archive_path + ".tmp"
+    # asset directories can be nested in directories that don't exist yet, e.g. opensearch/elasticsearch/assets
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+
+    with gzip.open(tmp_path, "wb", compresslevel=COMPRESS_LEVEL) as gz, tarfile.open(
+        fileobj=gz, mode="w|"
+    ) as tar, tempfile.TemporaryDirectory(
+        dir=os.path.dirname(archive_path)
+    ) as backup_dir:
+        for dir_path, dir_names, file_names in os.walk(src):
+            dir_names.sort()
+            rel_dir = os.path.relpath(dir_path, src)
+            if rel_dir != os.curdir:
+                tar.add(dir_path, arcname=rel_dir, recursive=False)
+
+            for name in sorted(file_names):
+                if (base := sqlite_sidecar_base(name)) and base in file_names:
+                    continue
+                path = os.path.join(dir_path, name)
+                arcname = os.path.normpath(os.path.join(rel_dir, name))
+                try:
+                    _add_file(tar, path, arcname, backup_dir)
+                except FileNotFoundError:
+                    # deleted while archiving, so there's nothing to persist
+                    pass
+
+    os.replace(tmp_path, archive_path)
+    METRICS.histogram("assets.archive_write_duration_ms").record(
+        (time.perf_counter() - start) * 1000
+    )
+
+
+def _add_file(tar: tarfile.TarFile, path: str, arcname: str, backup_dir: str):
+    if os.path.islink(path) or not is_sqlite_file(path):
+        tar.add(path, arcname=arcname)
+        return
+
+    backup_path = os.path.join(backup_dir, "backup.db")
+    if not backup_sqlite(path, backup_path):
+        tar.add(path, arcname=arcname)
+        return
+    info = tar.gettarinfo(backup_path, arcname=arcname)
+    info.mtime = os.stat(path).st_mtime
+    with open(backup_path, "rb") as file:
+        tar.addfile(info, file)
+    os.remove(backup_path)
+
+
+# Extracts the archive at `archive_path` into `dst`. Decompression runs in a separate thread, so that it
+# overlaps with writing out the extracted files.
+def extract_asset_archive(archive_path: str, dst: str | os.PathLike):
+    start = time.perf_counter()
+    with open(archive_path, "rb") as file:
+        reader = _DecompressingReader(file)
+        try:
+            # streamed extraction ("r|") only ever reads from the file
+            with tarfile.open(fileobj=cast(BinaryIO, reader), mode="r|") as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(dst, filter="data")
+                else:
+                    tar.extractall(dst)
+        finally:
+            reader.close()
+
+    METRICS.histogram("assets.archive_extract_duration_ms").record(
+        (time.perf_counter() - start) * 1000
+    )
+
+
+# Read-only file-like object of the decompressed contents of a gzip file, which is decompressed in a
+# background thread
+class _DecompressingReader:
+    def __init__(self, file):
+        self._file = file
+        self._chunks = queue.Queue[bytes | BaseException | None](MAX_BUFFERED_CHUNKS)
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self._closed = False
+        self._thread = Thread(
+            target=self._decompress, name="asset-decompress", daemon=True
+        )
+        self._thread.start()
+
+    def _decompress(self):
+        try:
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            while not self._closed and (data := self._file.read(READ_CHUNK_SIZE)):
+                # an archive may contain multiple concatenated gzip members
+                while data:
+                    if chunk := decompressor.decompress(data):
+                        self._put(chunk)
+                    data = decompressor.unused_data
+                    if decompressor.eof:
+                        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            if chunk := decompressor.flush():
+                self._put(chunk)
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item: bytes | BaseException | None):
+        while not self._closed:
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            parts = []
+            while part := self.read(READ_CHUNK_SIZE):
+                parts.append(part)
+            return b"".join(parts)
+
+        while not self._buffer and not self._eof:
+            item = self._chunks.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                self._buffer = memoryview(item)
+
+        result = bytes(self._buffer[:size])
+        self._buffer = self._buffer[size:]
+        return result
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
@@ -0,0 +1,334 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Iterable, NamedTuple, Optional
+
+from .config import AssetRestoreMode, PERSIST_ASSET_CHECKSUMS, PERSIST_ASSET_RESTORE
+from .metrics import METRICS
+from .utils import file_digest
+from .sqlite_backup import backup_sqlite, is_sqlite_file, sqlite_sidecar_base
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = "assets-manifest.json"
+
+# ioctl request number to clone a file's extents into another file (from linux/fs.h)
+FICLONE = 0x40049409
+# Errors indicating that the filesystem can't clone files, e.g. because it doesn't support reflinks or
+# because the source and destination are on different filesystems
+REFLINK_UNSUPPORTED_ERRNOS = {
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+}
+
+RESTORE_THREADS = min(16, (os.cpu_count() or 1) * 4)
+
+
+class ManifestEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    hash: Optional[str]
+
+
+# Records the size, modification time (and optionally a hash) of each source file as of when it was last
+# copied into a persisted asset directory, so that unchanged files don't need to be copied again. The
+# manifest is saved next to the persisted assets, so syncs remain incremental after a restart.
+class AssetManifest:
+    def __init__(self, dst: str):
+        self.path = os.path.join(os.path.dirname(dst), MANIFEST_FILE_NAME)
+        self.entries = dict[str, ManifestEntry]()
+        self.loaded = False
+        self.dirty = False
+
+    def load(self, dst: str):
+        self.loaded = True
+        self.entries = {}
+        if not os.path.isdir(dst):
+            # without the persisted assets, the manifest doesn't describe anything
+            return
+        try:
+            with open(self.path) as file:
+                self.entries = {
+                    relpath: ManifestEntry(*entry)
+                    for relpath, entry in json.load(file).items()
+                }
+        except FileNotFoundError:
+            pass
+        except:
+            LOG.warning("Ignoring invalid asset manifest at %s", self.path)
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.entries, file, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def update(self, relpath: str, entry: ManifestEntry):
+        if self.entries.get(relpath) != entry:
+            self.entries[relpath] = entry
+            self.dirty = True
+
+    def remove_tree(self, relpath: str):
+        prefix = relpath + os.sep
+        for key in [k for k in self.entries if k == relpath or k.startswith(prefix)]:
+            del self.entries[key]
+            self.dirty = True
+
+
+_manifests = dict[str, AssetManifest]()
+_manifests_lock = Lock()
+
+
+def get_manifest(dst: str) -> AssetManifest:
+    with _manifests_lock:
+        manifest = _manifests.get(dst)
+        if not manifest:
+            manifest = _manifests[dst] = AssetManifest(dst)
+
+    if not manifest.loaded or not os.path.isdir(dst):
+        manifest.load(dst)
+    return manifest
+
+
+# Discards cached manifests of persisted asset directories within `dir`, e.g. after it's replaced by a snapshot
+def forget_manifests(dir: str):
+    prefix = os.path.join(dir, "")
+    with _manifests_lock:
+        for dst in [dst for dst in _manifests if dst.startswith(prefix)]:
+            del _manifests[dst]
+
+
+# Syncs `src` into `dst` rsync-style, copying only files that are new or changed since they were last copied
+# and removing anything that no longer exists in `src`. If `changed_paths` is given, only those paths (and
+# their descendants) are checked, otherwise the whole of `src` is.
+def sync_asset_directory(
+    src: str | os.PathLike,
+    dst: str | os.PathLike,
+    changed_paths: Optional[Iterable[str]] = None,
+):
+    src = os.fspath(src)
+    dst = os.fspath(dst)
+    manifest = get_manifest(dst)
+    syncer = _Syncer(src, dst, manifest)
+
+    if changed_paths is None:
+        seen = syncer.sync_tree(src)
+        for relpath in set(manifest.entries) - seen:
+            del manifest.entries[relpath]
+            manifest.dirty = True
+        _delete_extra_files(src, dst)
+    else:
+        # Sorting means that directories are synced before the files within them
+        for path in sorted(changed_paths):
+            relpath = os.path.relpath(path, src)
+            if relpath == os.curdir or relpath.startswith(os.pardir):
+                continue
+            try:
+                syncer.sync_path(path, relpath)
+            except FileNotFoundError:
+                # path was changed again while syncing it, which will have been recorded for the next save
+                pass
+
+    manifest.save()
+    METRICS.increment("assets.files_copied", syncer.copied)
+    METRICS.increment("assets.files_skipped", syncer.skipped)
+
+
+class _Syncer:
+    def __init__(self, src: str, dst: str, manifest: AssetManifest):
+        self.src = src
+        self.dst = dst
+        self.manifest = manifest
+        self.copied = 0
+        self.skipped = 0
+
+    def sync_path(self, path: str, relpath: str):
+        if (base := sqlite_sidecar_base(path)) and os.path.isfile(base):
+            # changes to sidecar files are synced by backing up their database
+            path, relpath = base, os.path.relpath(base, self.src)
+
+        dst_path = os.path.join(self.dst, relpath)
+        if os.path.isdir(path):
+            self.sync_tree(path)
+        elif os.path.lexists(path):
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            self.sync_file(path, relpath)
+        else:
+            self.manifest.remove_tree(relpath)
+            if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+                shutil.rmtree(dst_path)
+            elif os.path.lexists(dst_path):
+                os.remove(dst_path)
+
+    # Returns the relative paths of all files within `root`
+    def sync_tree(self, root: str) -> set[str]:
+        seen = set[str]()
+        for dir_path, _, file_names in os.walk(root, followlinks=True):
+            rel_dir = os.path.relpath(dir_path, self.src)
+            dst_dir = os.path.normpath(os.path.join(self.dst, rel_dir))
+            if os.path.lexists(dst_dir) and not os.path.isdir(dst_dir):
+                os.remove(dst_dir)
+            os.makedirs(dst_dir, exist_ok=True)
+
+            for name in file_names:
+                if (base := sqlite_sidecar_base(name)) and base in file_names:
+                    continue
+                relpath = os.path.normpath(os.path.join(rel_dir, name))
+                try:
+                    self.sync_file(os.path.join(dir_path, name), relpath)
+                    seen.add(relpath)
+                except FileNotFoundError:
+                    pass
+        return seen
+
+    def sync_file(self, path: str, relpath: str):
+        stat = os.stat(path)
+        size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        try:
+            # SQLite databases in WAL mode may be modified by only writing to their -wal file
+            mtime_ns = max(mtime_ns, os.stat(path + "-wal").st_mtime_ns)
+        except FileNotFoundError:
+            pass
+
+        dst_path = os.path.join(self.dst, relpath)
+        old = self.manifest.entries.get(relpath)
+
+        if (
+            old
+            and (old.size, old.mtime_ns) == (size, mtime_ns)
+            and os.path.lexists(dst_path)
+        ):
+            self.skipped += 1
+            return
+
+        if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+            shutil.rmtree(dst_path)
+
+        if is_sqlite_file(path) and backup_sqlite(path, dst_path):
+            # Preserve modification times, so that the manifest still matches after assets are restored on startup
+            os.utime(dst_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.manifest.update(relpath, ManifestEntry(size, mtime_ns, None))
+            self.copied += 1
+            return
+
+        hash = None
+        if PERSIST_ASSET_CHECKSUMS:
+            hash = file_digest(path)
+            # content is unchanged even though the file was touched, so just update the manifest
+            if (
+                old
+                and (old.size, old.hash) == (size, hash)
+                and os.path.lexists(dst_path)
+            ):
+                self.manifest.update(relpath, ManifestEntry(size, mtime_ns, hash))
+                self.skipped += 1
+                return
+
+        # Copy via a temporary file, so that any snapshot hardlinking the previous file is left unchanged
+        tmp_path = dst_path + ".tmp"
+        shutil.copy2(path, tmp_path)
+        os.replace(tmp_path, dst_path)
+        # Record the stats from before copying, so that any concurrent modification is picked up next time
+        self.manifest.update(relpath, ManifestEntry(size, mtime_ns, hash))
+        self.copied += 1
+
+
+def _delete_extra_files(src: str, dst: str):
+    desired_files = set(os.listdir(src))
+    with os.scandir(dst) as it:
+        dst_entries = list(it)
+
+    for entry in dst_entries:
+        should_delete = entry.name not in desired_files
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if should_delete and is_dir:
+            shutil.rmtree(entry)
+        elif should_delete:
+            os.remove(entry)
+        elif is_dir:
+            _delete_extra_files(os.path.join(src, entry.name), entry.path)
+
+
+# Restores persisted assets from `src` into `dst`, preserving modification times so that they still match the
+# asset manifest. In AUTO mode, files are cloned with reflinks where possible, which shares their data blocks
+# rather than copying them, so even very large assets are restored almost instantly.
+def restore_asset_directory(src: str | os.PathLike, dst: str | os.PathLike):
+    start = time.perf_counter()
+    mode = PERSIST_ASSET_RESTORE
+
+    if mode == AssetRestoreMode.COPY:
+        shutil.copytree(src, dst, dirs_exist_ok=True, copy_function=shutil.copy2)
+    else:
+        restorer = _Restorer(try_reflink=mode == AssetRestoreMode.AUTO)
+        with ThreadPoolExecutor(
+            max_workers=RESTORE_THREADS, thread_name_prefix="asset-restore"
+        ) as executor:
+            futures = []
+            for dir_path, _, file_names in os.walk(src, followlinks=True):
+                dst_dir = os.path.join(dst, os.path.relpath(dir_path, src))
+                os.makedirs(dst_dir, exist_ok=True)
+                for name in file_names:
+                    futures.append(
+                        executor.submit(
+                            restorer.restore_file,
+                            os.path.join(dir_path, name),
+                            os.path.join(dst_dir, name),
+                        )
+                    )
+            reflinked = sum(future.result() for future in futures)
+
+        METRICS.increment("assets.files_reflinked", reflinked)
+
+    METRICS.histogram("assets.restore_duration_ms").record(
+        (time.perf_counter() - start) * 1000
+    )
+
+
+class _Restorer:
+    def __init__(self, try_reflink: bool):
+        # set to False once the filesystem turns out not to support reflinks, to avoid retrying for every file
+        self.try_reflink = try_reflink
+
+    # Returns whether the file was cloned with a reflink
+    def restore_file(self, src: str, dst: str) -> bool:
+        if self.try_reflink and self._reflink(src, dst):
+            shutil.copystat(src, dst)
+            return True
+        shutil.copy2(src, dst)
+        return False
+
+    def _reflink(self, src: str, dst: str) -> bool:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                return True
+            except OSError as e:
+                if e.errno not in REFLINK_UNSUPPORTED_ERRNOS:
+                    raise
+                if self.try_reflink:
+                    LOG.info(
+                        "Filesystem does not support reflinks - copying assets instead"
+                    )
+                    self.try_reflink = False
+                return False
+
+
+# Removes persisted assets at `dst` along with their manifest, e.g. after switching to the archive format
+def remove_asset_directory(dst: str):
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    manifest_path = os.path.join(os.path.dirname(dst), MANIFEST_FILE_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
@@ -0,0 +1,392 @@
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import struct
+import time
+from threading import Lock
+from typing import Any, Optional
+
+from .asset_archive import ARCHIVE_EXT
+from .config import BASE_DIR, PERSIST_SEED_BUNDLE, SerializationFormat
+from .layers import forget_base_layer_hidden, get_base_layer_path, hide_base_layer
+from .metrics import METRICS
+from .s3.segments import (
+    SEGMENTS_DIR_NAME,
+    get_read_only_segment_store,
+    get_segment_store,
+)
+from .snapshots import SKIPPED_DIR_NAMES, remove_in_background
+from .utils import atomic_write
+
+LOG = logging.getLogger(__name__)
+
+# A bundle is a single file containing the persisted data of any number of services: this magic number, followed
+# by the content of every file, followed by a JSON index of the files (and directories) of each service, followed
+# by a footer locating the index. Bundles are read via mmap, so only the files of services that are actually used
+# are ever read.
+BUNDLE_MAGIC = b"LSPBNDL1"
+BUNDLE_VERSION = 1
+# Footer fields: offset of index, length of index, magic number
+BUNDLE_FOOTER = struct.Struct("<QQ8s")
+
+STATE_FILE_NAMES = ("backend", "store")
+
+# Bundles exported/imported via the API can only be in this directory, so that requests can't read or write
+# arbitrary files
+BUNDLES_DIR = os.path.join(BASE_DIR, "_bundles")
+
+valid_bundle_name = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,127}$")
+
+
+class BundleError(Exception):
+    pass
+
+
+def get_bundle_path(name: str) -> str:
+    if not valid_bundle_name.match(name):
+        raise BundleError(f"Invalid bundle name '{name}'")
+    return os.path.join(BUNDLES_DIR, name)
+
+
+# Whether a relative path stays within the directory it's relative to
+def is_contained_path(relpath: str) -> bool:
+    if not isinstance(relpath, str) or not relpath or os.path.isabs(relpath):
+        return False
+    # any absolute directory will do, as the path is only normalised rather than resolved
+    root = os.path.abspath(os.sep + "bundle")
+    path = os.path.normpath(os.path.join(root, relpath))
+    return path != root and os.path.commonpath([root, path]) == root
+
+
+class Bundle:
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, "rb") as file:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise BundleError(f"Unable to open bundle {path}: {e}")
+
+        try:
+            index_offset, index_length, magic = BUNDLE_FOOTER.unpack_from(
+                self._mmap, len(self._mmap) - BUNDLE_FOOTER.size
+            )
+            if magic != BUNDLE_MAGIC or self._mmap[: len(BUNDLE_MAGIC)] != magic:
+                raise BundleError(f"{path} is not a bundle")
+            self.index: dict[str, Any] = json.loads(
+                self._mmap[index_offset : index_offset + index_length]
+            )
+        except BundleError:
+            self.close()
+            raise
+        except (struct.error, ValueError) as e:
+            self.close()
+            raise BundleError(f"Invalid bundle {path}: {e}")
+
+        if self.index.get("version") != BUNDLE_VERSION:
+            self.close()
+            raise BundleError(
+                f"Unsupported version of bundle {path}: {self.index.get('version')}"
+            )
+
+        try:
+            self._validate_index()
+        except BundleError:
+            self.close()
+            raise
+        except (AttributeError, KeyError, TypeError) as e:
+            self.close()
+            raise BundleError(f"Invalid bundle {path}: {e!r}")
+
+    # Services and their files are extracted to paths from the index, so a crafted bundle mustn't be able to
+    # write anywhere outside of a service's directory
+    def _validate_index(self):
+        for service_name, entry in self.index["services"].items():
+            if not valid_bundle_name.match(service_name):
+                raise BundleError(
+                    f"Invalid service name '{service_name}' in bundle {self.path}"
+                )
+            relpaths = entry["dirs"] + [file["path"] for file in entry["files"]]
+            for relpath in relpaths:
+                if not is_contained_path(relpath):
+                    raise BundleError(
+                        f"Invalid path '{relpath}' of service {service_name} in bundle {self.path}"
+                    )
+
+    @property
+    def services(self) -> list[str]:
+        return sorted(self.index["services"])
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "path": self.path,
+            "created_at": self.index["created_at"],
+            "services": self.services,
+            "size": len(self._mmap),
+        }
+
+    # Writes the files of a service to `dst_dir`, preserving their modification times (which are used to detect
+    # changed asset files)
+    def extract_service(self, service_name: str, dst_dir: str) -> int:
+        entry = self.index["services"][service_name]
+        os.makedirs(dst_dir, exist_ok=True)
+        for relpath in entry["dirs"]:
+            os.makedirs(self._dst_path(dst_dir, relpath), exist_ok=True)
+
+        with memoryview(self._mmap) as view:
+            for file in entry["files"]:
+                path = self._dst_path(dst_dir, file["path"])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as dst:
+                    dst.write(view[file["offset"] : file["offset"] + file["size"]])
+                os.utime(path, ns=(file["mtime_ns"], file["mtime_ns"]))
+
+        return len(entry["files"])
+
+    def _dst_path(self, dst_dir: str, relpath: str) -> str:
+        dst_dir = os.path.abspath(dst_dir)
+        path = os.path.normpath(os.path.join(dst_dir, relpath))
+        if path == dst_dir or os.path.commonpath([dst_dir, path]) != dst_dir:
+            raise BundleError(f"Invalid path '{relpath}' in bundle {self.path}")
+        return path
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self) -> "Bundle":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Writes the persisted data of the given services to a bundle at `path`, replacing it atomically
+def write_bundle(path: str, services: list[str]) -> dict[str, Any]:
+    start = time.perf_counter()
+    index: dict[str, Any] = {
+        "version": BUNDLE_VERSION,
+        "created_at": time.time(),
+        "services": {},
+    }
+
+    with atomic_write(path, "wb") as file:
+        file.write(BUNDLE_MAGIC)
+        for service_name in services:
+            dirs, sources = find_service_files(service_name)
+            files = []
+            for relpath, (src, mtime_ns) in sorted(sources.items()):
+                offset = file.tell()
+                if isinstance(src, bytes):
+                    file.write(src)
+                else:
+                    with open(src, "rb") as src_file:
+                        shutil.copyfileobj(src_file, file)
+                files.append(
+                    {
+                        "path": relpath,
+                        "offset": offset,
+                        "size": file.tell() - offset,
+                        "mtime_ns": mtime_ns,
+                    }
+                )
+            index["services"][service_name] = {"dirs": sorted(dirs), "files": files}
+
+        index_offset = file.tell()
+        index_data = json.dumps(index, separators=(",", ":")).encode("utf-8")
+        file.write(index_data)
+        file.write(BUNDLE_FOOTER.pack(index_offset, len(index_data), BUNDLE_MAGIC))
+        size = file.tell()
+
+    duration_ms = (time.perf_counter() - start) * 1000
+    METRICS.histogram("bundles.export_duration_ms").record(duration_ms)
+    LOG.info(
+        "Exported %d services to bundle %s (%d bytes) in %.0f ms",
+        len(services),
+        path,
+        size,
+        duration_ms,
+    )
+    return {
+        "path": path,
+        "created_at": index["created_at"],
+        "services": services,
+        "size": size,
+    }
+
+
+# Returns the directories and files of a service's persisted data, relative to its directory. Files are mapped
+# to their path and modification time, or to the content and modification time of S3 objects in segments.
+# Data in the base layer is included wherever it would still be loaded from there.
+def find_service_files(
+    service_name: str,
+) -> tuple[set[str], dict[str, tuple[str | bytes, int]]]:
+    dirs = set[str]()
+    files = dict[str, tuple[str | bytes, int]]()
+
+    service_dir = os.path.join(BASE_DIR, service_name)
+    layer_dirs = [service_dir]
+    if base_layer_service_dir := get_base_layer_path(service_dir):
+        layer_dirs.append(base_layer_service_dir)
+
+    for layer_dir in layer_dirs:
+        is_base_layer = layer_dir != service_dir
+        for dir_path, dir_names, file_names in os.walk(layer_dir):
+            rel_dir = os.path.relpath(dir_path, layer_dir)
+            rel_dir = "" if rel_dir == os.curdir else rel_dir
+            dir_names[:] = [d for d in dir_names if d not in SKIPPED_DIR_NAMES]
+
+            if is_base_layer and os.path.basename(dir_path) == SEGMENTS_DIR_NAME:
+                files.update(
+                    _find_base_layer_segment_objects(dir_path, service_dir, rel_dir)
+                )
+                continue
+            if (
+                is_base_layer
+                and rel_dir
+                and _is_replaced(service_name, service_dir, rel_dir, is_dir=True)
+            ):
+                dir_names[:] = []
+                continue
+            if rel_dir:
+                dirs.add(rel_dir)
+
+            for name in file_names:
+                relpath = os.path.join(rel_dir, name)
+                # temporary files are only ever partially written
+                if name.endswith(".tmp") or relpath in files:
+                    continue
+                if is_base_layer and _is_replaced(service_name, service_dir, relpath):
+                    continue
+                path = os.path.join(dir_path, name)
+                if os.path.isfile(path):
+                    files[relpath] = (path, os.stat(path).st_mtime_ns)
+
+    return dirs, files
+
+
+# Whether a file in the base layer has been replaced by data in BASE_DIR, in which case it would no longer be loaded
+def _is_replaced(
+    service_name: str, service_dir: str, relpath: str, is_dir=False
+) -> bool:
+    if not is_dir and os.path.lexists(os.path.join(service_dir, relpath)):
+        return True
+
+    parts = relpath.split(os.sep)
+    if len(parts) == 1 and not is_dir:
+        # state files are replaced in every format at once
+        stem = parts[0].split(".", 1)[0]
+        if stem in STATE_FILE_NAMES and any(
+            os.path.exists(os.path.join(service_dir, stem + format.file_ext()))
+            for format in SerializationFormat
+        ):
+            return True
+
+    # asset directories (and their archives) are replaced as a whole - except S3's, which holds its objects
+    for i, part in enumerate(parts):
+        if part.removesuffix(ARCHIVE_EXT) == "assets" and not (
+            service_name == "s3" and i == 0
+        ):
+            asset_dir = os.path.join(service_dir, *parts[:i], "assets")
+            if os.path.exists(asset_dir) or os.path.exists(asset_dir + ARCHIVE_EXT):
+                return True
+
+    return False
+
+
+# Segment files of the base layer are appended to separately in BASE_DIR, so can't be included as they are.
+# Instead, objects that are only in the base layer's segments are included as individual object files.
+def _find_base_layer_segment_objects(
+    segments_dir: str, service_dir: str, rel_segments_dir: str
+) -> dict[str, tuple[str | bytes, int]]:
+    rel_bucket_dir = os.path.dirname(rel_segments_dir)
+    bucket_dir = os.path.join(service_dir, rel_bucket_dir)
+    store = get_read_only_segment_store(os.path.dirname(segments_dir))
+    if store is None:
+        return {}
+    overlay_store = get_segment_store(bucket_dir, create=False)
+
+    objects = dict[str, tuple[str | bytes, int]]()
+    for name, _ in store.entries():
+        if (overlay_store is not None and name in overlay_store) or os.path.exists(
+            os.path.join(bucket_dir, name)
+        ):
+            continue
+        if found := store.read(name):
+            data, mtime_ns = found
+            objects[os.path.join(rel_bucket_dir, name)] = (data, mtime_ns)
+    return objects
+
+
+# Replaces the persisted data of a service with its data from a bundle. The new directory is built alongside the
+# current one and swapped in with a rename, and the old directory is removed in the background. Any data of the
+# service in the base layer is hidden, as otherwise files that aren't in the bundle would still be loaded from there.
+def import_service_dir(bundle: Bundle, service_name: str):
+    start = time.perf_counter()
+    dst = os.path.join(BASE_DIR, service_name)
+    tmp_path = os.path.join(BASE_DIR, f".import-{service_name}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    files = bundle.extract_service(service_name, tmp_path)
+    base_layer_service_dir = get_base_layer_path(dst)
+    if base_layer_service_dir and os.path.exists(base_layer_service_dir):
+        hide_base_layer(tmp_path)
+    if os.path.exists(dst):
+        remove_in_background(dst)
+    os.rename(tmp_path, dst)
+    forget_base_layer_hidden(service_name)
+
+    METRICS.histogram("bundles.import_duration_ms").record(
+        (time.perf_counter() - start) * 1000
+    )
+    LOG.info(
+        "Imported persisted data of service %s (%d files) from bundle %s",
+        service_name,
+        files,
+        bundle.path,
+    )
+
+
+_seed_bundle: Optional[Bundle] = None
+_seed_bundle_lock = Lock()
+_seed_bundle_opened = False
+
+
+def get_seed_bundle() -> Optional[Bundle]:
+    global _seed_bundle, _seed_bundle_opened
+    if not PERSIST_SEED_BUNDLE:
+        return None
+
+    with _seed_bundle_lock:
+        if not _seed_bundle_opened:
+            _seed_bundle_opened = True
+            try:
+                _seed_bundle = Bundle(PERSIST_SEED_BUNDLE)
+            except BundleError:
+                LOG.exception("Unable to seed persisted data from bundle")
+        return _seed_bundle
+
+
+def list_seed_services() -> list[str]:
+    bundle = get_seed_bundle()
+    return bundle.services if bundle else []
+
+
+# Seeds the persisted data of a service from PERSIST_SEED_BUNDLE, if the service doesn't have any persisted data
+# yet (in BASE_DIR or the base layer). Services are only seeded when they're first loaded.
+def seed_service(service_name: str):
+    bundle = get_seed_bundle()
+    if not bundle or service_name not in bundle.index["services"]:
+        return
+
+    service_dir = os.path.join(BASE_DIR, service_name)
+    base_layer_service_dir = get_base_layer_path(service_dir)
+    if os.path.exists(service_dir) or (
+        base_layer_service_dir and os.path.exists(base_layer_service_dir)
+    ):
+        return
+
+    import_service_dir(bundle, service_name)
+    METRICS.increment("bundles.services_seeded")
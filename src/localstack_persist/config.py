@@ -40,55 +40,303 @@ class SerializationFormat(Enum):
         return [cls.JSON]
 
 
+class S3Durability(Enum):
+    # Rely on the OS to eventually write S3 objects to disk
+    NONE = 1
+    # fsync written S3 objects in periodic group commits, before acknowledging the write
+    BATCHED = 2
+    # fsync every written S3 object individually before acknowledging the write
+    ALWAYS = 3
+
+
+class S3GcMode(Enum):
+    OFF = 1
+    # Log S3 asset files that aren't referenced by any S3 state
+    REPORT = 2
+    # Log and remove S3 asset files that aren't referenced by any S3 state
+    REMOVE = 3
+
+
+class AssetRestoreMode(Enum):
+    # Copy asset files one at a time
+    COPY = 1
+    # Copy asset files using multiple threads
+    PARALLEL = 2
+    # Clone asset files using reflinks where the filesystem supports them (e.g. btrfs, XFS), otherwise copy them
+    # using multiple threads
+    AUTO = 3
+
+
+class ProfileOperation(Enum):
+    SAVE = 1
+    LOAD = 2
+
+
+class AssetFormat(Enum):
+    # Persist asset directories as a copy of the directory, only copying files that have changed
+    DIRECTORY = 1
+    # Persist asset directories as a single compressed tar archive
+    ARCHIVE = 2
+
+
 PERSISTED_SERVICES = {"default": True}
 PERSIST_FORMATS = SerializationFormat.default()
+# Whether to choose each service's serialization format automatically, rather than using PERSIST_FORMATS
+PERSIST_FORMAT_AUTO = False
+# Per-service overrides of PERSIST_FORMATS, where `None` means the format is chosen automatically
+PERSIST_SERVICE_FORMATS: dict[str, list[SerializationFormat] | None] = {}
 PERSIST_FREQUENCY = 10
 BASE_DIR = "/persisted-data"
+# Read-only directory of persisted data (e.g. shared between many containers), which is read from wherever BASE_DIR
+# doesn't contain a newer copy of the same data. All changes are still saved to BASE_DIR.
+PERSIST_BASE_LAYER: str | None = None
+# Maximum number of idle read-only S3 object file handles to keep open for reuse.
+# `None` means a limit is derived from the process's RLIMIT_NOFILE.
+PERSIST_S3_MAX_OPEN_FILES: int | None = None
+PERSIST_S3_DURABILITY = S3Durability.NONE
+# Interval, in milliseconds, between group commits when PERSIST_S3_DURABILITY is "batched"
+PERSIST_S3_COMMIT_INTERVAL = 20
+# Maximum number of deleted S3 files to remove from disk per second (0 means unlimited)
+PERSIST_S3_DELETE_RATE = 1000.0
+# S3 objects up to this size (in bytes) are packed into segment files instead of being stored in their own
+# file (0 disables packing of small objects)
+PERSIST_S3_SMALL_OBJECT_THRESHOLD = 0
+PERSIST_S3_GC = S3GcMode.OFF
+# Whether to hash asset files when syncing them, so that files which are modified without changing their
+# content don't need to be copied again
+PERSIST_ASSET_CHECKSUMS = False
+PERSIST_ASSET_RESTORE = AssetRestoreMode.AUTO
+PERSIST_ASSET_FORMAT = AssetFormat.DIRECTORY
+# Per-service glob patterns of asset file paths whose changes shouldn't cause the service to be persisted,
+# overriding the defaults in watcher.py
+PERSIST_WATCH_IGNORE: dict[str, list[str]] = {}
+# Whether to persist SQS messages in per-queue append-only logs, rather than in the SQS store file
+PERSIST_SQS_MESSAGE_LOG = False
+# Maximum number of snapshots to keep, after which the oldest are removed
+PERSIST_SNAPSHOT_GENERATIONS = 5
+# Bundle to seed the persisted data of services from, if they don't have any persisted data yet
+PERSIST_SEED_BUNDLE: str | None = None
+# Operations on services' state to profile with cProfile and tracemalloc
+PERSIST_PROFILE = set[ProfileOperation]()
+# Proportion of operations to profile, between 0 and 1
+PERSIST_PROFILE_SAMPLE_RATE = 1.0
+# Maximum number of profiles to keep for each service and operation, after which the oldest are removed
+PERSIST_PROFILE_RETENTION = 10
+# Waits for and holds of services' locks that take at least this long, in milliseconds, are logged as slow
+PERSIST_LOCK_SLOW_THRESHOLD = 250
+# Seconds to spend persisting changed services when LocalStack stops, which should be less than the time the
+# container is given to stop (e.g. 10 seconds by default with Docker)
+PERSIST_SHUTDOWN_TIMEOUT = 8.0
+
+
+def warn_invalid_value(key: str, value: str):
+    LOG.warning(
+        "Environment variable %s has invalid value '%s' - it will be ignored",
+        key,
+        value,
+    )
+
+
+def parse_formats(key: str, value: str) -> list[SerializationFormat]:
+    formats: list[SerializationFormat] = []
+    for x in value.split(","):
+        x = x.strip()
+        try:
+            format = SerializationFormat[x.upper()]
+            if format not in formats:
+                formats.append(format)
+        except:
+            warn_invalid_value(key, value)
+    return formats
 
 
 def init():
     global PERSISTED_SERVICES
     global PERSIST_FORMATS
+    global PERSIST_FORMAT_AUTO
     global PERSIST_FREQUENCY
     global BASE_DIR
+    global PERSIST_BASE_LAYER
+    global PERSIST_S3_MAX_OPEN_FILES
+    global PERSIST_S3_DURABILITY
+    global PERSIST_S3_COMMIT_INTERVAL
+    global PERSIST_S3_DELETE_RATE
+    global PERSIST_S3_SMALL_OBJECT_THRESHOLD
+    global PERSIST_S3_GC
+    global PERSIST_ASSET_CHECKSUMS
+    global PERSIST_ASSET_RESTORE
+    global PERSIST_ASSET_FORMAT
+    global PERSIST_SNAPSHOT_GENERATIONS
+    global PERSIST_SEED_BUNDLE
+    global PERSIST_PROFILE
+    global PERSIST_PROFILE_SAMPLE_RATE
+    global PERSIST_PROFILE_RETENTION
+    global PERSIST_LOCK_SLOW_THRESHOLD
+    global PERSIST_SHUTDOWN_TIMEOUT
+    global PERSIST_SQS_MESSAGE_LOG
 
     for key, value in os.environ.items():
         if not key.lower().startswith("persist_") or not value.strip():
             continue
 
         if key.lower() == "persist_format":
-            new_formats: list[SerializationFormat] = []
-            for x in value.split(","):
-                x = x.strip()
-                try:
-                    format = SerializationFormat[x.upper()]
-                    if format not in new_formats:
-                        new_formats.append(format)
-                except:
-                    LOG.warning(
-                        "Environment variable %s has invalid value '%s' - it will be ignored",
-                        key,
-                        value,
-                    )
-            if new_formats:
+            if value.strip().lower() == "auto":
+                PERSIST_FORMAT_AUTO = True
+            elif new_formats := parse_formats(key, value):
                 PERSIST_FORMATS = new_formats
             continue
 
+        if key.lower().startswith("persist_format_"):
+            service_name = normalise_service_name(key[len("persist_format_") :])
+            if value.strip().lower() == "auto":
+                PERSIST_SERVICE_FORMATS[service_name] = None
+            elif new_formats := parse_formats(key, value):
+                PERSIST_SERVICE_FORMATS[service_name] = new_formats
+            continue
+
         if key.lower() == "persist_frequency":
             try:
                 PERSIST_FREQUENCY = float(value.strip())
             except:
-                LOG.warning(
-                    "Environment variable %s has invalid value '%s' - it will be ignored",
-                    key,
-                    value,
-                )
+                warn_invalid_value(key, value)
             continue
 
         if key.lower() == "persist_base_dir":
             BASE_DIR = value.strip()
             continue
 
+        if key.lower() == "persist_base_layer":
+            PERSIST_BASE_LAYER = value.strip()
+            continue
+
+        if key.lower() == "persist_s3_max_open_files":
+            try:
+                PERSIST_S3_MAX_OPEN_FILES = max(0, int(value.strip()))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_s3_durability":
+            try:
+                PERSIST_S3_DURABILITY = S3Durability[value.strip().upper()]
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_s3_commit_interval":
+            try:
+                PERSIST_S3_COMMIT_INTERVAL = max(1, int(value.strip()))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_s3_delete_rate":
+            try:
+                PERSIST_S3_DELETE_RATE = max(0.0, float(value.strip()))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_s3_small_object_threshold":
+            try:
+                PERSIST_S3_SMALL_OBJECT_THRESHOLD = max(0, int(value.strip()))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_s3_gc":
+            try:
+                PERSIST_S3_GC = S3GcMode[value.strip().upper()]
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_asset_checksums":
+            if value == "1" or value.lower() == "true":
+                PERSIST_ASSET_CHECKSUMS = True
+            elif value == "0" or value.lower() == "false":
+                PERSIST_ASSET_CHECKSUMS = False
+            else:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_asset_restore":
+            try:
+                PERSIST_ASSET_RESTORE = AssetRestoreMode[value.strip().upper()]
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_asset_format":
+            try:
+                PERSIST_ASSET_FORMAT = AssetFormat[value.strip().upper()]
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_sqs_message_log":
+            if value == "1" or value.lower() == "true":
+                PERSIST_SQS_MESSAGE_LOG = True
+            elif value == "0" or value.lower() == "false":
+                PERSIST_SQS_MESSAGE_LOG = False
+            else:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_snapshot_generations":
+            try:
+                PERSIST_SNAPSHOT_GENERATIONS = max(1, int(value.strip()))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_profile":
+            for x in value.split(","):
+                try:
+                    PERSIST_PROFILE.add(ProfileOperation[x.strip().upper()])
+                except:
+                    warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_profile_sample_rate":
+            try:
+                PERSIST_PROFILE_SAMPLE_RATE = min(1.0, max(0.0, float(value.strip())))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_profile_retention":
+            try:
+                PERSIST_PROFILE_RETENTION = max(1, int(value.strip()))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_lock_slow_threshold":
+            try:
+                PERSIST_LOCK_SLOW_THRESHOLD = max(0, int(value.strip()))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_shutdown_timeout":
+            try:
+                PERSIST_SHUTDOWN_TIMEOUT = max(0.0, float(value.strip()))
+            except:
+                warn_invalid_value(key, value)
+            continue
+
+        if key.lower() == "persist_seed_bundle":
+            PERSIST_SEED_BUNDLE = value.strip() or None
+            continue
+
+        if key.lower().startswith("persist_watch_ignore_"):
+            service_name = normalise_service_name(key[len("persist_watch_ignore_") :])
+            PERSIST_WATCH_IGNORE[service_name] = [
+                pattern.strip() for pattern in value.split(",") if pattern.strip()
+            ]
+            continue
+
         # assume that `key` is the name of service
         service_name = normalise_service_name(key[len("persist_") :])
 
@@ -99,11 +347,15 @@ def init():
         elif value == "0" or value.lower() == "false":
             PERSISTED_SERVICES[service_name] = False
         else:
-            LOG.warning(
-                "Environment variable %s has invalid value '%s' - it will be ignored",
-                key,
-                value,
-            )
+            warn_invalid_value(key, value)
+
+
+# Returns the formats to persist a service's state in, or `None` if they should be chosen automatically
+def get_persist_formats(service_name: str) -> list[SerializationFormat] | None:
+    service_name = normalise_service_name(service_name)
+    if service_name in PERSIST_SERVICE_FORMATS:
+        return PERSIST_SERVICE_FORMATS[service_name]
+    return None if PERSIST_FORMAT_AUTO else PERSIST_FORMATS
 
 
 def is_persistence_enabled(service_name: str):
@@ -0,0 +1,102 @@
+import os
+
+from localstack.http import Request, Response, route
+from localstack.services.internal import get_internal_apis
+
+from .bundle import BUNDLES_DIR, BundleError, get_bundle_path
+from .lock_tracing import LOCK_TRACER
+from .metrics import METRICS
+from .snapshots import (
+    SnapshotError,
+    SnapshotNotFoundError,
+    delete_snapshot,
+    list_snapshots,
+)
+from .state import STATE_TRACKER
+from .utils import once
+
+PATH_PREFIX = "/_localstack/persist"
+
+
+def error_response(message: str, status: int) -> Response:
+    response = Response(status=status)
+    response.set_json({"error": message})
+    return response
+
+
+def snapshot_error_response(e: SnapshotError) -> Response:
+    status = 404 if isinstance(e, SnapshotNotFoundError) else 400
+    return error_response(str(e), status)
+
+
+def bad_request_response(message: str) -> Response:
+    return error_response(message, 400)
+
+
+class PersistApi:
+    @route(PATH_PREFIX + "/metrics", methods=["GET"])
+    def get_metrics(self, request: Request):
+        return METRICS.snapshot()
+
+    @route(PATH_PREFIX + "/locks", methods=["GET"])
+    def get_locks(self, request: Request):
+        return {"slow_events": LOCK_TRACER.slow_events()}
+
+    @route(PATH_PREFIX + "/snapshots", methods=["GET"])
+    def get_snapshots(self, request: Request):
+        return {"snapshots": list_snapshots()}
+
+    @route(PATH_PREFIX + "/snapshots", methods=["POST"])
+    def post_snapshot(self, request: Request):
+        # parse the body regardless of content type, e.g. for `curl -d`
+        body = request.get_json(force=True, silent=True) or {}
+        try:
+            return STATE_TRACKER.create_snapshot(body.get("name"))
+        except SnapshotError as e:
+            return snapshot_error_response(e)
+
+    @route(PATH_PREFIX + "/snapshots/<name>", methods=["DELETE"])
+    def delete_snapshot(self, request: Request, name: str):
+        try:
+            delete_snapshot(name)
+        except SnapshotError as e:
+            return snapshot_error_response(e)
+        return {}
+
+    @route(PATH_PREFIX + "/snapshots/<name>/rollback", methods=["POST"])
+    def post_rollback(self, request: Request, name: str):
+        try:
+            STATE_TRACKER.rollback_to_snapshot(name)
+        except SnapshotError as e:
+            return snapshot_error_response(e)
+        return {}
+
+    @route(PATH_PREFIX + "/bundle/export", methods=["POST"])
+    def post_bundle_export(self, request: Request):
+        body = request.get_json(force=True, silent=True) or {}
+        if not body.get("name"):
+            return bad_request_response("Missing bundle name")
+        try:
+            path = get_bundle_path(body["name"])
+            os.makedirs(BUNDLES_DIR, exist_ok=True)
+            return STATE_TRACKER.export_bundle(path)
+        except BundleError as e:
+            return bad_request_response(str(e))
+        except OSError as e:
+            return bad_request_response(f"Unable to write bundle: {e}")
+
+    @route(PATH_PREFIX + "/bundle/import", methods=["POST"])
+    def post_bundle_import(self, request: Request):
+        body = request.get_json(force=True, silent=True) or {}
+        if not body.get("name"):
+            return bad_request_response("Missing bundle name")
+        try:
+            return STATE_TRACKER.import_bundle(get_bundle_path(body["name"]))
+        except BundleError as e:
+            return bad_request_response(str(e))
+
+
+# Paths under /_localstack are only served by LocalStack's internal resources, never by the edge router
+@once
+def register_endpoints():
+    get_internal_apis().add(PersistApi())
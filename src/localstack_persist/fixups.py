@@ -0,0 +1,113 @@
+import logging
+from typing import Any, Callable, NamedTuple, Optional
+
+from localstack.services.stores import AccountRegionBundle
+from localstack.services.opensearch.models import OpenSearchStore
+from localstack.services.lambda_.invocation.models import LambdaStore
+from localstack.services.sqs.models import SqsStore
+
+from .manifest import ServiceManifest
+from .metrics import METRICS
+from .serialization import is_manifest_state_file
+from .sqs.message_log import load_message_logs
+
+LOG = logging.getLogger(__name__)
+
+
+class Fixup(NamedTuple):
+    name: str
+    store_type: type
+    # Versioned fixups only need to run until the state has been re-saved by this version of localstack-persist,
+    # which is recorded in the service's manifest. Increment the version to make an updated fixup run again.
+    # Fixups with no version run on every load, e.g. because they restore data that's never persisted.
+    version: Optional[int]
+    apply: Callable[[Any], None]
+
+
+FIXUPS: list[Fixup] = []
+
+
+def fixup(name: str, store_type: type, version: Optional[int] = None):
+    def register(apply: Callable[[Any], None]):
+        FIXUPS.append(Fixup(name, store_type, version, apply))
+        return apply
+
+    return register
+
+
+def get_fixups(store_type: type) -> list[Fixup]:
+    return [f for f in FIXUPS if f.store_type is store_type]
+
+
+# Applies any fixups to state freshly loaded from `file_path` that it still needs, returning True if any versioned
+# fixups were applied, in which case the state should be re-saved
+def apply_fixups(
+    manifest: ServiceManifest, state: AccountRegionBundle, file_path: str
+) -> bool:
+    # the recorded fixup versions only apply to the state file that was saved along with the manifest, rather than
+    # e.g. one that was replaced without updating it
+    manifest_valid = is_manifest_state_file(state.service_name, file_path)
+    applied = False
+    for f in get_fixups(state.store):
+        if (
+            f.version is not None
+            and manifest_valid
+            and manifest.get_fixup_version(f.name) >= f.version
+        ):
+            METRICS.increment("fixups.skipped")
+            continue
+
+        LOG.debug("Applying fixup %s", f.name)
+        for region_bundle in state.values():
+            for store in region_bundle.values():
+                f.apply(store)
+        METRICS.increment("fixups.applied")
+        applied = applied or f.version is not None
+
+    return applied
+
+
+# Records that state being saved has had all current versioned fixups applied
+def record_fixups(manifest: ServiceManifest, state: AccountRegionBundle):
+    manifest.set_fixup_versions(
+        {f.name: f.version for f in get_fixups(state.store) if f.version is not None}
+    )
+
+
+# Set Processing because after loading state, it will take some time for opensearch/elasticsearch to start.
+@fixup("opensearch-domain-processing", OpenSearchStore)
+def set_opensearch_domains_processing(store: OpenSearchStore):
+    for domain in store.opensearch_domains.values():
+        domain["Processing"] = True
+
+
+# Workarounds for restoring state of old lambda functions
+@fixup("lambda-function-defaults", LambdaStore, version=1)
+def fix_lambda_functions(store: LambdaStore):
+    for function in store.functions.values():
+        # 1. Call `__post_init__()` to populate `instance_id` field. This is done by `__setstate__`, but that's
+        #    only called if the `Function` had a `__getstate__` when serialized, which was not always the case.
+        if hasattr(function, "__post_init__"):
+            function.__post_init__()  # type: ignore
+        # 2. Populate the required `logging_config` field with a default value in case the field wasn't present
+        #    when the `Function` was serialized.
+        for function_version in function.versions.values():
+            if not hasattr(function_version.config, "logging_config"):
+                object.__setattr__(function_version.config, "logging_config", {})
+
+
+# Computed attributes weren't serialized to JSON and were unreliably serialized by dill by older versions, so
+# restore them from `default_attributes()`
+@fixup("sqs-computed-attributes", SqsStore, version=1)
+def restore_sqs_computed_attributes(store: SqsStore):
+    for queue in store.queues.values():
+        for k, v in queue.default_attributes().items():
+            if k not in queue.attributes or callable(queue.attributes[k]):
+                queue.attributes[k] = v
+
+
+# Messages are persisted separately from the SQS store when PERSIST_SQS_MESSAGE_LOG is enabled, so restore them
+# from any message logs (even if it's since been disabled, in which case they're saved in the store next time)
+@fixup("sqs-message-log", SqsStore)
+def restore_sqs_messages(store: SqsStore):
+    load_message_logs(store)
@@ -4,22 +4,38 @@ from localstack.runtime import hooks
 from localstack.utils.tagging import TaggingService
 from moto.core.common_models import CloudFormationModel
 
+from .config import is_persistence_enabled
+from .endpoints import register_endpoints
 from .state import STATE_TRACKER
 
 LOG = logging.getLogger(__name__)
 
 
-@hooks.on_infra_start(priority=1)
-def on_infra_start():
+def apply_compat_patches():
     # HACK for "global" models that were persisted without a `partition` field
     setattr(CloudFormationModel, "partition", "aws")
     # HACK for TaggingServices that were persisted without the `key_field`/`value_field` properties
     setattr(TaggingService, "key_field", "Key")
     setattr(TaggingService, "value_field", "Value")
 
+
+@hooks.on_infra_start(priority=1)
+def on_infra_start():
+    apply_compat_patches()
+    register_endpoints()
     STATE_TRACKER.load_all_services_state()
     STATE_TRACKER.start()
 
+    # Only look for orphaned S3 files once S3 state has been successfully loaded
+    if (
+        is_persistence_enabled("s3")
+        and "s3" in STATE_TRACKER.loaded_services
+        and "s3" not in STATE_TRACKER.failed_services
+    ):
+        from .s3.gc import start_orphan_scanner
+
+        start_orphan_scanner()
+
 
 @hooks.on_infra_shutdown()
 def on_infra_shutdown():
@@ -0,0 +1,76 @@
+import logging
+import os
+from typing import Iterable, Optional
+
+from .config import BASE_DIR, PERSIST_BASE_LAYER
+
+LOG = logging.getLogger(__name__)
+
+# A file with this name in a service's directory in BASE_DIR hides all of the service's data in the base layer, e.g.
+# once the service's data has been replaced by importing a bundle
+BASE_LAYER_HIDDEN_FILE_NAME = ".base-layer-hidden"
+
+# Whether each service's base layer data is hidden, to avoid checking on every read
+_hidden_services = dict[str, bool]()
+
+
+# Returns the equivalent of `path` (which must be within BASE_DIR) in the read-only base layer, or None if there's
+# no base layer (or the base layer data of the service it belongs to is hidden)
+def get_base_layer_path(path: str) -> Optional[str]:
+    if not PERSIST_BASE_LAYER:
+        return None
+    relpath = os.path.relpath(path, BASE_DIR)
+    if relpath.startswith(os.pardir) or is_base_layer_hidden(
+        relpath.split(os.sep, 1)[0]
+    ):
+        return None
+    return os.path.normpath(os.path.join(PERSIST_BASE_LAYER, relpath))
+
+
+def is_base_layer_hidden(service_name: str) -> bool:
+    hidden = _hidden_services.get(service_name)
+    if hidden is None:
+        hidden = _hidden_services[service_name] = os.path.exists(
+            os.path.join(BASE_DIR, service_name, BASE_LAYER_HIDDEN_FILE_NAME)
+        )
+    return hidden
+
+
+# Hides the base layer data of the service whose directory is (or will be renamed to) `service_dir`
+def hide_base_layer(service_dir: str):
+    with open(os.path.join(service_dir, BASE_LAYER_HIDDEN_FILE_NAME), "w"):
+        pass
+
+
+# Must be called whenever a service's directory in BASE_DIR is replaced
+def forget_base_layer_hidden(service_name: str):
+    _hidden_services.pop(service_name, None)
+
+
+# Returns where to read the persisted data at `path` from - `path` itself if it exists (with any of the given
+# suffixes, e.g. file extensions), otherwise its equivalent in the base layer if it exists there
+def get_read_path(path: str, suffixes: Iterable[str] = ("",)) -> str:
+    if not PERSIST_BASE_LAYER or any(os.path.exists(path + s) for s in suffixes):
+        return path
+    base_layer_path = get_base_layer_path(path)
+    if base_layer_path and any(os.path.exists(base_layer_path + s) for s in suffixes):
+        return base_layer_path
+    return path
+
+
+# Returns the names of all services with persisted data in BASE_DIR or the base layer. Directories starting with
+# "_" or "." hold internal data (e.g. snapshots) rather than a service's state.
+def list_persisted_services() -> list[str]:
+    services = set[str]()
+    for dir in (BASE_DIR, PERSIST_BASE_LAYER):
+        if not dir or not os.path.isdir(dir):
+            continue
+        with os.scandir(dir) as it:
+            for entry in it:
+                if entry.name.startswith(("_", ".")):
+                    continue
+                if not entry.is_dir():
+                    LOG.warning("Expected %s to be a directory", entry.path)
+                    continue
+                services.add(entry.name)
+    return sorted(services)
@@ -0,0 +1,158 @@
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Iterator, Optional
+
+from readerwriterlock.rwlock import RWLockWrite
+
+from .config import PERSIST_LOCK_SLOW_THRESHOLD
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# Number of most recent slow events kept
+SLOW_EVENTS_WINDOW = 256
+
+
+# A read lock held by a request, from when it was acquired until it was released (by the request finishing, or
+# forcibly if the request took too long)
+class ReadLockHold:
+    def __init__(self, service_name: str, operation: str, acquired_at: float):
+        self.service_name = service_name
+        self.operation = operation
+        self.acquired_at = acquired_at
+        self.released = False
+
+
+# Traces how long requests wait for and hold services' read locks, and how long saves (and other operations on
+# persisted data) wait for and hold services' write locks. Durations are recorded in histograms, and waits/holds
+# of at least PERSIST_LOCK_SLOW_THRESHOLD ms are kept in a log of slow events, along with the requests that were
+# holding read locks when a write lock was waited for - i.e. the requests that stalled persistence.
+class LockTracer:
+    def __init__(self, slow_threshold_ms: float = PERSIST_LOCK_SLOW_THRESHOLD):
+        self.slow_threshold_ms = slow_threshold_ms
+        self._holds = dict[str, set[ReadLockHold]]()
+        self._slow_events = deque[dict[str, Any]](maxlen=SLOW_EVENTS_WINDOW)
+        self._lock = Lock()
+
+    def read_acquired(
+        self, service_name: str, operation: str, wait_start: float
+    ) -> ReadLockHold:
+        now = time.perf_counter()
+        hold = ReadLockHold(service_name, operation, now)
+        with self._lock:
+            self._holds.setdefault(service_name, set()).add(hold)
+
+        wait_ms = (now - wait_start) * 1000
+        METRICS.histogram(f"locks.{service_name}.read_wait_ms").record(wait_ms)
+        if wait_ms >= self.slow_threshold_ms:
+            self._slow_event("read_wait", service_name, wait_ms, operation=operation)
+        return hold
+
+    # Returns whether the lock was still held, as it's released by whichever of the request finishing or the
+    # forced release happens first
+    def read_released(self, hold: ReadLockHold, forced=False) -> bool:
+        with self._lock:
+            if hold.released:
+                return False
+            hold.released = True
+            self._holds.get(hold.service_name, set()).discard(hold)
+
+        hold_ms = (time.perf_counter() - hold.acquired_at) * 1000
+        prefix = f"locks.{hold.service_name}.{hold.operation}"
+        METRICS.histogram(f"{prefix}.read_hold_ms").record(hold_ms)
+        if forced:
+            METRICS.increment(f"{prefix}.forced_releases")
+            self._slow_event(
+                "forced_release",
+                hold.service_name,
+                hold_ms,
+                operation=hold.operation,
+            )
+        elif hold_ms >= self.slow_threshold_ms:
+            self._slow_event(
+                "read_hold", hold.service_name, hold_ms, operation=hold.operation
+            )
+        return True
+
+    # Acquires a service's write lock for the duration of the context, e.g. while saving the service's state
+    @contextmanager
+    def write_lock(
+        self, service_name: str, rwlock: RWLockWrite, reason: str
+    ) -> Iterator[None]:
+        blockers = self.read_lock_holders(service_name)
+        start = time.perf_counter()
+        with rwlock.gen_wlock():
+            acquired_at = time.perf_counter()
+            wait_ms = (acquired_at - start) * 1000
+            METRICS.histogram(f"locks.{service_name}.write_wait_ms").record(wait_ms)
+            if wait_ms >= self.slow_threshold_ms:
+                self._slow_event(
+                    "write_wait",
+                    service_name,
+                    wait_ms,
+                    reason=reason,
+                    blocked_by=blockers,
+                )
+
+            try:
+                yield
+            finally:
+                hold_ms = (time.perf_counter() - acquired_at) * 1000
+                METRICS.histogram(f"locks.{service_name}.write_hold_ms").record(hold_ms)
+                if hold_ms >= self.slow_threshold_ms:
+                    self._slow_event("write_hold", service_name, hold_ms, reason=reason)
+
+    # Returns the operations of requests currently holding a service's read lock, and how long they've held it
+    def read_lock_holders(self, service_name: str) -> list[dict[str, Any]]:
+        now = time.perf_counter()
+        with self._lock:
+            holds = list(self._holds.get(service_name, ()))
+        return [
+            {
+                "operation": hold.operation,
+                "held_ms": round((now - hold.acquired_at) * 1000, 3),
+            }
+            for hold in sorted(holds, key=lambda h: h.acquired_at)
+        ]
+
+    def slow_events(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return list(self._slow_events)
+
+    def _slow_event(
+        self,
+        kind: str,
+        service_name: str,
+        duration_ms: float,
+        operation: Optional[str] = None,
+        reason: Optional[str] = None,
+        blocked_by: Optional[list[dict[str, Any]]] = None,
+    ):
+        event: dict[str, Any] = {
+            "time": time.time(),
+            "kind": kind,
+            "service": service_name,
+            "duration_ms": round(duration_ms, 3),
+        }
+        if operation:
+            event["operation"] = operation
+        if reason:
+            event["reason"] = reason
+        if blocked_by:
+            event["blocked_by"] = blocked_by
+
+        with self._lock:
+            self._slow_events.append(event)
+        LOG.info(
+            "Slow lock event %s for service %s (%s): %.0f ms",
+            kind,
+            service_name,
+            operation or reason,
+            duration_ms,
+        )
+
+
+LOCK_TRACER = LockTracer()
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+from threading import Lock
+from typing import Any, Optional
+
+from .config import BASE_DIR
+from .layers import get_read_path
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+# Metadata about a service's persisted state, stored alongside it in BASE_DIR/<service>/manifest.json
+class ServiceManifest:
+    def __init__(self, service_name: str):
+        self.path = os.path.join(BASE_DIR, service_name, MANIFEST_FILE_NAME)
+        self._data = dict[str, Any]()
+        self._dirty = False
+
+        try:
+            # until the service's state is first saved, its manifest is read from the base layer (if any)
+            with open(get_read_path(self.path)) as file:
+                self._data = json.load(file)
+        except FileNotFoundError:
+            pass
+        except:
+            LOG.warning("Ignoring invalid manifest at %s", self.path)
+
+    def get_fixup_version(self, name: str) -> int:
+        return self._data.get("fixups", {}).get(name, 0)
+
+    def set_fixup_versions(self, versions: dict[str, int]):
+        fixups = self._data.setdefault("fixups", {})
+        for name, version in versions.items():
+            if fixups.get(name) != version:
+                fixups[name] = version
+                self._dirty = True
+
+    # Returns details of the files most recently saved for the state file with the given base name (e.g. "store")
+    def get_state_file(self, name: str) -> Optional[dict[str, Any]]:
+        return self._data.get("state_files", {}).get(name)
+
+    def set_state_file(self, name: str, entry: dict[str, Any]):
+        self._data.setdefault("state_files", {})[name] = entry
+        self._dirty = True
+
+    # Returns the serialization format most recently chosen automatically for the given state file, along with
+    # the measurements it was chosen from
+    def get_format_choice(self, name: str) -> Optional[dict[str, Any]]:
+        return self._data.get("format_choices", {}).get(name)
+
+    def set_format_choice(self, name: str, choice: dict[str, Any]):
+        self._data.setdefault("format_choices", {})[name] = choice
+        self._dirty = True
+
+    # Returns how long it took to save all of the service's state files the last time they were saved
+    def get_save_duration_ms(self) -> Optional[float]:
+        entries = self._data.get("state_files", {}).values()
+        durations = [e["save_duration_ms"] for e in entries if "save_duration_ms" in e]
+        return sum(durations) if durations else None
+
+    def save(self):
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self._data, file, indent=2)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+_manifests = dict[str, ServiceManifest]()
+_manifests_lock = Lock()
+
+
+def get_service_manifest(service_name: str) -> ServiceManifest:
+    with _manifests_lock:
+        if service_name not in _manifests:
+            _manifests[service_name] = ServiceManifest(service_name)
+        return _manifests[service_name]
+
+
+# Discards the cached manifest of a service, e.g. after its persisted state is replaced by a snapshot
+def forget_service_manifest(service_name: str):
+    with _manifests_lock:
+        _manifests.pop(service_name, None)
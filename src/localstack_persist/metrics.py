@@ -0,0 +1,78 @@
+from collections import deque
+from threading import Lock
+from typing import Any
+
+# Number of most recent samples kept by each histogram
+HISTOGRAM_WINDOW = 1024
+
+
+class Histogram:
+    def __init__(self, window: int = HISTOGRAM_WINDOW):
+        self._samples = deque[float](maxlen=window)
+        self._count = 0
+        self._total = 0.0
+        self._lock = Lock()
+
+    def record(self, value: float):
+        with self._lock:
+            self._samples.append(value)
+            self._count += 1
+            self._total += value
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self._count
+            total = self._total
+
+        if not samples:
+            return {"count": count, "sum": total}
+
+        def percentile(p: float):
+            return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+        return {
+            "count": count,
+            "sum": total,
+            "min": samples[0],
+            "max": samples[-1],
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._counters = dict[str, int]()
+        self._gauges = dict[str, float]()
+        self._histograms = dict[str, Histogram]()
+        self._lock = Lock()
+
+    def increment(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float):
+        self._gauges[name] = value
+
+    def histogram(self, name: str) -> Histogram:
+        if histogram := self._histograms.get(name):
+            return histogram
+
+        with self._lock:
+            return self._histograms.setdefault(name, Histogram())
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+
+        return {
+            "counters": counters,
+            "gauges": dict(self._gauges),
+            "histograms": {k: v.snapshot() for k, v in histograms.items()},
+        }
+
+
+METRICS = Metrics()
@@ -1,10 +1,13 @@
 import os
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 from localstack.services.plugins import SERVICE_PLUGINS
 
 from .config import BASE_DIR
 from .utils import once
 
+if TYPE_CHECKING:
+    from .s3.storage import PersistedS3ObjectStore
+
 
 def prepare_service(service_name: str):
     if service_name == "s3":
@@ -15,21 +18,48 @@ def prepare_service(service_name: str):
         prepare_iam()
 
 
+# Prepares persisted data to be loaded outside of a running LocalStack (i.e. by the command-line tool), without
+# modifying the service or starting any background threads
+def prepare_service_data(service_name: str):
+    if service_name == "s3":
+        from .s3.storage import PersistedS3ObjectStore
+
+        store = PersistedS3ObjectStore()
+        try:
+            prepare_s3_data(store)
+        finally:
+            store.close()
+    else:
+        prepare_service(service_name)
+
+
 @once
 def prepare_s3():
     from .s3.storage import PersistedS3ObjectStore
-    from localstack.services.s3.models import S3Object
+    from .s3.trash import TRASH_REAPER
 
     service = SERVICE_PLUGINS.get_service("s3")
     store = PersistedS3ObjectStore()
     service._provider._storage_backend = store  # type: ignore
+    # resume removing any files that were deleted before a restart
+    TRASH_REAPER.start()
+    prepare_s3_data(store)
+
+
+def prepare_s3_data(store: "PersistedS3ObjectStore"):
+    from localstack.services.s3.models import S3Object
 
     # localstack-persist 3.0.0 persisted S3 objects in a JSON file - migrate that file to new format if necessary
     old_objects_path = os.path.join(BASE_DIR, "s3", "objects.json")
-    if not os.path.exists(store.root_directory) and os.path.isfile(old_objects_path):
-        from .s3.migrate_ephemeral_object_store import migrate_ephemeral_object_store
+    if os.path.isfile(old_objects_path):
+        from .s3.migrate_ephemeral_object_store import (
+            CHECKPOINT_PATH,
+            migrate_ephemeral_object_store,
+        )
 
-        migrate_ephemeral_object_store(old_objects_path, store)
+        # a checkpoint means a previous migration was interrupted, so needs to be resumed
+        if not os.path.exists(store.root_directory) or os.path.exists(CHECKPOINT_PATH):
+            migrate_ephemeral_object_store(old_objects_path, store)
 
     # HACK for S3Objects that were persisted without the `internal_last_modified`/`sse_key_hash`/`precondition` properties
     setattr(S3Object, "internal_last_modified", None)
@@ -37,6 +67,16 @@ def prepare_s3():
     setattr(S3Object, "precondition", None)
 
 
+# Closes file handles held by the S3 object store, e.g. before its files are replaced by a snapshot
+def release_s3_files():
+    from .s3.storage import PersistedS3ObjectStore
+
+    service = SERVICE_PLUGINS.get_service("s3")
+    store = getattr(getattr(service, "_provider", None), "_storage_backend", None)
+    if isinstance(store, PersistedS3ObjectStore):
+        store.release_files()
+
+
 @once
 def prepare_acm():
     from moto.acm.models import CertBundle
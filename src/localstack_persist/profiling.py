@@ -0,0 +1,134 @@
+import cProfile
+import logging
+import os
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+from threading import Lock
+
+from .config import (
+    BASE_DIR,
+    PERSIST_PROFILE,
+    PERSIST_PROFILE_RETENTION,
+    PERSIST_PROFILE_SAMPLE_RATE,
+    ProfileOperation,
+)
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+PROFILES_DIR = os.path.join(BASE_DIR, "_profiles")
+# Number of allocation sites to list in each allocations report
+TOP_ALLOCATIONS = 25
+
+# Only one profiler can be active at a time, so operations that run while another is being profiled aren't profiled
+_profiling_lock = Lock()
+
+
+# Profiles saving/loading a service's state, if enabled by PERSIST_PROFILE. Writes a cProfile `.prof` file (which can
+# be viewed with e.g. snakeviz or `python -m pstats`) and a report of the top allocation sites from tracemalloc.
+@contextmanager
+def profile(operation: ProfileOperation, service_name: str):
+    if (
+        operation not in PERSIST_PROFILE
+        or random.random() >= PERSIST_PROFILE_SAMPLE_RATE
+        or not _profiling_lock.acquire(blocking=False)
+    ):
+        yield
+        return
+
+    try:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler (outside of localstack-persist) is already active
+            LOG.debug("Unable to profile service %s", service_name, exc_info=True)
+            yield
+            return
+
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration_ms = (time.perf_counter() - start) * 1000
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracemalloc:
+                tracemalloc.stop()
+
+            try:
+                write_profile(
+                    operation, service_name, profiler, snapshot, duration_ms, peak
+                )
+            except:
+                LOG.exception(
+                    "Error writing %s profile of service %s",
+                    operation.name.lower(),
+                    service_name,
+                )
+    finally:
+        _profiling_lock.release()
+
+
+def write_profile(
+    operation: ProfileOperation,
+    service_name: str,
+    profiler: cProfile.Profile,
+    snapshot: tracemalloc.Snapshot,
+    duration_ms: float,
+    peak: int,
+):
+    prefix = f"{service_name}-{operation.name.lower()}-"
+    now = time.time()
+    name = prefix + time.strftime("%Y%m%dT%H%M%S", time.gmtime(now))
+    name += f".{int(now * 1000) % 1000:03d}"
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+
+    profiler.dump_stats(os.path.join(PROFILES_DIR, name + ".prof"))
+
+    snapshot = snapshot.filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+    )
+    with open(os.path.join(PROFILES_DIR, name + ".allocations.txt"), "w") as file:
+        file.write(
+            f"{operation.name.lower()} of service {service_name} took {duration_ms:.0f} ms, "
+            f"peak traced memory {peak} bytes\n\n"
+        )
+        file.write(f"Top {TOP_ALLOCATIONS} allocation sites still allocated:\n")
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            file.write(f"{stat}\n")
+
+    METRICS.increment("profiles.written")
+    LOG.info(
+        "Wrote %s profile of service %s to %s",
+        operation.name.lower(),
+        service_name,
+        name,
+    )
+    prune_profiles(prefix, PERSIST_PROFILE_RETENTION)
+
+
+# Removes the oldest profiles with the given prefix (i.e. service and operation) so that at most `retention` remain
+def prune_profiles(prefix: str, retention: int):
+    names = sorted(
+        name.removesuffix(".prof")
+        for name in os.listdir(PROFILES_DIR)
+        if name.startswith(prefix) and name.endswith(".prof")
+    )
+    for name in names[: max(0, len(names) - retention)]:
+        for ext in (".prof", ".allocations.txt"):
+            try:
+                os.remove(os.path.join(PROFILES_DIR, name + ext))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,114 @@
+import logging
+import os
+import time
+from threading import Condition, Thread
+
+from ..metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+
+def fsync_path(path: str, is_dir: bool = False):
+    fd = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if is_dir else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Coalesces fsyncs of recently-written files (and their parent directories) into periodic group commits.
+# `commit()` blocks the caller until a group commit containing its file has completed, so many concurrent
+# writes can share the cost of a single round of fsyncs.
+class GroupCommitter:
+    def __init__(self, interval_ms: int):
+        self.interval = interval_ms / 1000
+        self._pending = set[str]()
+        self._cond = Condition()
+        # number of the batch that newly-submitted paths will be committed in
+        self._batch = 1
+        self._committed_batch = 0
+        self._running = False
+        self._thread: Thread | None = None
+
+    def commit(self, path: str):
+        with self._cond:
+            if not self._thread:
+                self._running = True
+                self._thread = Thread(
+                    target=self._run, name="s3-group-commit", daemon=True
+                )
+                self._thread.start()
+
+            if self._running:
+                self._pending.add(path)
+                batch = self._batch
+                self._cond.notify_all()
+                while self._committed_batch < batch:
+                    self._cond.wait()
+                return
+
+        # committer has been stopped - fall back to committing synchronously
+        self._commit_paths([path])
+
+    def stop(self):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._running and not self._pending:
+                    return
+
+            if self._running:
+                # give concurrent writers a chance to join this batch
+                time.sleep(self.interval)
+
+            self._commit_batch()
+
+    def _commit_batch(self):
+        with self._cond:
+            paths = self._pending
+            self._pending = set()
+            batch = self._batch
+            self._batch += 1
+
+        try:
+            self._commit_paths(paths)
+        except:
+            LOG.exception("Error while committing %d S3 files to disk", len(paths))
+        finally:
+            with self._cond:
+                self._committed_batch = batch
+                self._cond.notify_all()
+
+    @staticmethod
+    def _commit_paths(paths: "set[str] | list[str]"):
+        start = time.monotonic()
+        dirs = set[str]()
+        for path in paths:
+            try:
+                fsync_path(path)
+            except FileNotFoundError:
+                # file was deleted or replaced since it was written
+                continue
+            dirs.add(os.path.dirname(path))
+
+        for dir in dirs:
+            try:
+                fsync_path(dir, is_dir=True)
+            except FileNotFoundError:
+                pass
+
+        METRICS.histogram("s3.group_commit.batch_size").record(len(paths))
+        METRICS.histogram("s3.group_commit.duration_ms").record(
+            (time.monotonic() - start) * 1000
+        )
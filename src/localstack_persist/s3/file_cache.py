@@ -0,0 +1,193 @@
+import os
+import resource
+from collections import OrderedDict
+from threading import Lock
+from typing import BinaryIO, Callable
+
+from ..config import PERSIST_S3_MAX_OPEN_FILES
+
+# Number of shards that cached read handles are split between, each with its own lock
+READ_FILE_SHARDS = 16
+# Number of shards used to track files opened for writing. Each shard has its own lock, so that
+# opening/closing files rarely contends with other threads or with `flush()`.
+WRITE_FILE_SHARDS = 16
+
+
+def get_nofile_soft_limit() -> int | None:
+    try:
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (OSError, ValueError):
+        return None
+
+    return None if soft_limit == resource.RLIM_INFINITY else soft_limit
+
+
+def get_max_open_files() -> int:
+    soft_limit = get_nofile_soft_limit()
+
+    if PERSIST_S3_MAX_OPEN_FILES is None:
+        # Leave plenty of descriptors for sockets, databases etc. used by other services
+        return 256 if soft_limit is None else min(256, soft_limit // 4)
+
+    # Never allow the cache to take more than half of the available descriptors
+    return (
+        PERSIST_S3_MAX_OPEN_FILES
+        if soft_limit is None
+        else min(PERSIST_S3_MAX_OPEN_FILES, soft_limit // 2)
+    )
+
+
+# LRU-bounded pool of idle read-only file handles, keyed by path. A handle is only ever used by one reader
+# at a time - `acquire` checks out an idle handle (or opens a new one), and `release` returns it to the pool.
+# Handles that are checked out when their path is invalidated are closed when they're released, rather than
+# being returned to the pool.
+# Paths are sharded by hash like in `WriteFileTracker`, each shard with its own lock and LRU order, so that
+# concurrent reads of different objects rarely contend.
+class ReadFileCache:
+    def __init__(self, max_size: int, shards: int = READ_FILE_SHARDS):
+        self.max_size = max_size
+        # each shard gets an equal part of the limit, so the total never exceeds it
+        shards = max(1, min(shards, max_size))
+        self._shards = [ReadFileShard(max_size // shards) for _ in range(shards)]
+
+    def _shard(self, path: str) -> "ReadFileShard":
+        return self._shards[hash(path) % len(self._shards)]
+
+    def acquire(self, path: str) -> BinaryIO:
+        return self._shard(path).acquire(path)
+
+    def release(self, path: str, file: BinaryIO):
+        self._shard(path).release(path, file)
+
+    def invalidate(self, path: str):
+        self._shard(path).invalidate(path)
+
+    def invalidate_dir(self, dir_path: str):
+        prefix = os.path.join(dir_path, "")
+        for shard in self._shards:
+            shard.invalidate_matching(lambda path: path.startswith(prefix))
+
+    def clear(self):
+        for shard in self._shards:
+            shard.invalidate_matching(lambda _: True)
+
+
+class ReadFileShard:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._idle = OrderedDict[str, list[BinaryIO]]()
+        self._idle_count = 0
+        self._checked_out = dict[str, set[BinaryIO]]()
+        self._stale = set[BinaryIO]()
+        # Incremented on every invalidation, to detect handles opened while their path was being invalidated
+        self._invalidations = 0
+        self._lock = Lock()
+
+    def acquire(self, path: str) -> BinaryIO:
+        with self._lock:
+            if handles := self._idle.get(path):
+                file = handles.pop()
+                self._idle_count -= 1
+                if not handles:
+                    del self._idle[path]
+                self._checked_out.setdefault(path, set()).add(file)
+                return file
+            invalidations = self._invalidations
+
+        file = open(path, "rb")
+        with self._lock:
+            self._checked_out.setdefault(path, set()).add(file)
+            if self._invalidations != invalidations:
+                self._stale.add(file)
+        return file
+
+    def release(self, path: str, file: BinaryIO):
+        with self._lock:
+            if handles := self._checked_out.get(path):
+                handles.discard(file)
+                if not handles:
+                    del self._checked_out[path]
+            stale = file in self._stale
+            self._stale.discard(file)
+
+        if self.max_size <= 0 or file.closed or stale:
+            file.close()
+            return
+
+        try:
+            file.seek(0)
+        except (OSError, ValueError):
+            file.close()
+            return
+
+        evicted: list[BinaryIO] = []
+        with self._lock:
+            self._idle.setdefault(path, []).append(file)
+            self._idle.move_to_end(path)
+            self._idle_count += 1
+
+            while self._idle_count > self.max_size:
+                _, handles = self._idle.popitem(last=False)
+                self._idle_count -= len(handles)
+                evicted.extend(handles)
+
+        for f in evicted:
+            f.close()
+
+    def invalidate(self, path: str):
+        with self._lock:
+            self._invalidations += 1
+            handles = self._idle.pop(path, [])
+            self._idle_count -= len(handles)
+            self._stale.update(self._checked_out.get(path, ()))
+
+        for f in handles:
+            f.close()
+
+    def invalidate_matching(self, matches: Callable[[str], bool]):
+        with self._lock:
+            self._invalidations += 1
+            paths = [p for p in self._idle if matches(p)]
+            handles = [f for p in paths for f in self._idle.pop(p)]
+            self._idle_count -= len(handles)
+            for p, checked_out in self._checked_out.items():
+                if matches(p):
+                    self._stale.update(checked_out)
+
+        for f in handles:
+            f.close()
+
+
+# Tracks files currently opened for writing so that they can be flushed. `flush` only holds each shard's lock
+# for long enough to take a snapshot, so it never blocks files being opened/closed while writing data to disk.
+class WriteFileTracker:
+    def __init__(self, shards: int = WRITE_FILE_SHARDS):
+        self._shards = [(set[BinaryIO](), Lock()) for _ in range(shards)]
+
+    def _shard(self, file: BinaryIO):
+        return self._shards[hash(file) % len(self._shards)]
+
+    def add(self, file: BinaryIO):
+        files, lock = self._shard(file)
+        with lock:
+            files.add(file)
+
+    def discard(self, file: BinaryIO):
+        files, lock = self._shard(file)
+        with lock:
+            files.discard(file)
+
+    def flush(self):
+        for files, lock in self._shards:
+            with lock:
+                snapshot = list(files)
+
+            for f in snapshot:
+                try:
+                    f.flush()
+                except ValueError:
+                    # file was closed concurrently, which will have flushed it anyway
+                    pass
+
+    def __len__(self) -> int:
+        return sum(len(files) for files, _ in self._shards)
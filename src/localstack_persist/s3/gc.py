@@ -0,0 +1,304 @@
+import bisect
+import json
+import logging
+import os
+import time
+from contextlib import nullcontext
+from threading import Thread
+from typing import NamedTuple, Optional
+
+from localstack.services.s3.models import S3Bucket, S3Object, s3_stores
+
+from ..config import BASE_DIR, PERSIST_S3_GC, S3GcMode
+from ..metrics import METRICS
+from ..state import STATE_TRACKER
+from .segments import SEGMENTS_DIR_NAME, close_segment_store, get_segment_store
+from .storage import PersistedS3ObjectStore, encode_file_name
+from .trash import TRASH_REAPER
+
+LOG = logging.getLogger(__name__)
+
+CHECKPOINT_PATH = os.path.join(BASE_DIR, "s3", "gc-checkpoint.json")
+
+# Maximum number of directory entries to check in each step of the scan
+SCAN_BATCH_SIZE = 1000
+# Delay, in seconds, between each step of the scan
+SCAN_INTERVAL = 10
+# Delay, in seconds, between finishing a full scan of all assets and starting the next one
+FULL_SCAN_INTERVAL = 3600
+# Files modified more recently than this (in seconds) are never considered orphans, because they may belong
+# to a request that is still in progress
+GRACE_PERIOD = 600
+
+MULTIPARTS_DIR_NAME = "multiparts"
+
+ORPHANED_BUCKET = "bucket"
+ORPHANED_OBJECT_FILE = "object file"
+ORPHANED_SEGMENT_OBJECT = "segment object"
+STALE_MULTIPART = "multipart"
+
+
+# An entry that wasn't referenced by the S3 state when its bucket was opened, which is re-checked against the
+# current S3 state before it's reported
+class Orphan(NamedTuple):
+    kind: str
+    bucket: str
+    path: str
+    name: str
+
+
+def expected_file_names(bucket: S3Bucket) -> set[str]:
+    return {
+        encode_file_name(f"{obj.key}@{obj.version_id or 'null'}")
+        for obj in bucket.objects.values(with_versions=True)
+        if isinstance(obj, S3Object)
+    }
+
+
+def get_buckets() -> dict[str, S3Bucket]:
+    return {
+        name: bucket
+        for _, _, store in s3_stores.iter_stores()
+        for name, bucket in dict(store.buckets).items()
+    }
+
+
+# Incrementally walks the S3 assets directory in small batches, comparing files against the loaded S3 state
+# to find orphans: object files, multipart uploads and bucket directories that the state no longer references.
+# Orphans are logged (and optionally removed), and progress is checkpointed to disk so that scans resume
+# after a restart rather than starting over. Scanning a bucket can take longer than GRACE_PERIOD, so each batch's
+# orphans are confirmed against the current S3 state (while S3 requests are blocked, if removing them).
+class OrphanScanner:
+    def __init__(self, mode: S3GcMode):
+        self.mode = mode
+        self.root = PersistedS3ObjectStore.root_directory
+        self._bucket: Optional[str] = None
+        self._entries: list[str] = []
+        self._position = 0
+        self._expected = set[str]()
+        self._multipart_ids = set[str]()
+
+    def start(self):
+        Thread(target=self._run, name="s3-orphan-scanner", daemon=True).start()
+
+    def _run(self):
+        self._restore_checkpoint()
+        while True:
+            time.sleep(SCAN_INTERVAL)
+            try:
+                if not self.step():
+                    LOG.debug("Finished scanning S3 assets for orphaned files")
+                    time.sleep(FULL_SCAN_INTERVAL)
+            except:
+                LOG.exception("Error while scanning S3 assets for orphaned files")
+
+    # Scans the next batch of entries, returning False once a full scan has completed
+    def step(self) -> bool:
+        if "s3" in STATE_TRACKER.failed_services:
+            # the S3 state is (partly) empty, so every file would look orphaned
+            return False
+
+        buckets = get_buckets()
+        remaining = SCAN_BATCH_SIZE
+        orphans = list[Orphan]()
+        finished = False
+
+        while remaining > 0:
+            if self._bucket is None or self._position >= len(self._entries):
+                if not self._next_bucket(buckets):
+                    finished = True
+                    break
+                if self._bucket not in buckets:
+                    self._check_orphaned_bucket(orphans)
+                    remaining -= 1
+                    continue
+
+            assert self._bucket is not None
+            batch = self._entries[self._position : self._position + remaining]
+            for name in batch:
+                self._check_entry(self._bucket, name, orphans)
+            self._position += len(batch)
+            remaining -= len(batch)
+
+        if orphans:
+            self._handle_orphans(orphans)
+
+        if finished:
+            self._save_checkpoint(None, None)
+            return False
+        last = self._entries[self._position - 1] if self._position else None
+        self._save_checkpoint(self._bucket, last)
+        return True
+
+    def _next_bucket(self, buckets: dict[str, S3Bucket]) -> bool:
+        try:
+            bucket_dirs = sorted(os.listdir(self.root))
+        except FileNotFoundError:
+            bucket_dirs = []
+
+        index = (
+            bisect.bisect_right(bucket_dirs, self._bucket)
+            if self._bucket is not None
+            else 0
+        )
+        if index >= len(bucket_dirs):
+            self._bucket = None
+            return False
+
+        self._open_bucket(bucket_dirs[index], buckets)
+        return True
+
+    def _open_bucket(self, name: str, buckets: dict[str, S3Bucket]):
+        self._bucket = name
+        self._position = 0
+        self._entries = []
+        if bucket := buckets.get(name):
+            try:
+                self._entries = sorted(os.listdir(os.path.join(self.root, name)))
+            except FileNotFoundError:
+                pass
+            self._expected = expected_file_names(bucket)
+            self._multipart_ids = set(bucket.multiparts)
+
+    def _check_orphaned_bucket(self, orphans: list[Orphan]):
+        assert self._bucket is not None
+        path = os.path.join(self.root, self._bucket)
+        if not self._is_recent(path):
+            orphans.append(Orphan(ORPHANED_BUCKET, self._bucket, path, self._bucket))
+
+    def _check_entry(self, bucket: str, name: str, orphans: list[Orphan]):
+        path = os.path.join(self.root, bucket, name)
+
+        if name == SEGMENTS_DIR_NAME:
+            self._check_segments(bucket, path, orphans)
+        elif name == MULTIPARTS_DIR_NAME:
+            self._check_multiparts(bucket, path, orphans)
+        elif name not in self._expected and not self._is_recent(path):
+            orphans.append(Orphan(ORPHANED_OBJECT_FILE, bucket, path, name))
+
+    def _check_segments(self, bucket: str, path: str, orphans: list[Orphan]):
+        segments = get_segment_store(os.path.dirname(path), create=False)
+        if segments is None:
+            return
+
+        min_mtime_ns = (time.time() - GRACE_PERIOD) * 1e9
+        for name, entry in segments.entries():
+            if name not in self._expected and entry.mtime_ns < min_mtime_ns:
+                orphans.append(Orphan(ORPHANED_SEGMENT_OBJECT, bucket, path, name))
+
+    def _check_multiparts(self, bucket: str, path: str, orphans: list[Orphan]):
+        try:
+            upload_ids = os.listdir(path)
+        except FileNotFoundError:
+            return
+
+        for upload_id in upload_ids:
+            upload_path = os.path.join(path, upload_id)
+            if upload_id not in self._multipart_ids and not self._is_recent(
+                upload_path
+            ):
+                orphans.append(Orphan(STALE_MULTIPART, bucket, upload_path, upload_id))
+
+    # Reports (and removes) the orphans that still aren't referenced by the current S3 state
+    def _handle_orphans(self, orphans: list[Orphan]):
+        remove = self.mode == S3GcMode.REMOVE
+        with STATE_TRACKER.write_lock("s3", "gc") if remove else nullcontext():
+            buckets = get_buckets()
+            expected = dict[str, set[str]]()
+
+            for orphan in orphans:
+                if orphan.kind == ORPHANED_BUCKET:
+                    if orphan.bucket in buckets:
+                        continue
+                    LOG.info("Found S3 assets for unknown bucket at %s", orphan.path)
+                    METRICS.increment("s3.gc.orphaned_buckets")
+                    # With no buckets at all, it's more likely that S3 state failed to load than that every
+                    # bucket was deleted, so never remove anything in that case
+                    if remove and buckets:
+                        close_segment_store(orphan.path)
+                        self._remove(orphan.path)
+                    continue
+
+                if not (bucket := buckets.get(orphan.bucket)):
+                    # the whole bucket has been deleted since it was opened
+                    continue
+
+                if orphan.kind == STALE_MULTIPART:
+                    if orphan.name in bucket.multiparts:
+                        continue
+                    LOG.info("Found stale S3 multipart upload at %s", orphan.path)
+                    METRICS.increment("s3.gc.stale_multiparts")
+                    if remove:
+                        self._remove(orphan.path)
+                    continue
+
+                if orphan.bucket not in expected:
+                    expected[orphan.bucket] = expected_file_names(bucket)
+                if orphan.name in expected[orphan.bucket]:
+                    continue
+                METRICS.increment("s3.gc.orphaned_objects")
+                if orphan.kind == ORPHANED_SEGMENT_OBJECT:
+                    LOG.info(
+                        "Found orphaned S3 object %s in segments at %s",
+                        orphan.name,
+                        orphan.path,
+                    )
+                    segments = get_segment_store(
+                        os.path.dirname(orphan.path), create=False
+                    )
+                    if remove and segments is not None:
+                        segments.delete(orphan.name)
+                else:
+                    LOG.info("Found orphaned S3 object file %s", orphan.path)
+                    if remove:
+                        self._remove(orphan.path)
+
+    @staticmethod
+    def _is_recent(path: str) -> bool:
+        try:
+            return os.stat(path).st_mtime > time.time() - GRACE_PERIOD
+        except FileNotFoundError:
+            # already deleted, so treat as recent to skip it
+            return True
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            TRASH_REAPER.move_to_trash(path)
+            METRICS.increment("s3.gc.removed")
+        except FileNotFoundError:
+            pass
+
+    def _restore_checkpoint(self):
+        try:
+            with open(CHECKPOINT_PATH) as file:
+                checkpoint = json.load(file)
+        except FileNotFoundError:
+            return
+        except:
+            LOG.warning("Ignoring invalid S3 scan checkpoint at %s", CHECKPOINT_PATH)
+            return
+
+        bucket = checkpoint.get("bucket")
+        if bucket is None:
+            return
+
+        # Resume from the entry after the last one that was checked
+        self._open_bucket(bucket, get_buckets())
+        if (after := checkpoint.get("after")) is not None:
+            self._position = bisect.bisect_right(self._entries, after)
+
+    def _save_checkpoint(self, bucket: Optional[str], after: Optional[str]):
+        os.makedirs(os.path.dirname(CHECKPOINT_PATH), exist_ok=True)
+        tmp_path = CHECKPOINT_PATH + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"bucket": bucket, "after": after}, file)
+        os.replace(tmp_path, CHECKPOINT_PATH)
+
+
+def start_orphan_scanner():
+    if PERSIST_S3_GC == S3GcMode.OFF:
+        return
+
+    LOG.info("Starting background scan of S3 assets for orphaned files...")
+    OrphanScanner(PERSIST_S3_GC).start()
@@ -0,0 +1,45 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Protocol
+
+from localstack.services.s3.constants import S3_CHUNK_SIZE
+
+# Chunk size used when writing/hashing S3 objects. Larger chunks amortise the overhead of handing each chunk
+# to the hashing threads, and hashlib only releases the GIL for buffers larger than 2KiB.
+PIPELINE_CHUNK_SIZE = max(S3_CHUNK_SIZE, 1024 * 1024)
+
+# Chunks smaller than this are hashed inline, as the overhead of using another thread would outweigh any gain
+MIN_PARALLEL_CHUNK_SIZE = 64 * 1024
+
+_executor = ThreadPoolExecutor(
+    max_workers=min(8, (os.cpu_count() or 1) * 2), thread_name_prefix="s3-hash"
+)
+
+
+class Hash(Protocol):
+    def update(self, data: bytes, /) -> None: ...
+
+
+# Updates hashes in worker threads, so that hashing each chunk runs concurrently with writing it to disk and
+# reading the next chunk. Each hash is updated by at most one thread at a time, and always in chunk order.
+class HashPipeline:
+    def __init__(self, *hashes: Optional[Hash]):
+        self._hashes = [h for h in hashes if h is not None]
+        self._pending: list[Future] = []
+
+    def update(self, data: bytes):
+        # Wait for the previous chunk to be hashed before starting on the next one. This also ensures that at
+        # most one chunk is being held in memory for hashing.
+        self.wait()
+
+        if len(data) < MIN_PARALLEL_CHUNK_SIZE or (os.cpu_count() or 1) < 2:
+            for h in self._hashes:
+                h.update(data)
+        else:
+            self._pending = [_executor.submit(h.update, data) for h in self._hashes]
+
+    def wait(self):
+        pending = self._pending
+        self._pending = []
+        for future in pending:
+            future.result()
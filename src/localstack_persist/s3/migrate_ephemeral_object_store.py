@@ -1,5 +1,7 @@
 import base64
-from typing import cast
+import os
+from functools import partial
+from typing import Any, cast
 import jsonpickle
 
 from localstack.services.s3.models import S3Object, S3Multipart, S3Part
@@ -9,9 +11,29 @@ from localstack.services.s3.storage.ephemeral import (
 )
 from localstack.utils.files import mkdir
 
+from .migration import MigrationCheckpoint, ParallelWriter
 from .storage import PersistedS3ObjectStore
+from ..config import BASE_DIR
 from ..serialization.jsonpickle.serializer import JsonPickleDeserializer
 
+CHECKPOINT_PATH = os.path.join(BASE_DIR, "s3", "migrate-objects-checkpoint.log")
+
+
+# Holds the still-encoded data of a persisted LocalStack object file, so that each object is only decoded when
+# it's written, rather than decoding every object into memory up front
+class EncodedFile:
+    def __init__(self, obj: dict):
+        self.obj = obj
+
+    def decode(self) -> LockedSpooledTemporaryFile:
+        file = LockedSpooledTemporaryFile()
+        if "text" in self.obj:
+            file.write(self.obj["text"].encode())
+        else:
+            file.write(base64.b64decode(self.obj["b64"]))
+        file.seek(0)
+        return file
+
 
 class LockedSpooledTemporaryFileHandler(jsonpickle.handlers.BaseHandler):
     def flatten(self, obj, data):
@@ -20,13 +42,7 @@ class LockedSpooledTemporaryFileHandler(jsonpickle.handlers.BaseHandler):
         )
 
     def restore(self, obj: dict):
-        file = LockedSpooledTemporaryFile()
-        if "text" in obj:
-            file.write(obj["text"].encode())
-        else:
-            file.write(base64.b64decode(obj["b64"]))
-        file.seek(0)
-        return file
+        return EncodedFile(obj)
 
 
 class StubS3Multipart:
@@ -34,6 +50,34 @@ class StubS3Multipart:
         self.id = id
 
 
+# The ephemeral store's files are typed as LockedSpooledTemporaryFile, but are restored as EncodedFile by
+# LockedSpooledTemporaryFileHandler
+def decode_file(
+    data: EncodedFile | LockedSpooledTemporaryFile,
+) -> LockedSpooledTemporaryFile:
+    return data.decode() if isinstance(data, EncodedFile) else data
+
+
+def write_object(
+    store: PersistedS3ObjectStore,
+    bucket: str,
+    key: str,
+    data: EncodedFile | LockedSpooledTemporaryFile,
+):
+    [key, version] = key.rsplit("?", 1)
+    with store.open(bucket, S3Object(key, version_id=version), "w") as new_object:
+        new_object.write(decode_file(data))
+
+
+def write_part(
+    multipart: Any, part_number: int, data: EncodedFile | LockedSpooledTemporaryFile
+):
+    with multipart.open(S3Part(part_number)) as new_part:
+        new_part.write(decode_file(data))
+
+
+# Objects are written in parallel, with progress recorded in a checkpoint so that an interrupted migration
+# resumes where it left off. The root directory existing (without a checkpoint) means the migration completed.
 def migrate_ephemeral_object_store(file_path: str, store: PersistedS3ObjectStore):
     jsonpickle.register(LockedSpooledTemporaryFile, LockedSpooledTemporaryFileHandler)
     ephemeral_store: EphemeralS3ObjectStore = JsonPickleDeserializer(
@@ -45,19 +89,28 @@ def migrate_ephemeral_object_store(file_path: str, store: PersistedS3ObjectStore
         mkdir(store.root_directory)
         return
 
-    for bucket, files in ephemeral_store._filesystem.items():
-        store.create_bucket(bucket)
-        for key, obj_data in files["keys"].items():
-            [key, version] = key.rsplit("?", 1)
-            with store.open(
-                bucket, S3Object(key, version_id=version), "w"
-            ) as new_object:
-                new_object.write(obj_data)
-
-        for id, multipart in files["multiparts"].items():
-            new_multipart = store.get_multipart(
-                bucket, cast(S3Multipart, StubS3Multipart(id))
-            )
-            for part_number, part_data in multipart.parts.items():
-                with new_multipart.open(S3Part(part_number)) as new_part:
-                    new_part.write(part_data)
+    with MigrationCheckpoint(CHECKPOINT_PATH) as checkpoint, ParallelWriter(
+        checkpoint
+    ) as writer:
+        for bucket, files in ephemeral_store._filesystem.items():
+            store.create_bucket(bucket)
+            # pop each object as it's submitted, so that its data can be freed once it's been written
+            keys = files["keys"]
+            while keys:
+                key, obj_data = keys.popitem()
+                writer.submit(
+                    f"{bucket}/{key}",
+                    partial(write_object, store, bucket, key, obj_data),
+                )
+
+            for id, multipart in files["multiparts"].items():
+                new_multipart = store.get_multipart(
+                    bucket, cast(S3Multipart, StubS3Multipart(id))
+                )
+                parts = multipart.parts
+                while parts:
+                    part_number, part_data = parts.popitem()
+                    writer.submit(
+                        f"{bucket}/multiparts/{id}/{part_number}",
+                        partial(write_part, new_multipart, part_number, part_data),
+                    )
@@ -6,12 +6,55 @@ from localstack.services.s3.models import S3Store, S3Bucket, S3Object
 from localstack.services.s3.utils import get_owner_for_account_id, get_canned_acl
 from localstack.aws.api.s3 import BucketCannedACL, StorageClass
 import io
+import os
+from functools import partial
+from typing import IO
 
+from ..config import BASE_DIR
+from .migration import MigrationCheckpoint, ParallelWriter
 from .storage import PersistedS3ObjectStore
 
+CHECKPOINT_PATH = os.path.join(BASE_DIR, "s3", "migrate-v3-checkpoint.log")
+
+
+def open_value(fake_key: FakeKey) -> IO[bytes]:
+    # Read directly from the key's buffer where possible, rather than copying its whole value into memory
+    buffer = getattr(fake_key, "_value_buffer", None)
+    if buffer is None:
+        return io.BytesIO(fake_key.value)
+    buffer.seek(0)
+    return buffer
+
+
+# Returns the properties of `s3_object` that are set by writing it, so they can be restored if the migration is
+# resumed and the object doesn't need to be written again
+def write_object(
+    objects: PersistedS3ObjectStore,
+    bucket_name: str,
+    s3_object: S3Object,
+    fake_key: FakeKey,
+) -> dict:
+    with objects.open(bucket_name, s3_object, "w") as s3_stored_object:
+        s3_stored_object.write(open_value(fake_key))
+    return {"etag": s3_object.etag, "size": s3_object.size}
+
+
+def restore_written_object(s3_object: S3Object, data: dict):
+    s3_object.etag = data["etag"]
+    s3_object.size = data["size"]
+
 
 def migrate_to_v3(
     backends: S3BackendDict,
+) -> AccountRegionBundle[S3Store]:
+    with MigrationCheckpoint(CHECKPOINT_PATH) as checkpoint, ParallelWriter(
+        checkpoint
+    ) as writer:
+        return _migrate_to_v3(backends, writer)
+
+
+def _migrate_to_v3(
+    backends: S3BackendDict, writer: ParallelWriter
 ) -> AccountRegionBundle[S3Store]:
     account_region_bundle = AccountRegionBundle[S3Store]("s3", S3Store)
     objects = PersistedS3ObjectStore()
@@ -66,8 +109,13 @@ def migrate_to_v3(
                     owner=s3_bucket.owner,
                 )
 
-                with objects.open(fake_bucket.name, s3_object, "w") as s3_stored_object:
-                    s3_stored_object.write(io.BytesIO(fake_key.value))
+                writer.submit(
+                    f"{fake_bucket.name}/{fake_key.name}@{fake_key.version_id}",
+                    partial(
+                        write_object, objects, fake_bucket.name, s3_object, fake_key
+                    ),
+                    partial(restore_written_object, s3_object),
+                )
 
                 s3_bucket.objects.set(fake_key.name, s3_object)
 
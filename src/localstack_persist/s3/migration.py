@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Optional
+
+LOG = logging.getLogger(__name__)
+
+MIGRATION_THREADS = min(16, (os.cpu_count() or 1) * 4)
+# Maximum number of objects queued for writing at once, to bound memory usage when objects are large
+MAX_PENDING_WRITES = MIGRATION_THREADS * 2
+
+
+# Records which objects have been migrated in an append-only log, so that an interrupted migration can resume
+# without rewriting objects that were already written. Each line is a JSON array of the ID of a completed object
+# and any data returned when writing it.
+class MigrationCheckpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        self._completed = dict[str, Any]()
+        self._file = None
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def __enter__(self):
+        if self.exists():
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        id, data = json.loads(line)
+                        self._completed[id] = data
+                    except ValueError:
+                        # the last line may be incomplete if the process was killed while writing it, in which
+                        # case that object will just be migrated again
+                        pass
+            LOG.info(
+                "Resuming migration from %s, skipping %d already-migrated objects",
+                self.path,
+                len(self._completed),
+            )
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        assert self._file
+        self._file.close()
+        self._file = None
+        # only discard progress once the migration has completed successfully
+        if exc_type is None:
+            os.remove(self.path)
+
+    def is_completed(self, id: str) -> bool:
+        return id in self._completed
+
+    def get_data(self, id: str) -> Any:
+        return self._completed.get(id)
+
+    def mark_completed(self, id: str, data: Any = None):
+        assert self._file
+        line = json.dumps([id, data]) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+
+# Runs object writes on a thread pool, marking each object as completed in the checkpoint (along with the data
+# returned by `write`) once it's written. If the object was already migrated, `on_skip` is called with the
+# data that was recorded instead. Submitting blocks while too many writes are pending, so that callers can
+# stream objects in without buffering all of them in memory.
+class ParallelWriter:
+    def __init__(self, checkpoint: MigrationCheckpoint):
+        self.checkpoint = checkpoint
+        self._executor = ThreadPoolExecutor(
+            max_workers=MIGRATION_THREADS, thread_name_prefix="s3-migrate"
+        )
+        self._pending = list[Future]()
+        self.written = 0
+        self.skipped = 0
+
+    def submit(
+        self,
+        id: str,
+        write: Callable[[], Any],
+        on_skip: Optional[Callable[[Any], None]] = None,
+    ):
+        if self.checkpoint.is_completed(id):
+            if on_skip:
+                on_skip(self.checkpoint.get_data(id))
+            self.skipped += 1
+            return
+
+        if len(self._pending) >= MAX_PENDING_WRITES:
+            self._wait(MAX_PENDING_WRITES // 2)
+
+        self._pending.append(self._executor.submit(self._write, id, write))
+
+    def _write(self, id: str, write: Callable[[], Any]):
+        self.checkpoint.mark_completed(id, write())
+
+    def _wait(self, max_pending: int):
+        while len(self._pending) > max_pending:
+            self._pending.pop(0).result()
+            self.written += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._wait(0)
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+        LOG.info(
+            "Migrated %d S3 objects (%d already migrated)", self.written, self.skipped
+        )
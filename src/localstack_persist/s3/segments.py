@@ -0,0 +1,479 @@
+import io
+import logging
+import os
+import re
+import struct
+import zlib
+import time
+from threading import Lock, Thread
+from typing import BinaryIO, Callable, Iterator, NamedTuple, Optional
+
+from ..config import PERSIST_S3_DURABILITY, S3Durability
+from ..metrics import METRICS
+from .durability import fsync_path
+
+LOG = logging.getLogger(__name__)
+
+# Name of the directory (within each bucket's directory) containing segment files. Object file names always
+# contain an "@" character, so this can never clash with an object.
+SEGMENTS_DIR_NAME = ".segments"
+
+# Once the active segment file reaches this size, a new segment file is started
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Segments are compacted once at least this proportion of their contents are overwritten/deleted objects
+COMPACTION_THRESHOLD = 0.5
+# How often, in seconds, to check whether any segments need compacting
+COMPACTION_INTERVAL = 60
+
+segment_file_name = re.compile(r"^segment-(\d+)$")
+
+# Each record is a header, followed by the object's (utf-8 encoded) file name, followed by the object's data.
+# Header fields: record kind, name length, data length, last modified time (ns), crc32 of name + data
+RECORD_HEADER = struct.Struct("<BIQqI")
+RECORD_PUT = 1
+RECORD_TOMBSTONE = 2
+
+
+class SegmentEntry(NamedTuple):
+    segment_id: int
+    data_offset: int
+    length: int
+    mtime_ns: int
+    record_size: int
+
+
+class SegmentRecord(NamedTuple):
+    kind: int
+    name: str
+    data_offset: int
+    length: int
+    mtime_ns: int
+    record_size: int
+
+
+def encode_record(kind: int, name: str, data: bytes, mtime_ns: int) -> bytes:
+    encoded_name = name.encode("utf-8")
+    crc = zlib.crc32(data, zlib.crc32(encoded_name))
+    header = RECORD_HEADER.pack(kind, len(encoded_name), len(data), mtime_ns, crc)
+    return header + encoded_name + data
+
+
+# Append-only store of small S3 objects for a single bucket, packed into segment files. An in-memory index
+# (rebuilt by scanning the segments on startup) maps each object's file name to the location of its data.
+# Deleted/overwritten objects are reclaimed by `compact()`, which rewrites live objects into a new segment.
+# Read-only stores (e.g. in the base layer) can only be read from, and are never modified.
+class SegmentStore:
+    def __init__(
+        self, dir: str, max_segment_size: int = MAX_SEGMENT_SIZE, read_only=False
+    ):
+        self.dir = dir
+        self.max_segment_size = max_segment_size
+        self.read_only = read_only
+        self._lock = Lock()
+        self._index = dict[str, SegmentEntry]()
+        self._fds = dict[int, int]()
+        self._sizes = dict[int, int]()
+        self._dead_bytes = dict[int, int]()
+        self._active_id = 0
+
+        if not read_only:
+            os.makedirs(dir, exist_ok=True)
+        self._load()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def entries(self) -> list[tuple[str, SegmentEntry]]:
+        return list(self._index.items())
+
+    # Segment files are never modified once written, so only the index lookup needs the lock. The segment's file
+    # descriptor is duplicated, as it may be closed (e.g. by compaction) while it's being read.
+    def read(self, name: str) -> Optional[tuple[bytes, int]]:
+        with self._lock:
+            if not (entry := self._index.get(name)):
+                return None
+            fd = os.dup(self._fds[entry.segment_id])
+
+        try:
+            data = os.pread(fd, entry.length, entry.data_offset)
+        finally:
+            os.close(fd)
+
+        METRICS.increment("s3.segments.reads")
+        return data, entry.mtime_ns
+
+    # Returns the path of the segment file that was written to
+    def put(self, name: str, data: bytes, mtime_ns: int) -> str:
+        assert not self.read_only
+        with self._lock:
+            self._append(RECORD_PUT, name, data, mtime_ns)
+            METRICS.increment("s3.segments.puts")
+            return self._segment_path(self._active_id)
+
+    def delete(self, name: str) -> bool:
+        assert not self.read_only
+        with self._lock:
+            if name not in self._index:
+                return False
+            self._append(RECORD_TOMBSTONE, name, b"", 0)
+            METRICS.increment("s3.segments.deletes")
+            return True
+
+    def compact(self, threshold: float = COMPACTION_THRESHOLD):
+        if self.read_only:
+            return
+        with self._lock:
+            candidates = [
+                id
+                for id, size in self._sizes.items()
+                if id != self._active_id and self._dead_bytes[id] >= threshold * size
+            ]
+
+        for id in sorted(candidates):
+            self._compact_segment(id)
+
+    def close(self):
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+
+    def _segment_path(self, id: int) -> str:
+        return os.path.join(self.dir, f"segment-{id:08d}")
+
+    def _open_segment(self, id: int) -> int:
+        flags = os.O_RDONLY if self.read_only else os.O_RDWR | os.O_CREAT | os.O_APPEND
+        fd = os.open(self._segment_path(id), flags, 0o644)
+        self._fds[id] = fd
+        self._sizes.setdefault(id, 0)
+        self._dead_bytes.setdefault(id, 0)
+        return fd
+
+    def _load(self):
+        ids = sorted(
+            int(m.group(1))
+            for name in os.listdir(self.dir)
+            if (m := segment_file_name.match(name))
+        )
+
+        for id in ids:
+            self._open_segment(id)
+            size = 0
+            for record in self._scan(id):
+                size = record.data_offset + record.length
+                self._apply(id, record)
+            self._sizes[id] = size
+
+            if size != os.fstat(self._fds[id]).st_size and not self.read_only:
+                LOG.warning(
+                    "Truncating incomplete/corrupt records from S3 segment file %s",
+                    self._segment_path(id),
+                )
+                os.truncate(self._segment_path(id), size)
+
+        if ids or self.read_only:
+            self._active_id = ids[-1] if ids else 0
+        else:
+            self._active_id = 1
+            self._open_segment(self._active_id)
+
+    def _scan(self, id: int) -> Iterator[SegmentRecord]:
+        with open(self._segment_path(id), "rb") as file:
+            offset = 0
+            while header := file.read(RECORD_HEADER.size):
+                if len(header) < RECORD_HEADER.size:
+                    return
+                kind, name_len, data_len, mtime_ns, crc = RECORD_HEADER.unpack(header)
+                encoded_name = file.read(name_len)
+                data = file.read(data_len)
+                if (
+                    kind not in (RECORD_PUT, RECORD_TOMBSTONE)
+                    or len(encoded_name) < name_len
+                    or len(data) < data_len
+                    or zlib.crc32(data, zlib.crc32(encoded_name)) != crc
+                ):
+                    return
+
+                record_size = RECORD_HEADER.size + name_len + data_len
+                yield SegmentRecord(
+                    kind,
+                    encoded_name.decode("utf-8"),
+                    offset + RECORD_HEADER.size + name_len,
+                    data_len,
+                    mtime_ns,
+                    record_size,
+                )
+                offset += record_size
+
+    def _apply(self, id: int, record: SegmentRecord):
+        if old := self._index.pop(record.name, None):
+            self._dead_bytes[old.segment_id] += old.record_size
+
+        if record.kind == RECORD_PUT:
+            self._index[record.name] = SegmentEntry(
+                id,
+                record.data_offset,
+                record.length,
+                record.mtime_ns,
+                record.record_size,
+            )
+        else:
+            # tombstones are never live, but must be kept until older segments are compacted
+            self._dead_bytes[id] += record.record_size
+
+    def _append(self, kind: int, name: str, data: bytes, mtime_ns: int):
+        record = encode_record(kind, name, data, mtime_ns)
+
+        size = self._sizes[self._active_id]
+        if size > 0 and size + len(record) > self.max_segment_size:
+            self._active_id += 1
+            self._open_segment(self._active_id)
+            size = 0
+
+        os.write(self._fds[self._active_id], record)
+        self._sizes[self._active_id] = size + len(record)
+
+        encoded_name_len = len(record) - RECORD_HEADER.size - len(data)
+        self._apply(
+            self._active_id,
+            SegmentRecord(
+                kind,
+                name,
+                size + RECORD_HEADER.size + encoded_name_len,
+                len(data),
+                mtime_ns,
+                len(record),
+            ),
+        )
+
+    # Live records are copied into a new segment without holding the lock, so that reads and writes aren't blocked
+    # while a whole segment is rewritten, and only the index entries are swapped over under the lock. A new active
+    # segment is started after the new segment, so that objects written in the meantime still take precedence over
+    # the copies when the segments are next loaded.
+    def _compact_segment(self, id: int):
+        with self._lock:
+            if id not in self._fds:
+                # store has been closed
+                return
+            has_older_segments = any(other < id for other in self._sizes)
+            new_id = self._active_id + 1
+            self._active_id += 2
+            self._open_segment(self._active_id)
+
+        new_path = self._segment_path(new_id)
+        new_fd = os.open(new_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        # copied records, and the offset of their data in the new segment
+        copied = list[tuple[SegmentRecord, int]]()
+        size = 0
+        try:
+            with open(self._segment_path(id), "rb") as file:
+                for record in self._scan(id):
+                    if record.kind == RECORD_PUT:
+                        if not self._is_live(id, record):
+                            continue
+                        data = os.pread(
+                            file.fileno(), record.length, record.data_offset
+                        )
+                    elif has_older_segments and record.name not in self._index:
+                        # an older segment may still contain a put record that this tombstone shadows
+                        data = b""
+                    else:
+                        continue
+
+                    encoded = encode_record(
+                        record.kind, record.name, data, record.mtime_ns
+                    )
+                    os.write(new_fd, encoded)
+                    copied.append((record, size + len(encoded) - len(data)))
+                    size += len(encoded)
+            if copied and PERSIST_S3_DURABILITY != S3Durability.NONE:
+                # the copies must be durable before the segment they replace is removed
+                os.fsync(new_fd)
+                fsync_path(self.dir, is_dir=True)
+        except:
+            os.close(new_fd)
+            os.unlink(new_path)
+            raise
+
+        with self._lock:
+            if id not in self._fds:
+                # store was closed meanwhile - both segments are left as they are, which loads the same objects
+                os.close(new_fd)
+                return
+
+            if copied:
+                self._fds[new_id] = new_fd
+                self._sizes[new_id] = size
+                self._dead_bytes[new_id] = 0
+            else:
+                os.close(new_fd)
+                os.unlink(new_path)
+
+            for record, data_offset in copied:
+                if record.kind == RECORD_PUT and self._is_live(id, record):
+                    self._index[record.name] = SegmentEntry(
+                        new_id,
+                        data_offset,
+                        record.length,
+                        record.mtime_ns,
+                        record.record_size,
+                    )
+                else:
+                    self._dead_bytes[new_id] += record.record_size
+
+            os.close(self._fds.pop(id))
+            del self._sizes[id]
+            del self._dead_bytes[id]
+            os.unlink(self._segment_path(id))
+
+        METRICS.increment("s3.segments.compactions")
+
+    # Whether a put record in segment `id` holds the current data of its object
+    def _is_live(self, id: int, record: SegmentRecord) -> bool:
+        entry = self._index.get(record.name)
+        return entry is not None and (entry.segment_id, entry.data_offset) == (
+            id,
+            record.data_offset,
+        )
+
+
+# Segment stores are shared between all PersistedS3ObjectStore instances, keyed by bucket directory.
+# `None` records that a bucket has no segments directory, to avoid checking for it on every read.
+_segment_stores = dict[str, Optional[SegmentStore]]()
+_segment_stores_lock = Lock()
+_compactor: Optional[Thread] = None
+
+
+def get_segment_store(bucket_dir: str, create: bool) -> Optional[SegmentStore]:
+    store = _segment_stores.get(bucket_dir)
+    if store is not None or (not create and bucket_dir in _segment_stores):
+        return store
+
+    global _compactor
+    with _segment_stores_lock:
+        if (store := _segment_stores.get(bucket_dir)) is not None:
+            return store
+
+        segments_dir = os.path.join(bucket_dir, SEGMENTS_DIR_NAME)
+        if create or os.path.isdir(segments_dir):
+            store = SegmentStore(segments_dir)
+            if not _compactor:
+                _compactor = Thread(
+                    target=_run_compactor, name="s3-segment-compactor", daemon=True
+                )
+                _compactor.start()
+
+        _segment_stores[bucket_dir] = store
+        return store
+
+
+# Returns the segment store of a bucket directory that mustn't be modified (i.e. in the base layer), if it has one
+def get_read_only_segment_store(bucket_dir: str) -> Optional[SegmentStore]:
+    if bucket_dir in _segment_stores:
+        return _segment_stores[bucket_dir]
+
+    with _segment_stores_lock:
+        if bucket_dir not in _segment_stores:
+            segments_dir = os.path.join(bucket_dir, SEGMENTS_DIR_NAME)
+            _segment_stores[bucket_dir] = (
+                SegmentStore(segments_dir, read_only=True)
+                if os.path.isdir(segments_dir)
+                else None
+            )
+        return _segment_stores[bucket_dir]
+
+
+def close_segment_store(bucket_dir: str):
+    with _segment_stores_lock:
+        store = _segment_stores.pop(bucket_dir, None)
+
+    if store is not None:
+        store.close()
+
+
+# Closes all segment stores of buckets within `root_dir`, which are reopened when next used
+def close_segment_stores(root_dir: str):
+    prefix = os.path.join(root_dir, "")
+    with _segment_stores_lock:
+        bucket_dirs = [d for d in _segment_stores if d.startswith(prefix)]
+        stores = [_segment_stores.pop(d) for d in bucket_dirs]
+
+    for store in stores:
+        if store is not None:
+            store.close()
+
+
+def _run_compactor():
+    while True:
+        time.sleep(COMPACTION_INTERVAL)
+        for bucket_dir, store in list(_segment_stores.items()):
+            if store is None or store.read_only:
+                continue
+            try:
+                store.compact()
+            except:
+                LOG.exception("Error while compacting S3 segments of %s", bucket_dir)
+
+
+# Read-only file-like view of an object stored in a segment
+class SegmentObjectFile(io.BytesIO):
+    def __init__(self, data: bytes, mtime_ns: int):
+        super().__init__(data)
+        self.mtime_ns = mtime_ns
+
+
+# Buffers a written object in memory until it's known whether it's small enough to be stored in a segment.
+# As soon as the object exceeds `threshold` bytes, it's spilled into the file returned by `spill`.
+class SmallObjectWriter:
+    def __init__(self, threshold: int, spill: Callable[[], BinaryIO]):
+        self.threshold = threshold
+        self.file: Optional[BinaryIO] = None
+        self.discarded = False
+        self.closed = False
+        # the time the object was last written to, i.e. the modification time it's persisted with
+        self.mtime_ns = time.time_ns()
+        self._spill = spill
+        self._buffer = io.BytesIO()
+
+    def _target(self) -> BinaryIO:
+        return self.file or self._buffer
+
+    def write(self, data: bytes) -> int:
+        if self.file is None and self._buffer.tell() + len(data) > self.threshold:
+            position = self._buffer.tell()
+            self.file = self._spill()
+            self.file.write(self._buffer.getbuffer())
+            self.file.seek(position)
+            self._buffer = io.BytesIO()
+        self.mtime_ns = time.time_ns()
+        return self._target().write(data)
+
+    # Objects are only readable until they're spilled, as their file is opened for writing only
+    def read(self, size: int = -1) -> bytes:
+        return self._target().read(size)
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        self.mtime_ns = time.time_ns()
+        return self._target().truncate(size)
+
+    def tell(self) -> int:
+        return self._target().tell()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._target().seek(offset, whence)
+
+    def flush(self):
+        self._target().flush()
+
+    def fileno(self) -> int:
+        if self.file is None:
+            raise io.UnsupportedOperation("fileno")
+        return self.file.fileno()
+
+    def getvalue(self) -> bytes:
+        return self._buffer.getvalue()
+
+    def close(self):
+        self.closed = True
+        self._buffer = io.BytesIO()
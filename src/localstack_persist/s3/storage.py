@@ -1,4 +1,5 @@
 import base64
+import errno
 import hashlib
 import os
 import re
@@ -15,9 +16,40 @@ from localstack.services.s3.storage import (
     S3StoredObject,
     LimitedStream,
 )
-from localstack.utils.files import mkdir, rm_rf
-from typing import IO, BinaryIO, Iterator, Literal, Optional, Sequence, TypeVar
-from ..config import BASE_DIR
+from localstack.utils.files import mkdir
+from typing import (
+    IO,
+    BinaryIO,
+    Iterator,
+    Literal,
+    Optional,
+    Sequence,
+    TypeVar,
+    cast,
+)
+from ..utils import break_hardlink
+from ..layers import get_base_layer_path, get_read_path
+from ..config import (
+    BASE_DIR,
+    PERSIST_BASE_LAYER,
+    PERSIST_S3_COMMIT_INTERVAL,
+    PERSIST_S3_DURABILITY,
+    PERSIST_S3_SMALL_OBJECT_THRESHOLD,
+    S3Durability,
+)
+from .durability import GroupCommitter, fsync_path
+from .file_cache import ReadFileCache, WriteFileTracker, get_max_open_files
+from .hashing import PIPELINE_CHUNK_SIZE, HashPipeline
+from .segments import (
+    SegmentObjectFile,
+    SegmentStore,
+    SmallObjectWriter,
+    close_segment_store,
+    close_segment_stores,
+    get_read_only_segment_store,
+    get_segment_store,
+)
+from .trash import TRASH_REAPER
 
 special_chars = re.compile(r"[\x00-\x1f\x7f\\/\":*?|<>$%]")
 
@@ -40,6 +72,7 @@ def encode_file_name(name: str) -> str:
 
 
 class PersistedS3StoredObject(S3StoredObject):
+    _mode: Literal["r", "w"]
     _file: BinaryIO
     _size: Optional[int]
     _md5: "hashlib._Hash"
@@ -51,11 +84,13 @@ class PersistedS3StoredObject(S3StoredObject):
         self,
         s3_object: S3Object | S3Part,
         store: "PersistedS3ObjectStore",
+        path: str,
         file: BinaryIO,
         mode: Literal["r", "w"],
     ):
         super().__init__(s3_object, mode)
         self._store = store
+        self._path = path
         self._file = file
         self._size = None
         self._md5 = hashlib.md5(usedforsecurity=False)
@@ -68,8 +103,10 @@ class PersistedS3StoredObject(S3StoredObject):
         self._checksum_value = None
 
     def close(self):
-        self._store.close_file(self._file)
+        if self.closed:
+            return
         self.closed = True
+        self._store.close_file(self._path, self._file, self._mode)
 
     def truncate(self, size: Optional[int] = None) -> int:
         return self._file.truncate(size)
@@ -78,11 +115,11 @@ class PersistedS3StoredObject(S3StoredObject):
         self._file.truncate()
 
         if s:
-            while data := s.read(S3_CHUNK_SIZE):
+            hashes = HashPipeline(self._md5, self._checksum)
+            while data := s.read(PIPELINE_CHUNK_SIZE):
+                hashes.update(data)
                 self._file.write(data)
-                self._md5.update(data)
-                if self._checksum:
-                    self._checksum.update(data)
+            hashes.wait()
 
         self._etag = self.s3_object.etag = self._md5.hexdigest()
         if self._checksum:
@@ -95,12 +132,12 @@ class PersistedS3StoredObject(S3StoredObject):
 
     def append(self, part: IO[bytes] | S3StoredObject) -> int:
         read = 0
-        while data := part.read(S3_CHUNK_SIZE):
+        hashes = HashPipeline(self._md5, self._checksum)
+        while data := part.read(PIPELINE_CHUNK_SIZE):
+            hashes.update(data)
             self._file.write(data)
-            self._md5.update(data)
-            if self._checksum:
-                self._checksum.update(data)
             read += len(data)
+        hashes.wait()
 
         self._etag = self.s3_object.etag = self._md5.hexdigest()
         if self._checksum:
@@ -132,6 +169,10 @@ class PersistedS3StoredObject(S3StoredObject):
 
     @property
     def last_modified(self) -> int:
+        if isinstance(self._file, SegmentObjectFile) or (
+            isinstance(self._file, SmallObjectWriter) and self._file.file is None
+        ):
+            return self._file.mtime_ns
         return os.stat(self._file.fileno()).st_mtime_ns
 
     def __iter__(self) -> Iterator[bytes]:
@@ -142,10 +183,10 @@ class PersistedS3StoredObject(S3StoredObject):
         self.close()
 
     def _compute_hashes(self):
-        while data := self.read(S3_CHUNK_SIZE):
-            self._md5.update(data)
-            if self._checksum:
-                self._checksum.update(data)
+        hashes = HashPipeline(self._md5, self._checksum)
+        while data := self.read(PIPELINE_CHUNK_SIZE):
+            hashes.update(data)
+        hashes.wait()
 
         self._etag = self.s3_object.etag = self._md5.hexdigest()
         if self._checksum:
@@ -177,12 +218,16 @@ class PersistedS3StoredMultipart(S3StoredMultipart):
         self, s3_part: S3Part, mode: Literal["r", "w"] = "r"
     ) -> PersistedS3StoredObject:
         path = os.path.join(self._dir, f"part-{s3_part.part_number}")
+        if mode == "r":
+            path = get_read_path(path)
         file = self._s3_store.open_file(path, mode)
-        return PersistedS3StoredObject(s3_part, self._s3_store, file, mode)
+        return PersistedS3StoredObject(s3_part, self._s3_store, path, file, mode)
 
     def remove_part(self, s3_part: S3Part):
         path = os.path.join(self._dir, f"part-{s3_part.part_number}")
-        os.unlink(path)
+        self._s3_store._read_files.invalidate(path)
+        if os.path.exists(path) or get_read_path(path) == path:
+            os.unlink(path)
 
     def complete_multipart(
         self, parts: list[PartNumber] | list[S3Part] | list[Parts] | Parts
@@ -203,7 +248,7 @@ class PersistedS3StoredMultipart(S3StoredMultipart):
                     else s3_part.get("PartNumber")
                 )
             )
-            path = os.path.join(self._dir, f"part-{part_number}")
+            path = get_read_path(os.path.join(self._dir, f"part-{part_number}"))
             with open(path, "rb") as file:
                 s3_stored_object.append(file)
 
@@ -234,8 +279,15 @@ class PersistedS3ObjectStore(S3ObjectStore):
 
     def __init__(self) -> None:
         super().__init__()
-        self._open_files = set[BinaryIO]()
-        self._open_files_lock = Lock()
+        self._read_files = ReadFileCache(get_max_open_files())
+        self._write_files = WriteFileTracker()
+        self._committer = (
+            GroupCommitter(PERSIST_S3_COMMIT_INTERVAL)
+            if PERSIST_S3_DURABILITY == S3Durability.BATCHED
+            else None
+        )
+        self._small_object_writers = dict[str, set[SmallObjectWriter]]()
+        self._small_object_writers_lock = Lock()
 
     def open(
         self,
@@ -244,15 +296,45 @@ class PersistedS3ObjectStore(S3ObjectStore):
         mode: Literal["r", "w"] = "r",
     ) -> PersistedS3StoredObject:
         path = self._object_path(bucket, s3_object)
-        file = self.open_file(path, mode)
-        return PersistedS3StoredObject(s3_object, self, file, mode)
+        file: BinaryIO
+
+        if mode == "w" and PERSIST_S3_SMALL_OBJECT_THRESHOLD > 0:
+            writer = SmallObjectWriter(
+                PERSIST_S3_SMALL_OBJECT_THRESHOLD, lambda: self.open_file(path, "w")
+            )
+            with self._small_object_writers_lock:
+                self._small_object_writers.setdefault(path, set()).add(writer)
+            file = cast(BinaryIO, writer)
+        elif mode == "r" and (found := self._read_segments(bucket, path)):
+            file = SegmentObjectFile(*found)
+        else:
+            if mode == "r":
+                path = get_read_path(path)
+            file = self.open_file(path, mode)
+
+        return PersistedS3StoredObject(s3_object, self, path, file, mode)
 
     def remove(self, bucket: BucketName, s3_object: S3Object | list[S3Object]):
         s3_objects = s3_object if isinstance(s3_object, list) else [s3_object]
+        segments = self._segments(bucket)
 
+        paths = []
+        # paths of objects that were removed without needing their file to be moved to the trash
+        removed = set[str]()
         for s3_object in s3_objects:
             path = self._object_path(bucket, s3_object)
-            os.unlink(path)
+            paths.append(path)
+            self._read_files.invalidate(path)
+            if self._discard_small_object_writers(path):
+                removed.add(path)
+            if segments is not None and segments.delete(os.path.basename(path)):
+                removed.add(path)
+
+        for path in TRASH_REAPER.move_all_to_trash(paths):
+            # objects that are only in the base layer don't need removing, as objects are only ever read
+            # from the base layer while they're still in the S3 store's state
+            if path not in removed and get_read_path(path) == path:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
 
     def copy(
         self,
@@ -263,8 +345,24 @@ class PersistedS3ObjectStore(S3ObjectStore):
     ) -> PersistedS3StoredObject:
         src_path = self._object_path(src_bucket, src_object)
         dest_path = self._object_path(dest_bucket, dest_object)
-        if src_path != dest_path:
+        src_segments = self._segments(src_bucket)
+
+        if src_path == dest_path:
+            pass
+        elif (
+            PERSIST_S3_SMALL_OBJECT_THRESHOLD > 0
+            or (src_segments is not None and os.path.basename(src_path) in src_segments)
+            or get_read_path(src_path) != src_path
+        ):
+            with self.open(src_bucket, src_object, "r") as src_stored_object:
+                with self.open(dest_bucket, dest_object, "w") as dest_stored_object:
+                    dest_stored_object.write(src_stored_object)
+        else:
+            break_hardlink(dest_path)
             shutil.copy(src_path, dest_path)
+            self._commit_file(dest_path, fsync_file=True)
+            if (dest_segments := self._segments(dest_bucket)) is not None:
+                dest_segments.delete(os.path.basename(dest_path))
 
         return self.open(dest_bucket, dest_object, "r")
 
@@ -276,29 +374,146 @@ class PersistedS3ObjectStore(S3ObjectStore):
         return PersistedS3StoredMultipart(self, bucket, upload_id)
 
     def remove_multipart(self, bucket: BucketName, s3_multipart: S3Multipart):
-        rm_rf(self._multipart_path(bucket, s3_multipart.id))
+        path = self._multipart_path(bucket, s3_multipart.id)
+        self._read_files.invalidate_dir(path)
+        if os.path.exists(path):
+            TRASH_REAPER.move_to_trash(path)
 
     def create_bucket(self, bucket: BucketName):
         mkdir(self._bucket_path(bucket))
 
     def delete_bucket(self, bucket: BucketName):
-        rm_rf(self._bucket_path(bucket))
+        path = self._bucket_path(bucket)
+        self._read_files.invalidate_dir(path)
+        close_segment_store(path)
+        if os.path.exists(path):
+            TRASH_REAPER.move_to_trash(path)
 
     def open_file(self, path: str, mode: Literal["r", "w"]) -> BinaryIO:
-        file = open(path, mode + "b")
-        with self._open_files_lock:
-            self._open_files.add(file)
+        if mode == "r":
+            return self._read_files.acquire(path)
+
+        self._read_files.invalidate(path)
+        break_hardlink(path)
+        if PERSIST_BASE_LAYER:
+            # the bucket may so far only exist in the base layer
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = open(path, "wb")
+        self._write_files.add(file)
         return file
 
-    def close_file(self, file: BinaryIO):
-        with self._open_files_lock:
+    def close_file(self, path: str, file: BinaryIO, mode: Literal["r", "w"]):
+        if isinstance(file, SegmentObjectFile):
+            file.close()
+        elif mode == "r":
+            self._read_files.release(path, file)
+        elif isinstance(file, SmallObjectWriter):
+            self._close_small_object_writer(path, file)
+        else:
+            self._close_write_file(path, file)
+
+    def _close_write_file(self, path: str, file: BinaryIO):
+        try:
+            if PERSIST_S3_DURABILITY == S3Durability.ALWAYS and not file.closed:
+                file.flush()
+                os.fsync(file.fileno())
+        finally:
             file.close()
-            self._open_files.discard(file)
+            self._write_files.discard(file)
+
+        self._commit_file(path)
+
+    # Makes a newly-written file durable according to PERSIST_S3_DURABILITY. With "always", the file's data must
+    # already have been fsynced, unless `fsync_file` is set.
+    def _commit_file(self, path: str, fsync_file: bool = False):
+        if PERSIST_S3_DURABILITY == S3Durability.ALWAYS:
+            if fsync_file:
+                fsync_path(path)
+            fsync_path(os.path.dirname(path), is_dir=True)
+        elif self._committer:
+            self._committer.commit(path)
 
     def flush(self):
-        with self._open_files_lock:
-            for f in self._open_files:
-                f.flush()
+        self._write_files.flush()
+
+    # Flushes written files and closes all cached file handles, e.g. before the object files are replaced by a
+    # snapshot, so that later reads open the new files
+    def release_files(self):
+        self.flush()
+        self._read_files.clear()
+        close_segment_stores(self.root_directory)
+
+    def close(self):
+        self.flush()
+        if self._committer:
+            self._committer.stop()
+        self._read_files.clear()
+
+    def _segments(self, bucket: BucketName) -> Optional[SegmentStore]:
+        return get_segment_store(
+            self._bucket_path(bucket), create=PERSIST_S3_SMALL_OBJECT_THRESHOLD > 0
+        )
+
+    # Reads an object from the bucket's segments if it's in them, or from the base layer's segments if the object
+    # hasn't been written since the base layer was created
+    def _read_segments(
+        self, bucket: BucketName, path: str
+    ) -> Optional[tuple[bytes, int]]:
+        name = os.path.basename(path)
+        if (segments := self._segments(bucket)) is not None and (
+            found := segments.read(name)
+        ):
+            return found
+
+        base_layer_bucket_path = get_base_layer_path(self._bucket_path(bucket))
+        if (
+            base_layer_bucket_path
+            and not os.path.exists(path)
+            and (base_segments := get_read_only_segment_store(base_layer_bucket_path))
+            is not None
+        ):
+            return base_segments.read(name)
+        return None
+
+    def _close_small_object_writer(self, path: str, writer: SmallObjectWriter):
+        with self._small_object_writers_lock:
+            if writers := self._small_object_writers.get(path):
+                writers.discard(writer)
+                if not writers:
+                    del self._small_object_writers[path]
+
+        bucket_dir, name = os.path.split(path)
+        segments = get_segment_store(bucket_dir, create=True)
+        assert segments is not None
+
+        if writer.file:
+            # object was too large for a segment, so was written to its own file
+            self._close_write_file(path, writer.file)
+            if not writer.discarded:
+                segments.delete(name)
+        elif not writer.discarded:
+            segment_path = segments.put(name, writer.getvalue(), writer.mtime_ns)
+            if PERSIST_S3_DURABILITY == S3Durability.ALWAYS:
+                fsync_path(segment_path)
+            elif self._committer:
+                self._committer.commit(segment_path)
+
+            # remove any previous version of the object that was too large for a segment
+            if os.path.exists(path):
+                self._read_files.invalidate(path)
+                try:
+                    TRASH_REAPER.move_to_trash(path)
+                except FileNotFoundError:
+                    pass
+
+        writer.close()
+
+    def _discard_small_object_writers(self, path: str) -> bool:
+        with self._small_object_writers_lock:
+            writers = self._small_object_writers.get(path, set())
+            for writer in writers:
+                writer.discarded = True
+            return bool(writers)
 
     def _bucket_path(self, bucket: BucketName) -> str:
         return os.path.join(self.root_directory, bucket)
@@ -0,0 +1,126 @@
+import logging
+import os
+import shutil
+import time
+import uuid
+from threading import Condition, Thread
+
+from ..config import BASE_DIR, PERSIST_S3_DELETE_RATE
+from ..metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+TRASH_DIR = os.path.join(BASE_DIR, "s3", ".trash")
+
+# How often the reaper checks whether it's deleting files faster than PERSIST_S3_DELETE_RATE
+THROTTLE_INTERVAL = 0.1
+
+
+# Deleted S3 files/directories are atomically renamed into TRASH_DIR, and then removed in the background at a
+# throttled rate, so that deleting even huge buckets takes constant time on the request thread. Anything left
+# in TRASH_DIR (e.g. after a restart) is removed once the reaper starts.
+class TrashReaper:
+    def __init__(self, trash_dir: str, rate: float):
+        self.trash_dir = trash_dir
+        self.rate = rate
+        self._cond = Condition()
+        self._thread: Thread | None = None
+        self._window_start = 0.0
+        self._window_count = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread:
+                return
+            self._thread = Thread(target=self._run, name="s3-trash-reaper", daemon=True)
+            self._thread.start()
+
+    def move_to_trash(self, path: str):
+        os.makedirs(self.trash_dir, exist_ok=True)
+        os.rename(path, os.path.join(self.trash_dir, uuid.uuid4().hex))
+        self._notify_moved(1)
+
+    # Moves many files/directories to the trash at once (e.g. for DeleteObjects), returning the paths that don't
+    # exist. The reaper is only woken once, and the moved files share a single generated name prefix.
+    def move_all_to_trash(self, paths: list[str]) -> list[str]:
+        os.makedirs(self.trash_dir, exist_ok=True)
+        prefix = os.path.join(self.trash_dir, uuid.uuid4().hex)
+        missing = []
+        for i, path in enumerate(paths):
+            try:
+                os.rename(path, f"{prefix}-{i}")
+            except FileNotFoundError:
+                missing.append(path)
+
+        self._notify_moved(len(paths) - len(missing))
+        return missing
+
+    def _notify_moved(self, count: int):
+        if not count:
+            return
+        METRICS.increment("s3.trash.moved", count)
+        with self._cond:
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            try:
+                with os.scandir(self.trash_dir) as it:
+                    entries = [entry.path for entry in it]
+            except FileNotFoundError:
+                entries = []
+
+            if not entries:
+                with self._cond:
+                    self._cond.wait(60)
+                continue
+
+            for path in entries:
+                try:
+                    self._remove(path)
+                except:
+                    LOG.exception("Error while removing deleted S3 files at %s", path)
+                    # avoid spinning if the error is persistent
+                    time.sleep(1)
+
+    def _remove(self, path: str):
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+        if not os.path.isdir(path) or os.path.islink(path):
+            self._unlink(path)
+            return
+
+        for dir_path, dir_names, file_names in os.walk(path, topdown=False):
+            for name in file_names:
+                self._unlink(os.path.join(dir_path, name))
+            for name in dir_names:
+                dir = os.path.join(dir_path, name)
+                if os.path.islink(dir):
+                    self._unlink(dir)
+                else:
+                    os.rmdir(dir)
+
+        shutil.rmtree(path, ignore_errors=True)
+
+    def _unlink(self, path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        METRICS.increment("s3.trash.reaped")
+
+        if self.rate <= 0:
+            return
+
+        self._window_count += 1
+        if self._window_count >= self.rate * THROTTLE_INTERVAL:
+            elapsed = time.monotonic() - self._window_start
+            if elapsed < THROTTLE_INTERVAL:
+                time.sleep(THROTTLE_INTERVAL - elapsed)
+            self._window_start = time.monotonic()
+            self._window_count = 0
+
+
+TRASH_REAPER = TrashReaper(TRASH_DIR, PERSIST_S3_DELETE_RATE)
@@ -1,17 +1,31 @@
+import logging
 import os
-from typing import Any, Protocol
+import time
+from typing import Any, Optional, Protocol
 from .jsonpickle.serializer import JsonPickleSerializer, JsonPickleDeserializer
 from .pickle.serializer import PickleSerializer, PickleDeserializer
-from ..config import SerializationFormat, PERSIST_FORMATS
+from ..config import SerializationFormat, PERSIST_FORMATS, get_persist_formats
+from ..manifest import get_service_manifest
+from ..metrics import METRICS
+from ..utils import file_digest
+
+LOG = logging.getLogger(__name__)
 
 
 class Serializer(Protocol):
+    ser_version: int
+    file_path: str
+    # digest of the file written by the last call to `serialize`
+    digest: Optional[str]
+
     def __init__(self, service_name: str, file_path: str): ...
 
     def serialize(self, data: Any): ...
 
 
 class Deserializer(Protocol):
+    file_path: str
+
     def __init__(self, service_name: str, file_path: str): ...
 
     def deserialize(self) -> Any: ...
@@ -22,20 +36,45 @@ serializer_types: dict[SerializationFormat, type[Serializer]] = {
     SerializationFormat.BINARY: PickleSerializer,
 }
 
+serializer_formats = {type: format for format, type in serializer_types.items()}
+
 deserializer_types: dict[SerializationFormat, type[Deserializer]] = {
     SerializationFormat.JSON: JsonPickleDeserializer,
     SerializationFormat.BINARY: PickleDeserializer,
 }
 
 
-def get_serializers(service_name: str, file_path_base: str):
+# Returns the formats that a state file should be saved in. When the format is chosen automatically, this is
+# the format most recently chosen for the state file, as recorded in the service manifest.
+def get_formats(service_name: str, file_path_base: str) -> list[SerializationFormat]:
+    if (formats := get_persist_formats(service_name)) is not None:
+        return formats
+    if choice := get_service_manifest(service_name).get_format_choice(
+        os.path.basename(file_path_base)
+    ):
+        return [SerializationFormat[choice["format"]]]
+    return PERSIST_FORMATS
+
+
+def get_serializers(
+    service_name: str,
+    file_path_base: str,
+    formats: Optional[list[SerializationFormat]] = None,
+):
     return [
         serializer_types[format](service_name, file_path_base + format.file_ext())
-        for format in PERSIST_FORMATS
+        for format in formats or get_formats(service_name, file_path_base)
     ]
 
 
 def get_deserializer(service_name: str, file_path_base: str):
+    if format := get_manifest_format(service_name, file_path_base):
+        return deserializer_types[format](
+            service_name, file_path_base + format.file_ext()
+        )
+
+    formats = get_formats(service_name, file_path_base)
+
     def get_score(format: SerializationFormat) -> list[float]:
         try:
             # Prefer most-recently updated file
@@ -46,7 +85,7 @@ def get_deserializer(service_name: str, file_path_base: str):
         try:
             # For files with identical mtime, prefer deserializer for enabled format.
             # With multiple enabled formats, prefer last one (which typically gets written last).
-            return [mtime, PERSIST_FORMATS.index(format)]
+            return [mtime, formats.index(format)]
         except ValueError:
             return [mtime]
 
@@ -65,3 +104,106 @@ def get_deserializer(service_name: str, file_path_base: str):
     return deserializer_types[best_format](
         service_name, file_path_base + best_format.file_ext()
     )
+
+
+def describe_type(state: Any) -> str:
+    def name(t: type) -> str:
+        return f"{t.__module__}.{t.__qualname__}"
+
+    if isinstance(store_type := getattr(state, "store", None), type):
+        # AccountRegionBundle
+        return f"{name(type(state))}[{name(store_type)}]"
+    return name(type(state))
+
+
+# Returns the entry to record in the service manifest for state that has just been saved by `serializers`
+def describe_saved_state(
+    state: Any, serializers: list[Serializer], duration_ms: float
+) -> dict[str, Any]:
+    files = []
+    for serializer in serializers:
+        stat = os.stat(serializer.file_path)
+        files.append(
+            {
+                "format": serializer_formats[type(serializer)].name,
+                "ser_version": serializer.ser_version,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "digest": serializer.digest or file_digest(serializer.file_path),
+            }
+        )
+
+    return {
+        "container_type": describe_type(state),
+        "saved_at": time.time(),
+        "save_duration_ms": round(duration_ms, 3),
+        "files": files,
+    }
+
+
+# Uses the service manifest to pick which file to load, without needing to compare every file's mtime.
+# Files are validated against the size and modification time recorded in the manifest, and only hashed to
+# compare against the recorded digest if their modification time differs (e.g. if they were copied without
+# preserving it), so that a file which was changed without updating the manifest (e.g. if saving was interrupted)
+# is never trusted.
+def matches_manifest_file(file: dict, path: str) -> bool:
+    stat = os.stat(path)
+    return stat.st_size == file["size"] and (
+        stat.st_mtime_ns == file.get("mtime_ns") or file_digest(path) == file["digest"]
+    )
+
+
+# Whether the state file at `file_path` is the one described by the service manifest, so that other details
+# recorded in the manifest (e.g. which fixups have been applied) can be trusted to apply to its contents
+def is_manifest_state_file(service_name: str, file_path: str) -> bool:
+    file_path_base, ext = os.path.splitext(file_path)
+    entry = get_service_manifest(service_name).get_state_file(
+        os.path.basename(file_path_base)
+    )
+    for file in entry.get("files", []) if entry else []:
+        try:
+            if SerializationFormat[
+                file["format"]
+            ].file_ext() == ext and matches_manifest_file(file, file_path):
+                return True
+        except (KeyError, OSError):
+            pass
+    return False
+
+
+def get_manifest_format(
+    service_name: str, file_path_base: str
+) -> Optional[SerializationFormat]:
+    entry = get_service_manifest(service_name).get_state_file(
+        os.path.basename(file_path_base)
+    )
+    if not entry:
+        return None
+
+    formats = get_formats(service_name, file_path_base)
+
+    def preference(file: dict) -> int:
+        try:
+            return formats.index(SerializationFormat[file["format"]])
+        except (KeyError, ValueError):
+            return -1
+
+    # All files from a single save have the same content, so prefer the last enabled format as when probing
+    for file in sorted(entry.get("files", []), key=preference, reverse=True):
+        path = None
+        try:
+            format = SerializationFormat[file["format"]]
+            path = file_path_base + format.file_ext()
+            if matches_manifest_file(file, path):
+                METRICS.increment("manifest.hits")
+                return format
+        except (KeyError, OSError):
+            pass
+
+        LOG.warning(
+            "Persisted state file %s doesn't match the service manifest - ignoring it",
+            path or file_path_base,
+        )
+
+    METRICS.increment("manifest.misses")
+    return None
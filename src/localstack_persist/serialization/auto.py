@@ -0,0 +1,113 @@
+import logging
+import os
+import tempfile
+import time
+import warnings
+from threading import Lock
+from typing import Any
+
+from ..config import SerializationFormat, PERSIST_FORMATS
+from ..manifest import get_service_manifest
+from ..metrics import METRICS
+from . import deserializer_types, describe_type, serializer_types
+
+LOG = logging.getLogger(__name__)
+
+# State files whose format has already been chosen since LocalStack started
+_chosen = set[str]()
+_chosen_lock = Lock()
+
+
+# Chooses the format to save a state file in, if it hasn't already been chosen since LocalStack started, and
+# records the choice in the service manifest. Formats are chosen by saving and loading the state with every
+# serializer, so this is only done once per state file each time LocalStack starts, as the state may have changed
+# considerably since the format was last chosen.
+def choose_format(service_name: str, file_path_base: str, state: Any):
+    with _chosen_lock:
+        if file_path_base in _chosen:
+            return
+        _chosen.add(file_path_base)
+
+    measurements = {
+        format.name: measure_format(service_name, format, state)
+        for format in SerializationFormat
+    }
+    format = pick_format(measurements)
+
+    LOG.info(
+        "Chose %s serialization format for %s (%s)",
+        format.name.lower(),
+        file_path_base,
+        ", ".join(
+            f"{name.lower()}: {m['serialize_ms'] + m['deserialize_ms']:.0f} ms, {m['size']} bytes"
+            + ("" if m["reliable"] else " (unreliable)")
+            for name, m in measurements.items()
+        ),
+    )
+    METRICS.increment("serialization.formats_chosen")
+
+    get_service_manifest(service_name).set_format_choice(
+        os.path.basename(file_path_base),
+        {
+            "format": format.name,
+            "container_type": describe_type(state),
+            "chosen_at": time.time(),
+            "measurements": measurements,
+        },
+    )
+
+
+# Saves and loads state with the given format's serializer. The format is unreliable for the state if it can't
+# be loaded, if jsonpickle warns that an object couldn't be serialized (so would be lost), or if pickling needs
+# the slower "dill" fallback.
+def measure_format(
+    service_name: str, format: SerializationFormat, state: Any
+) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "state" + format.file_ext())
+        serializer = serializer_types[format](service_name, path)
+
+        start = time.perf_counter()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            serializer.serialize(state)
+        serialize_ms = (time.perf_counter() - start) * 1000
+        size = os.path.getsize(path)
+        reliable = not caught and not getattr(serializer, "used_fallback", False)
+
+        start = time.perf_counter()
+        try:
+            deserializer_types[format](service_name, path).deserialize()
+            loaded = True
+        except:
+            LOG.debug(
+                "Failed to load state saved in %s format", format.name, exc_info=True
+            )
+            loaded = False
+        deserialize_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "serialize_ms": round(serialize_ms, 3),
+        "deserialize_ms": round(deserialize_ms, 3),
+        "size": size,
+        "loaded": loaded,
+        "reliable": reliable and loaded,
+    }
+
+
+# Picks the format that's quickest to save and load (then the smallest), preferring reliable formats
+def pick_format(measurements: dict[str, dict[str, Any]]) -> SerializationFormat:
+    def cost(name: str) -> tuple:
+        m = measurements[name]
+        return (
+            not m["reliable"],
+            not m["loaded"],
+            m["serialize_ms"] + m["deserialize_ms"],
+            m["size"],
+        )
+
+    best = min(measurements, key=cost)
+    if not measurements[best]["loaded"]:
+        # the state can't be round-tripped at all, so the choice of format won't help
+        return PERSIST_FORMATS[0]
+    return SerializationFormat[best]
@@ -7,6 +7,7 @@ import jsonpickle.tags
 import jsonpickle.util
 from jsonpickle.handlers import DatetimeHandler as DefaultDatetimeHandler
 from moto.acm.models import CertBundle
+from localstack.services.sqs.models import FifoQueue, StandardQueue
 from localstack.utils.patch import patch
 from localstack.services.cloudformation.engine.v2.change_set_model import (
     Nothing,
@@ -15,6 +16,7 @@ from localstack.services.cloudformation.engine.v2.change_set_model import (
 
 from localstack_persist.utils import once
 from ..utils import compat_module_path
+from ...sqs.queues import get_queue_state
 
 
 @once
@@ -26,6 +28,8 @@ def register_handlers():
     DatetimeHandler.handles(datetime.date)
     DatetimeHandler.handles(datetime.time)
     NothingHandler.handles(NothingType)
+    SqsQueueHandler.handles(StandardQueue)
+    SqsQueueHandler.handles(FifoQueue)
 
     # jsonpickle doesn't expose a hook like Unpickler.find_class(),
     # so we patch untranslate_module_name for the same effect.
@@ -117,3 +121,28 @@ class NothingHandler(jsonpickle.handlers.BaseHandler):
 
     def restore(self, obj: dict):
         return Nothing
+
+
+# Omits messages from SQS queues when they're persisted separately in message logs
+class SqsQueueHandler(jsonpickle.handlers.BaseHandler):
+    def flatten(self, obj: StandardQueue | FifoQueue, data: dict):
+        data.update(
+            {
+                k: self.context.flatten(v, reset=False)
+                for k, v in get_queue_state(obj).items()
+            }
+        )
+        return data
+
+    def restore(self, obj: dict):
+        cls_name: str = obj[jsonpickle.tags.OBJECT]
+        cls = FifoQueue if cls_name.endswith("FifoQueue") else StandardQueue
+        queue = cls.__new__(cls)
+        queue.__dict__.update(
+            {
+                k: self.context.restore(v, reset=False)
+                for k, v in obj.items()
+                if k not in jsonpickle.tags.RESERVED
+            }
+        )
+        return queue
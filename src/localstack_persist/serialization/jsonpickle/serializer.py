@@ -1,10 +1,11 @@
 import json
 import logging
-from typing import Any
+from typing import Any, Optional
 import jsonpickle
 
 
 from .handlers import register_handlers
+from ...utils import HashingWriter, atomic_write
 
 # Track version for future handling of backward (or forward) incompatible changes.
 # This is the "serialisation format" version, which is different to the localstack-persist version.
@@ -17,10 +18,13 @@ LOG = logging.getLogger(__name__)
 
 
 class JsonPickleSerializer:
+    ser_version = SER_VERSION
     _json_encoder = json.JSONEncoder(check_circular=False, separators=(",", ":"))
 
     def __init__(self, service_name: str, file_path: str) -> None:
         self.file_path = file_path
+        # digest of the file written by the last call to `serialize`
+        self.digest: Optional[str] = None
 
     def serialize(self, data: Any):
         register_handlers()
@@ -29,9 +33,11 @@ class JsonPickleSerializer:
 
         envelope = {SER_VERSION_KEY: SER_VERSION, DATA_KEY: pickler.flatten(data)}
 
-        with open(self.file_path, "w") as file:
+        with atomic_write(self.file_path, "w") as file:
+            writer = HashingWriter(file)
             for chunk in self._json_encoder.iterencode(envelope):
-                file.write(chunk)
+                writer.write(chunk)
+        self.digest = writer.hexdigest()
 
 
 class JsonPickleDeserializer:
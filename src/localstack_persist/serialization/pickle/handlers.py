@@ -2,11 +2,14 @@ from queue import Queue, PriorityQueue, LifoQueue
 from threading import RLock, Lock
 from typing import cast
 from moto.acm.models import CertBundle
+from localstack.services.sqs.models import FifoQueue, SqsQueue, StandardQueue
 import pickle
 import dill
 import copyreg
 
 from ..utils import compat_module_path
+from ...config import PERSIST_SQS_MESSAGE_LOG
+from ...sqs.queues import get_queue_state
 
 # This module, and all of the unpickle_* functions in it, must not be moved/renamed,
 # because pickle-serialized data must be able to load them.
@@ -45,6 +48,18 @@ def unpickle_cert_bundle(state: dict) -> CertBundle:
     return obj
 
 
+def reduce_sqs_queue(queue: SqsQueue):
+    if not PERSIST_SQS_MESSAGE_LOG:
+        return queue.__reduce_ex__(pickle.DEFAULT_PROTOCOL)
+    return unpickle_sqs_queue, (type(queue), get_queue_state(queue))
+
+
+def unpickle_sqs_queue(cls: type[SqsQueue], state: dict) -> SqsQueue:
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
+
+
 custom_dispatch_table = {
     type(Lock()): reduce_lock,
     type(RLock()): reduce_rlock,
@@ -52,6 +67,8 @@ custom_dispatch_table = {
     PriorityQueue: reduce_queue,
     LifoQueue: reduce_queue,
     CertBundle: reduce_cert_bundle,
+    StandardQueue: reduce_sqs_queue,
+    FifoQueue: reduce_sqs_queue,
 }
 
 custom_dispatch = type(dill.Pickler.dispatch)(
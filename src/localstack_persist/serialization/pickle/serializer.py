@@ -1,5 +1,5 @@
 import logging
-from typing import Any, Tuple
+from typing import Any, Optional, Tuple
 
 from .handlers import (
     CustomPickler,
@@ -7,9 +7,12 @@ from .handlers import (
     CustomUnpickler,
     CustomDillUnpickler,
 )
+from ...utils import HashingWriter, atomic_write
 
 PICKLE_MARKER = b"p"
 DILL_PICKLE_MARKER = b"d"
+# Recorded in the service manifest, for future handling of backward (or forward) incompatible changes
+SER_VERSION = 1
 
 LOG = logging.getLogger(__name__)
 
@@ -17,19 +20,27 @@ DILL_TYPES = set[Tuple[str, type]]()
 
 
 class PickleSerializer:
+    ser_version = SER_VERSION
+
     def __init__(self, service_name: str, file_path: str):
         self.service_name = service_name
         self.file_path = file_path
+        # whether the last call to `serialize` needed the slower "dill" pickler
+        self.used_fallback = False
+        # digest of the file written by the last call to `serialize`
+        self.digest: Optional[str] = None
 
     def serialize(self, data: Any):
-        with open(self.file_path, "wb") as file:
-            if (self.service_name, type(data)) in DILL_TYPES:
-                file.write(DILL_PICKLE_MARKER)
-                pickler = CustomDillPickler(file)
+        self.used_fallback = (self.service_name, type(data)) in DILL_TYPES
+        with atomic_write(self.file_path, "wb") as file:
+            writer = HashingWriter(file)
+            if self.used_fallback:
+                writer.write(DILL_PICKLE_MARKER)
+                pickler = CustomDillPickler(writer)
                 pickler.dump(data)
             else:
-                file.write(PICKLE_MARKER)
-                pickler = CustomPickler(file)
+                writer.write(PICKLE_MARKER)
+                pickler = CustomPickler(writer)
                 try:
                     pickler.dump(data)
                 except:
@@ -39,11 +50,13 @@ class PickleSerializer:
                         exc_info=True,
                     )
                     DILL_TYPES.add((self.service_name, type(data)))
-                    file.seek(0)
-                    file.write(DILL_PICKLE_MARKER)
-                    pickler = CustomDillPickler(file)
+                    self.used_fallback = True
+                    writer.seek(0)
+                    writer.write(DILL_PICKLE_MARKER)
+                    pickler = CustomDillPickler(writer)
                     pickler.dump(data)
-                    file.truncate()
+                    writer.truncate()
+        self.digest = writer.hexdigest()
 
 
 class PickleDeserializer:
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from threading import Thread
+from typing import Any, Optional
+
+from .config import BASE_DIR, PERSIST_SNAPSHOT_GENERATIONS
+from .layers import forget_base_layer_hidden
+from .metrics import METRICS
+from .s3.segments import SEGMENTS_DIR_NAME
+from .sqs.message_log import MESSAGE_LOGS_DIR_NAME
+
+LOG = logging.getLogger(__name__)
+
+SNAPSHOTS_DIR = os.path.join(BASE_DIR, "_snapshots")
+SNAPSHOT_INFO_FILE_NAME = "snapshot.json"
+
+# Files in these directories are modified in place rather than being replaced, so they're copied into snapshots
+# instead of being hardlinked
+COPIED_DIR_NAMES = {SEGMENTS_DIR_NAME, MESSAGE_LOGS_DIR_NAME}
+# Directories that are never included in snapshots
+SKIPPED_DIR_NAMES = {".trash"}
+
+valid_snapshot_name = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,127}$")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotNotFoundError(SnapshotError):
+    pass
+
+
+def get_snapshot_path(name: str) -> str:
+    if not valid_snapshot_name.match(name):
+        raise SnapshotError(f"Invalid snapshot name '{name}'")
+    return os.path.join(SNAPSHOTS_DIR, name)
+
+
+# Returns the names of all services with persisted state. Directories starting with "_" or "." hold internal
+# data (such as snapshots) rather than a service's state.
+def list_service_dirs() -> list[str]:
+    if not os.path.isdir(BASE_DIR):
+        return []
+    with os.scandir(BASE_DIR) as it:
+        return sorted(
+            entry.name
+            for entry in it
+            if entry.is_dir() and not entry.name.startswith(("_", "."))
+        )
+
+
+def get_snapshot(name: str) -> dict[str, Any]:
+    info_path = os.path.join(get_snapshot_path(name), SNAPSHOT_INFO_FILE_NAME)
+    try:
+        with open(info_path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        raise SnapshotNotFoundError(f"Snapshot '{name}' does not exist")
+
+
+def list_snapshots() -> list[dict[str, Any]]:
+    if not os.path.isdir(SNAPSHOTS_DIR):
+        return []
+
+    snapshots = []
+    for name in os.listdir(SNAPSHOTS_DIR):
+        if name.startswith("."):
+            continue
+        try:
+            snapshots.append(get_snapshot(name))
+        except SnapshotError:
+            LOG.warning("Ignoring invalid snapshot %s", name)
+    return sorted(snapshots, key=lambda s: s["created_at"])
+
+
+# Creates a snapshot of the persisted data of the given services. Files are hardlinked rather than copied, which
+# is safe because persisted files are always replaced rather than modified in place (other than those in
+# COPIED_DIR_NAMES), so creating a snapshot takes time proportional to the number of files rather than their size.
+def create_snapshot(name: Optional[str], services: list[str]) -> dict[str, Any]:
+    name = name or time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    path = get_snapshot_path(name)
+    if os.path.exists(path):
+        raise SnapshotError(f"Snapshot '{name}' already exists")
+
+    start = time.perf_counter()
+    tmp_path = os.path.join(SNAPSHOTS_DIR, f".{name}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    files = 0
+    for service_name in services:
+        files += link_tree(
+            os.path.join(BASE_DIR, service_name), os.path.join(tmp_path, service_name)
+        )
+
+    info = {"name": name, "created_at": time.time(), "services": services}
+    with open(os.path.join(tmp_path, SNAPSHOT_INFO_FILE_NAME), "w") as file:
+        json.dump(info, file, indent=2)
+    # snapshots only become visible once complete
+    os.rename(tmp_path, path)
+
+    duration_ms = (time.perf_counter() - start) * 1000
+    METRICS.histogram("snapshots.create_duration_ms").record(duration_ms)
+    LOG.info(
+        "Created snapshot %s of %d services (%d files) in %.0f ms",
+        name,
+        len(services),
+        files,
+        duration_ms,
+    )
+
+    prune_snapshots(PERSIST_SNAPSHOT_GENERATIONS)
+    return info
+
+
+def delete_snapshot(name: str):
+    get_snapshot(name)
+    remove_in_background(get_snapshot_path(name))
+
+
+# Removes the oldest snapshots so that at most `generations` remain
+def prune_snapshots(generations: int):
+    snapshots = list_snapshots()
+    for snapshot in snapshots[: max(0, len(snapshots) - generations)]:
+        LOG.info("Removing old snapshot %s", snapshot["name"])
+        remove_in_background(get_snapshot_path(snapshot["name"]))
+
+
+# Replaces the persisted data of a service with its data from a snapshot (or with nothing, if the service had no
+# persisted data when the snapshot was taken). The new directory is built alongside the current one and swapped
+# in with renames, and the old directory is removed in the background.
+def restore_service_dir(snapshot_name: str, service_name: str):
+    src = os.path.join(get_snapshot_path(snapshot_name), service_name)
+    dst = os.path.join(BASE_DIR, service_name)
+    new_path = os.path.join(SNAPSHOTS_DIR, f".restore-{service_name}")
+    shutil.rmtree(new_path, ignore_errors=True)
+
+    if os.path.isdir(src):
+        link_tree(src, new_path)
+    if os.path.exists(dst):
+        remove_in_background(dst)
+    if os.path.isdir(new_path):
+        os.rename(new_path, dst)
+    forget_base_layer_hidden(service_name)
+
+
+# Removes anything left behind by snapshot operations that were interrupted by a restart
+def remove_incomplete_snapshots():
+    if not os.path.isdir(SNAPSHOTS_DIR):
+        return
+    for name in os.listdir(SNAPSHOTS_DIR):
+        if name.startswith("."):
+            shutil.rmtree(os.path.join(SNAPSHOTS_DIR, name), ignore_errors=True)
+
+
+# Recreates the directory tree `src` at `dst`, hardlinking files where possible. Returns the number of files.
+def link_tree(src: str, dst: str) -> int:
+    files = 0
+    for dir_path, dir_names, file_names in os.walk(src):
+        dir_names[:] = [d for d in dir_names if d not in SKIPPED_DIR_NAMES]
+        dst_dir = os.path.join(dst, os.path.relpath(dir_path, src))
+        os.makedirs(dst_dir, exist_ok=True)
+        copy = os.path.basename(dir_path) in COPIED_DIR_NAMES
+
+        for name in file_names:
+            # temporary files are only ever partially written
+            if name.endswith(".tmp"):
+                continue
+            src_path = os.path.join(dir_path, name)
+            dst_path = os.path.join(dst_dir, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif copy or not _try_link(src_path, dst_path):
+                shutil.copy2(src_path, dst_path)
+            files += 1
+
+    return files
+
+
+def _try_link(src: str, dst: str) -> bool:
+    try:
+        os.link(src, dst)
+        return True
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # e.g. the filesystem doesn't support hardlinks
+        METRICS.increment("snapshots.files_copied")
+        return False
+
+
+def remove_in_background(path: str):
+    # rename first so that the path can be reused immediately, even if removing it takes a while
+    trash_path = os.path.join(SNAPSHOTS_DIR, f".old-{uuid.uuid4().hex}")
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    os.rename(path, trash_path)
+    Thread(
+        target=shutil.rmtree,
+        args=(trash_path,),
+        kwargs={"ignore_errors": True},
+        name="snapshot-remover",
+        daemon=True,
+    ).start()
@@ -0,0 +1,72 @@
+import logging
+import os
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Files that SQLite keeps alongside a database, whose contents are included in a backup of the database
+SQLITE_SIDECAR_SUFFIXES = ("-wal", "-shm", "-journal")
+# How long, in seconds, to wait for a lock on a database that's being written to
+BUSY_TIMEOUT = 5
+
+
+def is_sqlite_file(path: str) -> bool:
+    try:
+        with open(path, "rb") as file:
+            return file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except IsADirectoryError:
+        return False
+
+
+# Returns the path of the database that `path` is a sidecar file of, if any
+def sqlite_sidecar_base(path: str) -> Optional[str]:
+    for suffix in SQLITE_SIDECAR_SUFFIXES:
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return None
+
+
+# Copies a consistent snapshot of the SQLite database at `src` (including any committed transactions that are
+# still in its write-ahead log) to `dst`, using SQLite's online backup API. Unlike copying the file directly,
+# this can't produce a torn copy if the database is written to at the same time.
+# Every backup is a full copy of the database. Databases that haven't changed since they were last persisted aren't
+# backed up again at all, but copying only the changed pages of one that has would need the `sqlite_dbpage`
+# extension (which Python's SQLite isn't built with), and would mean updating `dst` in place, which isn't atomic
+# and would also change any snapshot hardlinking it.
+# Returns False if `src` couldn't be backed up, e.g. because it's not actually a valid database.
+def backup_sqlite(src: str, dst: str) -> bool:
+    tmp_path = dst + ".tmp"
+    try:
+        src_conn = sqlite3.connect(
+            Path(os.path.abspath(src)).as_uri() + "?mode=ro",
+            uri=True,
+            timeout=BUSY_TIMEOUT,
+        )
+        try:
+            dst_conn = sqlite3.connect(tmp_path)
+            try:
+                src_conn.backup(dst_conn)
+            finally:
+                dst_conn.close()
+        finally:
+            src_conn.close()
+    except sqlite3.Error as e:
+        LOG.warning("Unable to back up SQLite database %s: %s", src, e)
+        for path in (tmp_path, tmp_path + "-journal"):
+            if os.path.exists(path):
+                os.remove(path)
+        return False
+
+    os.replace(tmp_path, dst)
+    # the backup includes everything from any previously-copied sidecar files, which would now be stale
+    for suffix in SQLITE_SIDECAR_SUFFIXES:
+        if os.path.lexists(dst + suffix):
+            os.remove(dst + suffix)
+
+    METRICS.increment("assets.sqlite_backups")
+    return True
@@ -0,0 +1,267 @@
+import io
+import json
+import logging
+import os
+import shutil
+import struct
+import zlib
+from threading import Lock
+from typing import BinaryIO, Iterator
+
+from localstack.services.sqs.models import SqsMessage, SqsQueue, SqsStore
+from localstack.services.stores import AccountRegionBundle
+
+from ..config import BASE_DIR
+from ..layers import get_base_layer_path, get_read_path
+from ..metrics import METRICS
+from ..serialization.pickle.handlers import (
+    CustomDillPickler,
+    CustomDillUnpickler,
+    CustomPickler,
+)
+from ..utils import atomic_write
+from .queues import get_live_messages, restore_messages
+
+LOG = logging.getLogger(__name__)
+
+MESSAGE_LOGS_DIR_NAME = "message-logs"
+MESSAGE_LOGS_DIR = os.path.join(BASE_DIR, "sqs", MESSAGE_LOGS_DIR_NAME)
+
+# Logs are compacted once at least this proportion of their records are for deleted messages or superseded
+# updates, and they're at least COMPACTION_MIN_SIZE bytes
+COMPACTION_THRESHOLD = 0.5
+COMPACTION_MIN_SIZE = 1024 * 1024
+
+# Header fields: record kind, payload length, crc32 of payload
+RECORD_HEADER = struct.Struct("<BII")
+# Payload is a pickled SqsMessage
+RECORD_ENQUEUE = 1
+# Payload is the (utf-8 encoded) ID of a deleted message
+RECORD_ACK = 2
+# Payload is JSON of a message's ID, receive count and attributes, which change whenever it's received
+RECORD_UPDATE = 3
+
+
+def encode_record(kind: int, payload: bytes) -> bytes:
+    return RECORD_HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+
+def encode_enqueue(message: SqsMessage) -> bytes:
+    buffer = io.BytesIO()
+    try:
+        CustomPickler(buffer).dump(message)
+    except:
+        buffer = io.BytesIO()
+        CustomDillPickler(buffer).dump(message)
+    return encode_record(RECORD_ENQUEUE, buffer.getvalue())
+
+
+def encode_update(message: SqsMessage) -> bytes:
+    update = {
+        "id": message.message_id,
+        "receive_count": message.receive_count,
+        "first_received": message.first_received,
+        "attributes": message.message.get("Attributes"),
+    }
+    return encode_record(RECORD_UPDATE, json.dumps(update).encode("utf-8"))
+
+
+def scan_records(file: BinaryIO) -> Iterator[tuple[int, bytes]]:
+    while header := file.read(RECORD_HEADER.size):
+        if len(header) < RECORD_HEADER.size:
+            return
+        kind, length, crc = RECORD_HEADER.unpack(header)
+        payload = file.read(length)
+        # stop at a record that was only partially written, e.g. because the container was killed
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        yield kind, payload
+
+
+# Append-only log of the messages in a single queue. Saving the queue only appends records for messages that were
+# sent, deleted or received since it was last saved, so takes time proportional to the number of changes rather
+# than the number of messages in the queue. In-memory state only tracks each logged message's receive count.
+class MessageLog:
+    def __init__(self, path: str):
+        self.path = path
+        self._receive_counts = dict[str, int]()
+        self._records = 0
+        self._size = 0
+        # whether the log was loaded from the base layer, so must be rewritten in full rather than appended to
+        self._from_base_layer = False
+
+    # Reads all messages that are still in the log, in the order they were sent
+    def load(self) -> list[SqsMessage]:
+        messages = dict[str, SqsMessage]()
+        self._records = 0
+        self._size = 0
+
+        path = get_read_path(self.path)
+        self._from_base_layer = path != self.path
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            self._receive_counts = {}
+            return []
+
+        with file:
+            for kind, payload in scan_records(file):
+                if kind == RECORD_ENQUEUE:
+                    message = CustomDillUnpickler(io.BytesIO(payload)).load()
+                    messages[message.message_id] = message
+                elif kind == RECORD_ACK:
+                    messages.pop(payload.decode("utf-8"), None)
+                elif kind == RECORD_UPDATE:
+                    update = json.loads(payload)
+                    if message := messages.get(update["id"]):
+                        message.receive_count = update["receive_count"]
+                        message.first_received = update["first_received"]
+                        message.message["Attributes"] = update["attributes"]
+                self._records += 1
+                self._size += RECORD_HEADER.size + len(payload)
+
+        if self._size < os.path.getsize(path) and not self._from_base_layer:
+            LOG.warning("Discarding incomplete record at end of %s", path)
+            os.truncate(path, self._size)
+
+        self._receive_counts = {id: m.receive_count for id, m in messages.items()}
+        return sorted(messages.values(), key=lambda m: m.created)
+
+    # Appends records for messages that were sent, deleted or received since the log was last written, given all
+    # messages that are currently in the queue
+    def write(self, messages: list[SqsMessage]):
+        # every message that's been sent to a queue has an ID
+        live = {m.message_id: m for m in messages if m.message_id is not None}
+        records = [
+            encode_record(RECORD_ACK, id.encode("utf-8"))
+            for id in self._receive_counts.keys() - live.keys()
+        ]
+        for id, message in live.items():
+            logged_receive_count = self._receive_counts.get(id)
+            if logged_receive_count is None:
+                records.append(encode_enqueue(message))
+            elif logged_receive_count != message.receive_count:
+                records.append(encode_update(message))
+
+        if not records:
+            return
+
+        self._receive_counts = {id: m.receive_count for id, m in live.items()}
+        total_records = self._records + len(records)
+
+        if not live:
+            self.remove()
+        elif self._from_base_layer or (
+            self._size >= COMPACTION_MIN_SIZE
+            and total_records - len(live) >= total_records * COMPACTION_THRESHOLD
+        ):
+            self._compact(list(live.values()))
+        else:
+            data = b"".join(records)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "ab") as file:
+                file.write(data)
+            self._records = total_records
+            self._size += len(data)
+
+        METRICS.increment("sqs.message_log.records", len(records))
+
+    def remove(self):
+        remove_log_file(self.path)
+        self._from_base_layer = False
+        self._records = 0
+        self._size = 0
+
+    # Rewrites the log with just an enqueue record for each message currently in the queue
+    def _compact(self, messages: list[SqsMessage]):
+        data = b"".join(
+            encode_enqueue(m) for m in sorted(messages, key=lambda m: m.created)
+        )
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with atomic_write(self.path, "wb") as file:
+            file.write(data)
+        self._from_base_layer = False
+        self._records = len(messages)
+        self._size = len(data)
+        METRICS.increment("sqs.message_log.compactions")
+
+
+# Removes a message log file. If the base layer has a log for the same queue, an empty log is left in its place,
+# so that the base layer's messages aren't loaded again.
+def remove_log_file(path: str):
+    base_layer_path = get_base_layer_path(path)
+    if base_layer_path and os.path.exists(base_layer_path):
+        if not os.path.exists(path) or os.path.getsize(path) > 0:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with atomic_write(path, "wb"):
+                pass
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+_logs = dict[str, MessageLog]()
+_logs_lock = Lock()
+
+
+def get_message_log_path(queue: SqsQueue) -> str:
+    return os.path.join(
+        MESSAGE_LOGS_DIR, f"{queue.account_id}.{queue.region}.{queue.name}.log"
+    )
+
+
+def get_message_log(queue: SqsQueue) -> MessageLog:
+    path = get_message_log_path(queue)
+    with _logs_lock:
+        if log := _logs.get(path):
+            return log
+        log = _logs[path] = MessageLog(path)
+    # the log must be read to know which of its messages need to be acked
+    log.load()
+    return log
+
+
+# Restores the messages of all queues in a store from their message logs
+def load_message_logs(store: SqsStore):
+    for queue in store.queues.values():
+        log = MessageLog(get_message_log_path(queue))
+        if messages := log.load():
+            restore_messages(queue, messages)
+        with _logs_lock:
+            _logs[log.path] = log
+
+
+def write_message_logs(state: AccountRegionBundle):
+    paths = set[str]()
+    for _, _, store in state.iter_stores():
+        for queue in list(store.queues.values()):
+            log = get_message_log(queue)
+            log.write(get_live_messages(queue))
+            paths.add(log.path)
+
+    # remove logs of deleted queues
+    if os.path.isdir(MESSAGE_LOGS_DIR):
+        for name in os.listdir(MESSAGE_LOGS_DIR):
+            path = os.path.join(MESSAGE_LOGS_DIR, name)
+            if name.endswith(".log") and path not in paths:
+                remove_log_file(path)
+                with _logs_lock:
+                    _logs.pop(path, None)
+
+
+# Removes all message logs, once messages are persisted in the SQS store file instead
+def remove_message_logs():
+    forget_message_logs()
+    if os.path.isdir(MESSAGE_LOGS_DIR):
+        shutil.rmtree(MESSAGE_LOGS_DIR)
+
+    base_layer_dir = get_base_layer_path(MESSAGE_LOGS_DIR)
+    if base_layer_dir and os.path.isdir(base_layer_dir):
+        for name in os.listdir(base_layer_dir):
+            if name.endswith(".log"):
+                remove_log_file(os.path.join(MESSAGE_LOGS_DIR, name))
+
+
+# Discards cached message logs, e.g. after they're replaced by a snapshot
+def forget_message_logs():
+    with _logs_lock:
+        _logs.clear()
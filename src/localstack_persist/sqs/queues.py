@@ -0,0 +1,55 @@
+from typing import Any, Iterable
+
+from localstack.services.sqs.models import FifoQueue, SqsMessage, SqsQueue
+
+from ..config import PERSIST_SQS_MESSAGE_LOG
+
+# Attributes of SqsQueue (and its subclasses) that hold messages. These aren't persisted in the SQS store file
+# when messages are persisted in message logs instead.
+MESSAGE_ATTRIBUTES = {
+    "visible",
+    "inflight",
+    "delayed",
+    "receipts",
+    "message_groups",
+    "inflight_groups",
+    "message_group_queue",
+}
+
+
+# Returns the attributes of a queue to persist, replacing any message containers with empty ones when messages are
+# persisted separately in message logs
+def get_queue_state(queue: SqsQueue) -> dict[str, Any]:
+    if not PERSIST_SQS_MESSAGE_LOG:
+        return queue.__dict__
+
+    return {
+        k: type(v)() if k in MESSAGE_ATTRIBUTES else v
+        for k, v in queue.__dict__.items()
+    }
+
+
+# Returns all messages in a queue that haven't been deleted, whether visible, in flight or delayed
+def get_live_messages(queue: SqsQueue) -> list[SqsMessage]:
+    with queue.mutex:
+        messages = list(queue.inflight) + list(queue.delayed)
+        if isinstance(queue, FifoQueue):
+            for message_group in queue.message_groups.values():
+                messages.extend(message_group.messages)
+        else:
+            messages.extend(queue.visible.queue)  # type: ignore[attr-defined]
+
+    return [m for m in messages if not m.deleted]
+
+
+# Puts messages loaded from a message log back into a queue. Messages that were in flight become visible again
+# immediately, since their receipt handles aren't persisted.
+def restore_messages(queue: SqsQueue, messages: Iterable[SqsMessage]):
+    with queue.mutex:
+        for message in sorted(messages, key=lambda m: m.created):
+            message.receipt_handles.clear()
+            message.visibility_deadline = None
+            if message.is_delayed:
+                queue.delayed.add(message)
+            else:
+                queue._put_message(message)
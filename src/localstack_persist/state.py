@@ -1,6 +1,9 @@
 import logging
 import os
-from typing import cast
+import time
+from concurrent.futures import wait
+from contextlib import ExitStack
+from typing import Any, Callable, Optional, cast
 
 from localstack.aws.handlers import (
     serve_custom_service_request_handlers,
@@ -12,14 +15,49 @@ from localstack.aws.api import RequestContext
 from collections import defaultdict
 from threading import Thread, Condition, Timer
 from readerwriterlock.rwlock import RWLockWrite, Lockable
-from .visitors import LoadStateVisitor, SaveStateVisitor
-from .config import BASE_DIR, is_persistence_enabled, PERSIST_FREQUENCY
-from .prepare_service import prepare_service
+from .visitors import LoadStateVisitor, ResetStateVisitor, SaveStateVisitor
+from .config import (
+    BASE_DIR,
+    ProfileOperation,
+    SerializationFormat,
+    is_persistence_enabled,
+    PERSIST_FREQUENCY,
+    PERSIST_SHUTDOWN_TIMEOUT,
+)
+from .profiling import profile
+from .prepare_service import prepare_service, release_s3_files
+from .asset_sync import forget_manifests
+from .manifest import forget_service_manifest, get_service_manifest
+from .sqs.message_log import forget_message_logs
+from .bundle import (
+    Bundle,
+    import_service_dir,
+    list_seed_services,
+    seed_service,
+    write_bundle,
+)
+from .layers import list_persisted_services
+from .lock_tracing import LOCK_TRACER, ReadLockHold
+from .metrics import METRICS
+from .utils import DaemonThreadPool
+from .snapshots import (
+    create_snapshot,
+    get_snapshot,
+    list_service_dirs,
+    remove_incomplete_snapshots,
+    restore_service_dir,
+)
 
 LOG = logging.getLogger(__name__)
 
 IDEMPOTENT_VERBS = ["GET", "HEAD", "QUERY", "LIST", "DESCRIBE"]
 
+# Maximum number of services to persist at once when LocalStack stops
+SHUTDOWN_MAX_WORKERS = 8
+# Proportion of PERSIST_SHUTDOWN_TIMEOUT reserved for persisting services in the binary format, if they haven't
+# started being persisted normally by then
+SHUTDOWN_FALLBACK_RESERVE = 0.25
+
 
 def lazy_load(service_name: str):
     # Lambda relies on other services being ready
@@ -34,7 +72,12 @@ def invoke_load_hooks(service_name: str):
 class StateTracker:
     def __init__(self):
         self.affected_services = set()
+        # when each affected service was first changed since it was last persisted
+        self.affected_since = dict[str, float]()
+        # how long, in milliseconds, each service took to persist the last time it was persisted
+        self.save_durations = dict[str, float]()
         self.loaded_services = set()
+        self.failed_services = set()
         self.cond = Condition()
         self.is_running = False
         self.rwlocks = defaultdict[str, RWLockWrite](lambda: RWLockWrite())
@@ -51,7 +94,7 @@ class StateTracker:
         assert self.is_running
         self.is_running = False
         with self.cond:
-            self.save_all_services_state()
+            self._save_all_services_state_before_shutdown()
             self.cond.notify()
 
     def on_request(self, chain, context: RequestContext, response):
@@ -74,11 +117,18 @@ class StateTracker:
         # Prevent persistence from running for this service while handling this request...
         rlock = self.rwlocks[service_name].gen_rlock()
         setattr(context, "localstack-persist_rlock", rlock)
+        wait_start = time.perf_counter()
         rlock.acquire()
+        hold = LOCK_TRACER.read_acquired(
+            service_name,
+            context.operation.name if context.operation else "unknown",
+            wait_start,
+        )
+        setattr(context, "localstack-persist_rlock_hold", hold)
         # ...unless the request takes over 1 second, in which case we force release the lock to
         # prevent long-running requests from blocking persistence which would in turn block other
         # requests
-        timer = Timer(1, try_release, [rlock])
+        timer = Timer(1, force_release, [rlock, hold])
         setattr(context, "localstack-persist_rlock_timer", timer)
         timer.start()
 
@@ -100,6 +150,11 @@ class StateTracker:
         self.add_affected_service(service_name)
 
     def on_finalize(self, chain, context: RequestContext, response):
+        if hold := cast(
+            ReadLockHold | None, getattr(context, "localstack-persist_rlock_hold", None)
+        ):
+            LOCK_TRACER.read_released(hold)
+
         if rlock := cast(
             Lockable | None, getattr(context, "localstack-persist_rlock", None)
         ):
@@ -112,17 +167,12 @@ class StateTracker:
 
     def load_all_services_state(self):
         LOG.info("Loading persisted state of all services...")
-        if not os.path.exists(BASE_DIR):
-            return
-
-        with os.scandir(BASE_DIR) as it:
-            for entry in it:
-                if is_persistence_enabled(entry.name) and not lazy_load(entry.name):
-                    if not entry.is_dir():
-                        LOG.warning("Expected %s to be a directory", entry.path)
-                        continue
+        remove_incomplete_snapshots()
 
-                    self._load_service_state(entry.name)
+        services = set(list_persisted_services()) | set(list_seed_services())
+        for service_name in sorted(services):
+            if is_persistence_enabled(service_name) and not lazy_load(service_name):
+                self._load_service_state(service_name)
 
     def save_all_services_state(self):
         with self.cond:
@@ -132,6 +182,9 @@ class StateTracker:
 
             affected_services = list(self.affected_services)
             self.affected_services.clear()
+            affected_since = {
+                s: self.affected_since.pop(s, time.time()) for s in affected_services
+            }
 
             LOG.debug("Persisting state of services: %s", affected_services)
 
@@ -144,11 +197,169 @@ class StateTracker:
                             "Error while persisting state of service %s", service_name
                         )
                         self.affected_services.add(service_name)
+                        self.affected_since.setdefault(
+                            service_name, affected_since[service_name]
+                        )
 
             LOG.debug("Finished persisting %d services.", len(affected_services))
 
+    # Snapshots the persisted data of all services, after persisting any outstanding changes
+    def create_snapshot(self, name: Optional[str] = None) -> dict[str, Any]:
+        with self.cond:
+            self.save_all_services_state()
+            services = list_service_dirs()
+            with ExitStack() as stack:
+                # S3 objects are written directly to the persisted data directory while handling requests
+                for service_name in services:
+                    stack.enter_context(self.write_lock(service_name, "snapshot"))
+                return create_snapshot(name, services)
+
+    # Replaces the persisted data of all services with a snapshot, and reloads the state of any services that
+    # were already loaded, without needing to restart LocalStack
+    def rollback_to_snapshot(self, name: str):
+        snapshot = get_snapshot(name)
+        LOG.info("Rolling back to snapshot %s...", name)
+        with self.cond:
+            # changes that haven't been persisted yet must be rolled back too
+            services = sorted(
+                set(list_service_dirs())
+                | set(snapshot["services"])
+                | self.affected_services
+            )
+            for service_name in services:
+                with self.write_lock(service_name, "rollback"):
+                    self._replace_service_data(
+                        service_name, lambda: restore_service_dir(name, service_name)
+                    )
+        LOG.info("Finished rolling back to snapshot %s", name)
+
+    # Writes the persisted data of all services to a bundle, after persisting any outstanding changes
+    def export_bundle(self, path: str) -> dict[str, Any]:
+        with self.cond:
+            self.save_all_services_state()
+            services = list_persisted_services()
+            with ExitStack() as stack:
+                for service_name in services:
+                    stack.enter_context(self.write_lock(service_name, "export"))
+                return write_bundle(path, services)
+
+    # Replaces the persisted data of every service in a bundle with its data from the bundle, and reloads the state
+    # of any of those services that were already loaded
+    def import_bundle(self, path: str) -> dict[str, Any]:
+        with Bundle(path) as bundle:
+            LOG.info("Importing bundle %s...", path)
+            with self.cond:
+                for service_name in bundle.services:
+                    with self.write_lock(service_name, "import"):
+                        self._replace_service_data(
+                            service_name,
+                            lambda: import_service_dir(bundle, service_name),
+                        )
+            LOG.info("Finished importing bundle %s", path)
+            return bundle.info()
+
     def add_affected_service(self, service_name: str):
         self.affected_services.add(service_name)
+        self.affected_since.setdefault(service_name, time.time())
+
+    # Persists all changed services when LocalStack stops, in parallel, within PERSIST_SHUTDOWN_TIMEOUT seconds so
+    # that the container isn't killed mid-write. Services are persisted in order of how long they've had unsaved
+    # changes, except that those expected to take longer than the timeout go last. Services that haven't started
+    # being persisted once most of the timeout has passed are persisted in the binary format only (which is the
+    # quickest to write) instead of the configured formats. Services are persisted by daemon threads, so that any
+    # still being persisted when the timeout expires don't delay LocalStack from exiting.
+    def _save_all_services_state_before_shutdown(self):
+        services = [s for s in self.affected_services if is_persistence_enabled(s)]
+        self.affected_services.clear()
+        if not services:
+            LOG.debug("Nothing to persist - no services were changed")
+            return
+
+        start = time.monotonic()
+        timeout_ms = PERSIST_SHUTDOWN_TIMEOUT * 1000
+        services.sort(
+            key=lambda s: (
+                (self._estimate_save_duration_ms(s) or 0) > timeout_ms,
+                self.affected_since.get(s, time.time()),
+            )
+        )
+        LOG.info(
+            "Persisting state of services before shutdown: %s", ", ".join(services)
+        )
+
+        executor = DaemonThreadPool(
+            min(len(services), SHUTDOWN_MAX_WORKERS), "persist-shutdown"
+        )
+        futures = {executor.submit(self._save_service_state, s): s for s in services}
+        wait(
+            futures,
+            timeout=PERSIST_SHUTDOWN_TIMEOUT * (1 - SHUTDOWN_FALLBACK_RESERVE),
+        )
+
+        fallback_futures = {}
+        if not_started := [s for f, s in futures.items() if f.cancel()]:
+            fallback_executor = DaemonThreadPool(
+                min(len(not_started), SHUTDOWN_MAX_WORKERS), "persist-shutdown-fallback"
+            )
+            fallback_futures = {
+                fallback_executor.submit(
+                    self._save_service_state, s, [SerializationFormat.BINARY]
+                ): s
+                for s in not_started
+            }
+            fallback_executor.shutdown()
+        executor.shutdown()
+
+        remaining = PERSIST_SHUTDOWN_TIMEOUT - (time.monotonic() - start)
+        all_futures = {
+            f: s for f, s in futures.items() if not f.cancelled()
+        } | fallback_futures
+        wait(all_futures, timeout=max(0, remaining))
+
+        saved, saved_as_binary, failed, unfinished = [], [], [], []
+        for future, service_name in all_futures.items():
+            if not future.done():
+                unfinished.append(service_name)
+            elif exception := future.exception():
+                LOG.error(
+                    "Error while persisting state of service %s",
+                    service_name,
+                    exc_info=exception,
+                )
+                failed.append(service_name)
+            elif future in fallback_futures:
+                saved_as_binary.append(service_name)
+            else:
+                saved.append(service_name)
+
+        duration_ms = (time.monotonic() - start) * 1000
+        METRICS.histogram("shutdown.save_duration_ms").record(duration_ms)
+        METRICS.increment("shutdown.services_unfinished", len(unfinished))
+        LOG.info(
+            "Persisted state of services before shutdown in %.0f ms: %s",
+            duration_ms,
+            ", ".join(saved) or "none",
+        )
+        if saved_as_binary:
+            LOG.warning(
+                "Persisted state of services in binary format only, due to the shutdown timeout: %s",
+                ", ".join(saved_as_binary),
+            )
+        if failed:
+            LOG.error(
+                "Failed to persist state of services before shutdown: %s",
+                ", ".join(failed),
+            )
+        if unfinished:
+            LOG.error(
+                "Timed out persisting state of services before shutdown, so their changes may be lost: %s",
+                ", ".join(unfinished),
+            )
+
+    def _estimate_save_duration_ms(self, service_name: str) -> Optional[float]:
+        if duration_ms := self.save_durations.get(service_name):
+            return duration_ms
+        return get_service_manifest(service_name).get_save_duration_ms()
 
     def _run(self):
         while self.is_running:
@@ -156,47 +367,102 @@ class StateTracker:
                 self.save_all_services_state()
                 self.cond.wait(PERSIST_FREQUENCY)
 
-    def _load_service_state(self, service_name: str):
-        LOG.info("Loading persisted state of service %s...", service_name)
-        prepare_service(service_name)
-        self.loaded_services.add(service_name)
+    # Prevents requests from being handled by a service while its state or persisted data is being accessed
+    def write_lock(self, service_name: str, reason: str):
+        return LOCK_TRACER.write_lock(service_name, self.rwlocks[service_name], reason)
 
-        service = SERVICE_PLUGINS.get_service(service_name)
-        if not service:
-            LOG.warning(
-                "No service %s found in service manager",
-                service_name,
-            )
-            return
-
-        should_invoke_hooks = invoke_load_hooks(service_name)
-        try:
-            if should_invoke_hooks:
-                service.lifecycle_hook.on_before_state_load()
-            service.accept_state_visitor(LoadStateVisitor(service_name))
-            if should_invoke_hooks:
-                service.lifecycle_hook.on_after_state_load()
-            LOG.debug("Finished loading persisted state of service %s", service_name)
-        except:
-            LOG.exception("Error while loading state of service %s", service_name)
+    def _load_service_state(self, service_name: str):
+        with profile(ProfileOperation.LOAD, service_name):
+            LOG.info("Loading persisted state of service %s...", service_name)
+            seed_service(service_name)
+            prepare_service(service_name)
+            self.loaded_services.add(service_name)
+
+            service = SERVICE_PLUGINS.get_service(service_name)
+            if not service:
+                LOG.warning(
+                    "No service %s found in service manager",
+                    service_name,
+                )
+                return
 
-    def _save_service_state(self, service_name: str):
+            should_invoke_hooks = invoke_load_hooks(service_name)
+            visitor = LoadStateVisitor(service_name)
+            try:
+                if should_invoke_hooks:
+                    service.lifecycle_hook.on_before_state_load()
+                service.accept_state_visitor(visitor)
+                if should_invoke_hooks:
+                    service.lifecycle_hook.on_after_state_load()
+                if visitor.failed:
+                    self.failed_services.add(service_name)
+                LOG.debug(
+                    "Finished loading persisted state of service %s", service_name
+                )
+            except:
+                LOG.exception("Error while loading state of service %s", service_name)
+                self.failed_services.add(service_name)
+
+    # Replaces the persisted data of a service using `replace_dir`, first resetting the service's state if it was
+    # loaded and then reloading it
+    def _replace_service_data(self, service_name: str, replace_dir: Callable[[], None]):
+        # services that haven't been loaded (or started) yet will load the new data when they're first used. Services
+        # that started without any persisted data hold state that must be replaced too.
+        was_loaded = service_name in self.loaded_services or SERVICE_PLUGINS.is_running(
+            service_name
+        )
+        service = SERVICE_PLUGINS.get_service(service_name) if was_loaded else None
+        if service:
+            service.lifecycle_hook.on_before_state_reset()
+            service.accept_state_visitor(ResetStateVisitor(service_name))
+            service.lifecycle_hook.on_after_state_reset()
+        if service_name == "s3":
+            release_s3_files()
+        elif service_name == "sqs":
+            forget_message_logs()
+
+        replace_dir()
+        forget_service_manifest(service_name)
+        forget_manifests(os.path.join(BASE_DIR, service_name))
+        self.affected_services.discard(service_name)
+        self.affected_since.pop(service_name, None)
+        self.failed_services.discard(service_name)
+
+        if was_loaded:
+            self._load_service_state(service_name)
+
+    def _save_service_state(
+        self,
+        service_name: str,
+        formats: Optional[list[SerializationFormat]] = None,
+    ):
         service = SERVICE_PLUGINS.get_service(service_name)
         if not service:
             LOG.error("No service %s found in service manager", service_name)
             return
 
-        with self.rwlocks[service_name].gen_wlock():
+        # lock waits are included in the profile, as they're part of the time taken to save
+        with profile(ProfileOperation.SAVE, service_name), self.write_lock(
+            service_name, "save"
+        ):
             LOG.info("Persisting state of service %s...", service_name)
+            start = time.perf_counter()
             service.lifecycle_hook.on_before_state_save()
-            service.accept_state_visitor(SaveStateVisitor(service_name))
+            service.accept_state_visitor(SaveStateVisitor(service_name, formats))
             service.lifecycle_hook.on_after_state_save()
+            if not formats:
+                self.save_durations[service_name] = (time.perf_counter() - start) * 1000
             LOG.debug("Finished persisting state of service %s", service_name)
 
 
 STATE_TRACKER = StateTracker()
 
 
+def force_release(lock: Lockable, hold: ReadLockHold):
+    if LOCK_TRACER.read_released(hold, forced=True):
+        try_release(lock)
+
+
 def try_release(lock: Lockable):
     if lock and lock.locked():
         try:
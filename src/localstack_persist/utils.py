@@ -1,4 +1,13 @@
+import hashlib
+import os
 from collections.abc import Callable
+from concurrent.futures import Future
+from contextlib import contextmanager
+from queue import SimpleQueue
+from threading import Thread
+from typing import IO, Any, Optional
+
+DIGEST_CHUNK_SIZE = 1024 * 1024
 
 
 def once(f: Callable[[], None]) -> Callable[[], None]:
@@ -11,3 +20,107 @@ def once(f: Callable[[], None]) -> Callable[[], None]:
             return f()
 
     return wrapper
+
+
+# Minimal thread pool whose workers are daemon threads, so unlike `ThreadPoolExecutor`, its unfinished tasks don't
+# delay the process from exiting
+class DaemonThreadPool:
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self._queue = SimpleQueue[Optional[tuple[Future, Callable, tuple]]]()
+        self._workers = [
+            Thread(target=self._work, name=f"{thread_name_prefix}_{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, fn: Callable, *args: Any) -> Future:
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    # Stops the workers once they've run all submitted tasks that haven't been cancelled
+    def shutdown(self):
+        for _ in self._workers:
+            self._queue.put(None)
+
+    def _work(self):
+        while item := self._queue.get():
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+def add_affected_service(service_name: str):
+    # circular dependency :(
+    from .state import STATE_TRACKER
+
+    STATE_TRACKER.add_affected_service(service_name)
+
+
+def new_digest():
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(path: str) -> str:
+    h = new_digest()
+    with open(path, "rb") as file:
+        while chunk := file.read(DIGEST_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Wraps a file that's being written to compute the same digest as `file_digest` would, without reading the file
+# back afterwards. Text is hashed in the file's encoding.
+class HashingWriter:
+    def __init__(self, file: IO):
+        self._file = file
+        self._encoding = getattr(file, "encoding", None) or "utf-8"
+        self._hash = new_digest()
+
+    def write(self, data: str | bytes) -> int:
+        self._hash.update(
+            data.encode(self._encoding) if isinstance(data, str) else data
+        )
+        return self._file.write(data)
+
+    # Only rewinding to the start is supported, to rewrite the whole file (which must then be truncated)
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if offset != 0 or whence != 0:
+            raise ValueError("HashingWriter can only seek to the start of the file")
+        self._hash = new_digest()
+        return self._file.seek(0)
+
+    def truncate(self) -> int:
+        return self._file.truncate()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+# Writes to a temporary file which then replaces `path`, so that a partially-written file is never left behind,
+# and any hardlinks to the previous file (i.e. in snapshots) are left unchanged
+@contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, mode) as file:
+            yield file
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Removes `path` if it's also hardlinked elsewhere (i.e. in a snapshot), so that it can then be rewritten in
+# place without modifying the other links
+def break_hardlink(path: str):
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
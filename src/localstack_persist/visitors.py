@@ -1,7 +1,8 @@
 import json
 import os
 import shutil
-from typing import Dict, Optional, Any, TypeAlias
+import time
+from typing import Any, Optional, TypeAlias
 
 import logging
 
@@ -10,23 +11,52 @@ from localstack.services.stores import AccountRegionBundle
 from localstack.state import AssetDirectory, StateContainer, StateVisitor
 
 from localstack.services.s3.models import S3Store as V3S3Store
-from localstack.services.opensearch.models import OpenSearchStore
-from localstack.services.lambda_.invocation.models import LambdaStore
 from localstack.services.sqs.models import SqsStore
-from watchdog.observers import Observer
-from watchdog.observers.api import BaseObserver
-from watchdog.events import FileSystemEventHandler
 
 import moto.utilities.utils
 from moto.core.base_backend import BackendDict, BaseBackend
 from moto.s3.models import s3_backends
 
-from .serialization import get_deserializer, get_serializers
-from .config import BASE_DIR, SerializationFormat, PERSIST_FORMATS
+from .serialization import (
+    describe_saved_state,
+    get_deserializer,
+    get_formats,
+    get_serializers,
+)
+from .serialization.auto import choose_format
+from .config import (
+    BASE_DIR,
+    AssetFormat,
+    SerializationFormat,
+    PERSIST_ASSET_FORMAT,
+    PERSIST_SQS_MESSAGE_LOG,
+    get_persist_formats,
+)
+from .fixups import apply_fixups, record_fixups
+from .layers import get_read_path
+from .manifest import get_service_manifest
+from .utils import add_affected_service
+from .asset_archive import (
+    ARCHIVE_EXT,
+    extract_asset_archive,
+    get_archive_path,
+    write_asset_archive,
+)
+from .asset_sync import (
+    remove_asset_directory,
+    restore_asset_directory,
+    sync_asset_directory,
+)
+from .sqs.message_log import remove_message_logs, write_message_logs
+from .watcher import (
+    invalidate_changed_paths,
+    start_watcher,
+    suppress_events,
+    take_changed_paths,
+)
 
 SerializableState: TypeAlias = BackendDict | AccountRegionBundle
 
-logging.getLogger("watchdog").setLevel(logging.INFO)
 LOG = logging.getLogger(__name__)
 
 
@@ -56,13 +86,6 @@ def state_type(state: Any) -> type:
     )
 
 
-def add_affected_service(service_name: str):
-    # circular dependency :(
-    from .state import STATE_TRACKER
-
-    STATE_TRACKER.add_affected_service(service_name)
-
-
 def is_legacy_s3_store(arb: AccountRegionBundle) -> bool:
     for _, _, store in arb.iter_stores():
         return "bucket_lifecycle_configuration" in store._global
@@ -74,6 +97,8 @@ class LoadStateVisitor(StateVisitor):
     def __init__(self, service_name: str) -> None:
         super().__init__()
         self.service_name = service_name
+        # whether any persisted state couldn't be loaded, leaving the service (partly) empty
+        self.failed = False
 
     def visit(self, state_container: StateContainer):
         if isinstance(state_container, BackendDict | AccountRegionBundle):
@@ -82,14 +107,21 @@ class LoadStateVisitor(StateVisitor):
             if str(state_container.path).startswith(BASE_DIR):
                 # nothing to do - assets are read directly from the volume
                 return
-            dir_path = get_asset_dir_path(state_container)
-            if os.path.isdir(dir_path):
-                shutil.copytree(
-                    dir_path,
-                    state_container.path,
-                    dirs_exist_ok=True,
-                    copy_function=shutil.copy,
-                )
+            # assets that haven't changed since the base layer was created are restored from it, and copied to
+            # BASE_DIR the next time they're saved
+            dir_path = get_read_path(
+                get_asset_dir_path(state_container),
+                ("", ARCHIVE_EXT),
+            )
+            archive_path = get_archive_path(dir_path)
+            with suppress_events(str(state_container.path)):
+                if os.path.isfile(archive_path) and (
+                    PERSIST_ASSET_FORMAT == AssetFormat.ARCHIVE
+                    or not os.path.isdir(dir_path)
+                ):
+                    extract_asset_archive(archive_path, state_container.path)
+                elif os.path.isdir(dir_path):
+                    restore_asset_directory(dir_path, state_container.path)
             os.makedirs(state_container.path, exist_ok=True)
             start_watcher(self.service_name, str(state_container.path))
 
@@ -100,7 +132,10 @@ class LoadStateVisitor(StateVisitor):
         state_migrated = False
         state_container_type = state_type(state_container)
 
-        file_path_base = get_state_file_path_base(state_container)
+        file_path_base = get_read_path(
+            get_state_file_path_base(state_container),
+            [format.file_ext() for format in SerializationFormat],
+        )
         deserializer = get_deserializer(state_container.service_name, file_path_base)
         if not deserializer:
             return
@@ -123,6 +158,7 @@ class LoadStateVisitor(StateVisitor):
                 state_migrated = True
             except:
                 LOG.exception("Error migrating S3 state to V3 provider")
+                self.failed = True
                 return
         elif state_container_type != deserialized_type:
             LOG.error(
@@ -130,46 +166,13 @@ class LoadStateVisitor(StateVisitor):
                 deserialized_type,
                 state_container_type,
             )
+            self.failed = True
             return
 
-        # Set Processing because after loading state, it will take some time for opensearch/elasticsearch to start.
-        if deserialized_type == AccountRegionBundle[OpenSearchStore]:
-            for region_bundle in deserialized.values():
-                os_store: OpenSearchStore
-                for os_store in region_bundle.values():
-                    for domain in os_store.opensearch_domains.values():
-                        domain["Processing"] = True
-
-        if deserialized_type == AccountRegionBundle[LambdaStore]:
-            for region_bundle in deserialized.values():
-                lambda_store: LambdaStore
-                for lambda_store in region_bundle.values():
-                    for function in lambda_store.functions.values():
-                        # Workarounds for restoring state of old lambda functions
-                        # 1. Call `__post_init__()` to populate `instance_id` field. This is done by `__setstate__`, but that's
-                        #    only called if the `Function` had a `__getstate__` when serialized, which was not always the case.
-                        if hasattr(function, "__post_init__"):
-                            function.__post_init__()  # type: ignore
-                        # 2. Populate the required `logging_config` field with a default value in case the field wasn't present
-                        #    when the `Function` was serialized.
-                        for function_version in function.versions.values():
-                            if not hasattr(function_version.config, "logging_config"):
-                                object.__setattr__(
-                                    function_version.config, "logging_config", {}
-                                )
-                                state_migrated = True
-
-        if deserialized_type == AccountRegionBundle[SqsStore]:
-            for region_bundle in deserialized.values():
-                sqs_store: SqsStore
-                for sqs_store in region_bundle.values():
-                    for queue in sqs_store.queues.values():
-                        # Computed attributes don't get serialized to JSON and are unreliably serialized by dill, so restore them from `default_attributes()`
-                        for k, v in queue.default_attributes().items():
-                            if k not in queue.attributes or callable(
-                                queue.attributes[k]
-                            ):
-                                queue.attributes[k] = v
+        if isinstance(deserialized, AccountRegionBundle):
+            manifest = get_service_manifest(state_container.service_name)
+            if apply_fixups(manifest, deserialized, deserializer.file_path):
+                state_migrated = True
 
         if isinstance(deserialized, BackendDict):
             deserialized._additional_regions = state_container._additional_regions  # type: ignore
@@ -196,9 +199,14 @@ class LoadStateVisitor(StateVisitor):
 class SaveStateVisitor(StateVisitor):
     json_encoder = json.JSONEncoder(check_circular=False, separators=(",", ":"))
 
-    def __init__(self, service_name: str) -> None:
+    # `formats` overrides the formats that state files are saved in, e.g. to save quickly during shutdown. Files in
+    # other formats are then kept, as the override doesn't change which formats are configured.
+    def __init__(
+        self, service_name: str, formats: Optional[list[SerializationFormat]] = None
+    ) -> None:
         super().__init__()
         self.service_name = service_name
+        self.formats = formats
 
     def visit(self, state_container: StateContainer):
         if isinstance(state_container, BackendDict | AccountRegionBundle):
@@ -208,8 +216,25 @@ class SaveStateVisitor(StateVisitor):
                 # nothing to do - assets are written directly to the volume
                 return
             dir_path = get_asset_dir_path(state_container)
+            archive_path = get_archive_path(dir_path)
             if os.path.isdir(state_container.path):
-                self._sync_directories(state_container.path, dir_path)
+                changed_paths = take_changed_paths(str(state_container.path))
+                try:
+                    if PERSIST_ASSET_FORMAT == AssetFormat.ARCHIVE:
+                        write_asset_archive(state_container.path, archive_path)
+                        remove_asset_directory(dir_path)
+                    else:
+                        if not os.path.isdir(dir_path):
+                            changed_paths = None
+                        sync_asset_directory(
+                            state_container.path, dir_path, changed_paths
+                        )
+                        if os.path.exists(archive_path):
+                            os.remove(archive_path)
+                except:
+                    # the changes may have been partly persisted, so the next save must sync the whole directory
+                    invalidate_changed_paths(str(state_container.path))
+                    raise
             else:
                 os.makedirs(state_container.path, exist_ok=True)
             start_watcher(self.service_name, str(state_container.path))
@@ -221,75 +246,89 @@ class SaveStateVisitor(StateVisitor):
 
         os.makedirs(os.path.dirname(file_path_base), exist_ok=True)
 
-        serializers = get_serializers(state_container.service_name, file_path_base)
+        sqs_store = (
+            state_container
+            if isinstance(state_container, AccountRegionBundle)
+            and state_container.store is SqsStore
+            else None
+        )
+        if sqs_store is not None and PERSIST_SQS_MESSAGE_LOG:
+            # messages must be logged before they're omitted from the store file
+            write_message_logs(sqs_store)
+
+        if self.formats:
+            formats = self.formats
+        else:
+            if get_persist_formats(state_container.service_name) is None:
+                choose_format(
+                    state_container.service_name, file_path_base, state_container
+                )
+            formats = get_formats(state_container.service_name, file_path_base)
+
+        start = time.perf_counter()
+        serializers = get_serializers(
+            state_container.service_name, file_path_base, formats
+        )
         for serializer in serializers:
             serializer.serialize(state_container)
-
-        for disabled_format in set(SerializationFormat) - set(PERSIST_FORMATS):
-            path = file_path_base + disabled_format.file_ext()
-            if os.path.exists(path):
-                os.remove(path)
-
-    @staticmethod
-    def _sync_directories(src: str | os.PathLike, dst: str | os.PathLike):
-        def delete_extra_files(src: str | os.PathLike, dst: str | os.PathLike):
-            desired_files = set(os.listdir(src))
-            with os.scandir(dst) as it:
-                dst_entries = list(it)
-
-            for entry in dst_entries:
-                should_delete = entry.name not in desired_files
-                is_dir = entry.is_dir(follow_symlinks=False)
-                if should_delete and is_dir:
-                    shutil.rmtree(entry)
-                elif should_delete:
-                    os.remove(entry)
-                elif is_dir:
-                    delete_extra_files(os.path.join(src, entry.name), entry.path)
-
-        shutil.copytree(src, dst, dirs_exist_ok=True, copy_function=shutil.copy)
-        delete_extra_files(src, dst)
-
-
-# TODO copy changed files directly in this handler, instead of relying on SaveStateVisitor on syncing directories
-class AffectedServiceHandler(FileSystemEventHandler):
-    def __init__(self, service_name: str) -> None:
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        if not self.formats:
+            for disabled_format in set(SerializationFormat) - set(formats):
+                path = file_path_base + disabled_format.file_ext()
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if sqs_store is not None and not PERSIST_SQS_MESSAGE_LOG:
+            remove_message_logs()
+
+        manifest = get_service_manifest(state_container.service_name)
+        manifest.set_state_file(
+            os.path.basename(file_path_base),
+            describe_saved_state(state_container, serializers, duration_ms),
+        )
+        if isinstance(state_container, AccountRegionBundle):
+            record_fixups(manifest, state_container)
+        manifest.save()
+
+
+# Passes only a service's serializable state to `visitor`, skipping its asset directories, e.g. to migrate state files
+# without restoring assets into LocalStack's data directory
+class StateFilesVisitor(StateVisitor):
+    def __init__(self, visitor: StateVisitor) -> None:
         super().__init__()
-        self.service_name = service_name
-
-    def on_created(self, event):
-        self._handle_event()
-
-    def on_deleted(self, event):
-        self._handle_event()
-
-    def on_modified(self, event):
-        self._handle_event()
-
-    def on_moved(self, event):
-        self._handle_event()
+        self.visitor = visitor
 
-    def _handle_event(self):
-        add_affected_service(self.service_name)
-
-
-path_watchers: Dict[str, AffectedServiceHandler] = {}
-observer: Optional[BaseObserver] = None
-
-
-def start_watcher(service_name: str, path: str):
-    if path in path_watchers:
-        return
-
-    global observer
-    old_observer = observer
-    observer = Observer()
+    def visit(self, state_container: StateContainer):
+        if isinstance(state_container, BackendDict | AccountRegionBundle):
+            self.visitor.visit(state_container)
 
-    path_watchers[path] = AffectedServiceHandler(service_name)
 
-    for watcher_path, watcher in path_watchers.items():
-        observer.schedule(watcher, watcher_path, recursive=True)
+# Clears the in-memory state of a service, so that state loaded afterwards (e.g. from a snapshot) replaces it
+# rather than being merged into it
+class ResetStateVisitor(StateVisitor):
+    def __init__(self, service_name: str) -> None:
+        super().__init__()
+        self.service_name = service_name
 
-    observer.start()
-    if old_observer:
-        old_observer.stop()
+    def visit(self, state_container: StateContainer):
+        if isinstance(state_container, (AccountRegionBundle, BackendDict)):
+            # also clears state shared between accounts/regions
+            state_container.reset()
+        elif isinstance(state_container, AssetDirectory):
+            if str(state_container.path).startswith(BASE_DIR):
+                # nothing to do - assets are read directly from the volume
+                return
+            if not os.path.isdir(state_container.path):
+                return
+            # remove the directory's contents rather than the directory itself, so that it's still being watched
+            with suppress_events(str(state_container.path)):
+                with os.scandir(state_container.path) as it:
+                    entries = list(it)
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+        else:
+            LOG.warning("Unexpected state_container type: %s", type(state_container))
@@ -0,0 +1,210 @@
+import errno
+import fnmatch
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Optional
+
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver, ObservedWatch
+from watchdog.observers.polling import PollingObserver
+
+from .config import PERSIST_WATCH_IGNORE, normalise_service_name
+from .metrics import METRICS
+from .utils import add_affected_service
+
+logging.getLogger("watchdog").setLevel(logging.INFO)
+LOG = logging.getLogger(__name__)
+
+# Maximum number of changed paths to track per asset directory, after which the next save falls back to
+# syncing the whole directory
+MAX_TRACKED_CHANGES = 10000
+
+# Once a service has been marked as affected, further events within this many seconds don't need to mark it
+# again (unless its assets are persisted in the meantime)
+DEBOUNCE_WINDOW = 1.0
+
+# Glob patterns (matched against the full path) of files whose changes alone don't warrant persisting a service.
+# Changes to these files are still persisted whenever the service is next persisted for another reason.
+COMMON_IGNORE_PATTERNS = ["*.lock", "*.tmp", "*~", "*-shm"]
+DEFAULT_IGNORE_PATTERNS = {
+    # OpenSearch/Elasticsearch constantly rewrite cluster state files, even when no data changes
+    "opensearch": COMMON_IGNORE_PATTERNS + ["*/_state/*"],
+    "es": COMMON_IGNORE_PATTERNS + ["*/_state/*"],
+}
+
+
+def get_ignore_patterns(service_name: str) -> list[str]:
+    service_name = normalise_service_name(service_name)
+    if service_name in PERSIST_WATCH_IGNORE:
+        return PERSIST_WATCH_IGNORE[service_name]
+    return DEFAULT_IGNORE_PATTERNS.get(service_name, COMMON_IGNORE_PATTERNS)
+
+
+class AffectedServiceHandler(FileSystemEventHandler):
+    def __init__(self, service_name: str) -> None:
+        super().__init__()
+        self.service_name = service_name
+        self.ignore_patterns = get_ignore_patterns(service_name)
+        self._changed_paths = set[str]()
+        # Until the first save after (re)starting, changes aren't known so the whole directory must be synced
+        self._overflowed = True
+        self._lock = Lock()
+        self._last_affected = 0.0
+        # number of `suppress_events()` blocks currently active for this handler
+        self._suppressed = 0
+        self._suppressed_until = 0.0
+
+    def on_created(self, event):
+        self._handle_event(event)
+
+    def on_deleted(self, event):
+        self._handle_event(event)
+
+    def on_modified(self, event):
+        self._handle_event(event)
+
+    def on_moved(self, event):
+        self._handle_event(event)
+
+    def take_changed_paths(self) -> Optional[set[str]]:
+        with self._lock:
+            changed_paths = None if self._overflowed else self._changed_paths
+            self._changed_paths = set()
+            self._overflowed = False
+            # any further changes will need to be persisted in the next save
+            self._last_affected = 0.0
+            return changed_paths
+
+    def invalidate_changed_paths(self):
+        with self._lock:
+            self._overflowed = True
+            self._changed_paths = set()
+
+    def _handle_event(self, event: FileSystemEvent):
+        METRICS.increment("watcher.events")
+        paths = [os.fsdecode(event.src_path)]
+        if event.dest_path:
+            paths.append(os.fsdecode(event.dest_path))
+
+        # A directory's mtime changes whenever a file within it is added/removed, but those files have
+        # their own events, so there's no need to re-sync the entire directory
+        if not (event.is_directory and event.event_type == "modified"):
+            for path in paths:
+                self._record_changed_path(path)
+
+        now = time.monotonic()
+        if self._suppressed or now < self._suppressed_until:
+            METRICS.increment("watcher.events_suppressed")
+            return
+
+        if all(self._is_ignored(path) for path in paths):
+            METRICS.increment("watcher.events_ignored")
+            return
+
+        if now - self._last_affected < DEBOUNCE_WINDOW:
+            METRICS.increment("watcher.events_debounced")
+            return
+        self._last_affected = now
+
+        add_affected_service(self.service_name)
+
+    def _is_ignored(self, path: str) -> bool:
+        return any(fnmatch.fnmatch(path, pattern) for pattern in self.ignore_patterns)
+
+    def _record_changed_path(self, path: str):
+        with self._lock:
+            if self._overflowed:
+                return
+            self._changed_paths.add(path)
+            if len(self._changed_paths) > MAX_TRACKED_CHANGES:
+                self._overflowed = True
+                self._changed_paths = set()
+
+
+path_watchers: Dict[str, AffectedServiceHandler] = {}
+observer: Optional[BaseObserver] = None
+# Used for any paths that can't be watched by `observer` because inotify limits have been reached
+polling_observer: Optional[BaseObserver] = None
+polling_paths = set[str]()
+watchers_lock = Lock()
+
+
+# Changes made within `path` while in this block (e.g. while restoring its assets) don't cause its service to be
+# persisted, though they're still synced whenever the service is next persisted. Events are delivered
+# asynchronously, so suppression continues for a short time after the block ends.
+@contextmanager
+def suppress_events(path: str):
+    watcher = path_watchers.get(path)
+    if not watcher:
+        yield
+        return
+
+    with watcher._lock:
+        watcher._suppressed += 1
+    try:
+        yield
+    finally:
+        with watcher._lock:
+            watcher._suppressed -= 1
+            watcher._suppressed_until = time.monotonic() + DEBOUNCE_WINDOW
+
+
+# Returns the paths changed within `path` since this was last called, or None if the whole directory
+# needs to be synced
+def take_changed_paths(path: str) -> Optional[set[str]]:
+    watcher = path_watchers.get(path)
+    return watcher.take_changed_paths() if watcher else None
+
+
+# Makes the next `take_changed_paths(path)` return None, e.g. when the changes it returned couldn't be persisted
+def invalidate_changed_paths(path: str):
+    if watcher := path_watchers.get(path):
+        watcher.invalidate_changed_paths()
+
+
+def start_watcher(service_name: str, path: str):
+    global observer
+    global polling_observer
+
+    with watchers_lock:
+        if path in path_watchers:
+            return
+
+        handler = AffectedServiceHandler(service_name)
+
+        if not observer:
+            observer = Observer()
+            observer.start()
+
+        try:
+            observer.schedule(handler, path, recursive=True)
+        except OSError as e:
+            if e.errno not in (errno.ENOSPC, errno.EMFILE):
+                raise
+
+            LOG.warning(
+                "Unable to watch %s for changes (%s) - falling back to polling, which is "
+                "slower. Consider increasing fs.inotify.max_user_watches/max_user_instances",
+                path,
+                e.strerror,
+            )
+            try:
+                observer.remove_handler_for_watch(
+                    handler, ObservedWatch(path, recursive=True)
+                )
+            except KeyError:
+                pass
+
+            if not polling_observer:
+                polling_observer = PollingObserver()
+                polling_observer.start()
+            polling_observer.schedule(handler, path, recursive=True)
+            polling_paths.add(path)
+
+        path_watchers[path] = handler
+        METRICS.set_gauge("watcher.watched_paths", len(path_watchers))
+        METRICS.set_gauge("watcher.polling_paths", len(polling_paths))
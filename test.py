@@ -1,14 +1,56 @@
 #!/usr/bin/env python3
 import glob
+import json
+import struct
 import subprocess
 import os
 import shutil
+import time
 
 
 def sh(cmd: str):
     subprocess.run(cmd, check=True, shell=True)
 
 
+def wait_until(cmd: str, timeout: int = 60):
+    for _ in range(timeout):
+        if subprocess.run(cmd, shell=True).returncode == 0:
+            return
+        time.sleep(1)
+    raise Exception(f"`{cmd}` did not succeed within {timeout}s")
+
+
+# A bundle whose index tries to write a file outside of the persisted data directory, which must be rejected
+ESCAPED_PATH = "/escaped-from-bundle"
+
+
+def malicious_bundle() -> bytes:
+    data = b"escaped"
+    relpath = "../.." + ESCAPED_PATH
+    index = {
+        "version": 1,
+        "created_at": 0,
+        "services": {
+            "sqs": {
+                "dirs": [],
+                "files": [{"path": relpath, "offset": 8, "size": 7, "mtime_ns": 0}],
+            }
+        },
+    }
+    index_data = json.dumps(index).encode("utf-8")
+    footer = struct.pack("<QQ8s", 8 + len(data), len(index_data), b"LSPBNDL1")
+    return b"LSPBNDL1" + data + index_data + footer
+
+
+# Small S3 objects are only packed into segment files when PERSIST_S3_SMALL_OBJECT_THRESHOLD is set
+SEGMENTS_PATH = "/persisted-data/s3/assets/test-bucket/.segments"
+SEGMENTS_EXPECTED = bool(os.environ.get("PERSIST_S3_SMALL_OBJECT_THRESHOLD"))
+
+
+# An S3 object file that isn't referenced by the S3 state, which is old enough to be removed by PERSIST_S3_GC
+ORPHAN_PATH = "/persisted-data/s3/assets/test-bucket/orphaned-object@null"
+
+
 if os.path.exists("temp-persisted-data"):
     shutil.rmtree("temp-persisted-data")
 
@@ -16,12 +58,31 @@ sh("docker compose build")
 
 if not os.environ.get("SKIP_TEST_SETUP"):
     sh("docker compose run --rm test setup")
+    subprocess.run(
+        "docker compose exec -T localstack-persist "
+        "sh -c 'mkdir -p /persisted-data/_bundles && cat > /persisted-data/_bundles/malicious.bundle'",
+        input=malicious_bundle(),
+        check=True,
+        shell=True,
+    )
 
     print("Ensure resources were created...", flush=True)
     sh("docker compose run --rm test verify")
+    sh(
+        "docker compose exec localstack-persist sh -c "
+        f"'echo orphan > {ORPHAN_PATH} && touch -d \"2 hours ago\" {ORPHAN_PATH}'"
+    )
     sh("docker compose stop")
     print("Ensure changes were persisted and can be loaded...", flush=True)
     sh("docker compose run --rm test verify")
+    print("Ensure orphaned S3 files are removed...", flush=True)
+    wait_until(f"docker compose exec localstack-persist test ! -e {ORPHAN_PATH}")
+    sh(f"docker compose exec localstack-persist test ! -e {ESCAPED_PATH}")
+    sh(
+        "docker compose exec localstack-persist test "
+        + ("-d " if SEGMENTS_EXPECTED else "! -e ")
+        + SEGMENTS_PATH
+    )
     sh("docker compose stop")
 
 if test_persisted_data_dir := os.environ.get("TEST_PERSISTED_DATA_DIR"):
@@ -1,8 +1,10 @@
 import sys
 from time import sleep
+from typing import Optional
 import boto3
 import io
 import zipfile
+import urllib.error
 import urllib.request
 import json
 
@@ -21,6 +23,20 @@ def wait_until_es_ready(domain_name: str):
     raise Exception(f"ElasticSearch domain {domain_name} was not ready after 180s")
 
 
+def persist_api(method: str, path: str, body: Optional[dict] = None):
+    req = urllib.request.Request(
+        endpoint_url + "/_localstack/persist" + path,
+        method=method,
+        data=json.dumps(body).encode("utf-8") if body is not None else None,
+    )
+    with urllib.request.urlopen(req) as res:
+        return json.loads(res.read().decode("utf-8"))
+
+
+def queue_names() -> set[str]:
+    return {queue.url.rsplit("/", 1)[-1] for queue in sqs.queues.all()}
+
+
 command = sys.argv[1] if len(sys.argv) > 1 else "verify"
 back_compat_dir = sys.argv[2] if len(sys.argv) > 2 else None
 
@@ -42,6 +58,29 @@ cfn_template = open("cfn_template.yaml", "r").read()
 if command == "setup":
     print("Setting up AWS resources...")
 
+    # Snapshots are rolled back and bundles imported before anything else is created, so that only SQS is affected
+    sqs.create_queue(QueueName="snapshot-queue")
+    persist_api("POST", "/snapshots", {"name": "test-snapshot"})
+    sqs.get_queue_by_name(QueueName="snapshot-queue").delete()
+    sqs.create_queue(QueueName="after-snapshot-queue")
+    persist_api("POST", "/snapshots/test-snapshot/rollback")
+    queues = queue_names()
+    assert "snapshot-queue" in queues, queues
+    assert "after-snapshot-queue" not in queues, queues
+
+    sqs.create_queue(QueueName="bundle-queue")
+    try:
+        persist_api("POST", "/bundle/export", {"name": "../outside.bundle"})
+        raise AssertionError("Bundle was exported outside of the bundles directory")
+    except urllib.error.HTTPError as e:
+        assert_equal(e.code, 400)
+    bundle = persist_api("POST", "/bundle/export", {"name": "test.bundle"})
+    assert "sqs" in bundle["services"], bundle
+    sqs.get_queue_by_name(QueueName="bundle-queue").delete()
+    persist_api("POST", "/bundle/import", {"name": "test.bundle"})
+    queues = queue_names()
+    assert "bundle-queue" in queues, queues
+
     elasticsearch.create_elasticsearch_domain(
         ElasticsearchVersion="7.10",
         DomainName="test-es-domain",
@@ -53,6 +92,13 @@ if command == "setup":
 
     sqs.create_queue(QueueName="test-queue", Attributes={"DelaySeconds": "123"})
 
+    # messages are persisted in a log per queue when PERSIST_SQS_MESSAGE_LOG is enabled
+    message_log_queue = sqs.create_queue(QueueName="message-log-queue")
+    for body in ["message 0", "message 1", "message 2"]:
+        message_log_queue.send_message(MessageBody=body)
+    for message in message_log_queue.receive_messages(MaxNumberOfMessages=1):
+        message.delete()
+
     table = dynamodb.create_table(
         TableName="test-table",
         KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
@@ -65,6 +111,16 @@ if command == "setup":
     bucket = s3.create_bucket(Bucket="test-bucket")
     bucket.put_object(Key="test-object", Body=b"object data")
 
+    # when PERSIST_S3_SMALL_OBJECT_THRESHOLD is set, objects up to that many bytes are packed into segment files
+    bucket.put_object(Key="small-object", Body=b"first")
+    bucket.put_object(Key="small-object", Body=b"second")
+    bucket.put_object(Key="small-to-large-object", Body=b"small")
+    bucket.put_object(Key="small-to-large-object", Body=b"L" * 4096)
+    bucket.put_object(Key="large-to-small-object", Body=b"L" * 4096)
+    bucket.put_object(Key="large-to-small-object", Body=b"small")
+    bucket.put_object(Key="deleted-small-object", Body=b"deleted")
+    bucket.Object("deleted-small-object").delete()
+
     role = iam.create_role(RoleName="test-role", AssumeRolePolicyDocument="{}")
 
     zipbuf = io.BytesIO()
@@ -106,6 +162,38 @@ elif command == "verify":
     assert_equal(queue.attributes["DelaySeconds"], "123")
     assert_equal(queue.attributes["ApproximateNumberOfMessages"], "0")
 
+    if not back_compat_dir:
+        queues = queue_names()
+        assert "snapshot-queue" in queues, queues
+        assert "after-snapshot-queue" not in queues, queues
+        assert "bundle-queue" in queues, queues
+
+        # planted by test.py, with a file path that escapes the service's directory
+        try:
+            persist_api("POST", "/bundle/import", {"name": "malicious.bundle"})
+            raise AssertionError("Malicious bundle was imported")
+        except urllib.error.HTTPError as e:
+            assert_equal(e.code, 400)
+
+        snapshots = persist_api("GET", "/snapshots")["snapshots"]
+        assert "test-snapshot" in [s["name"] for s in snapshots], snapshots
+
+        message_log_queue = sqs.get_queue_by_name(QueueName="message-log-queue")
+        assert_equal(message_log_queue.attributes["ApproximateNumberOfMessages"], "2")
+        # a visibility timeout of 0 leaves the messages visible for the next run
+        bodies = {
+            m.body
+            for m in message_log_queue.receive_messages(
+                MaxNumberOfMessages=10, VisibilityTimeout=0
+            )
+        }
+        assert_equal(len(bodies), 2)
+        assert bodies < {"message 0", "message 1", "message 2"}, bodies
+
+        metrics = persist_api("GET", "/metrics")
+        assert_equal(set(metrics), {"counters", "gauges", "histograms"})
+        assert "slow_events" in persist_api("GET", "/locks")
+
     table = dynamodb.Table("test-table")
     item = table.get_item(Key={"id": 123}).get("Item", {})
     assert_equal(item.get("foo"), "bar")
@@ -115,6 +203,16 @@ elif command == "verify":
     body = obj.get()["Body"].read()
     assert_equal(body, b"object data")
 
+    if not back_compat_dir:
+        for key, expected in [
+            ("small-object", b"second"),
+            ("small-to-large-object", b"L" * 4096),
+            ("large-to-small-object", b"small"),
+        ]:
+            assert_equal(bucket.Object(key).get()["Body"].read(), expected)
+        keys = [o.key for o in bucket.objects.all()]
+        assert "deleted-small-object" not in keys, keys
+
     role = iam.Role("test-role")
 
     lambda_response = lambda_client.get_function(FunctionName="test-lambda")